@@ -8,15 +8,27 @@
 import sys
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-import inspect
+
+# widget types whose values are saved
+SAVED_TYPES = (QComboBox, QLineEdit, QCheckBox, QRadioButton, QSpinBox)
 
 def strtobool(astr):
     return astr == True
 
+def savedwidgets(self):
+    # The form's widgets are attributes of self.ui; collect the saved ones
+    # once per window instead of inspecting every member on each call
+    registry = getattr(self, "_savedwidgets", None)
+    if registry is None:
+        registry = [(name, obj) for name, obj in sorted(vars(self.ui).items())
+                    if isinstance(obj, SAVED_TYPES)]
+        self._savedwidgets = registry
+    return registry
+
 def guisave(self):
     # Save geometry
     settings = self.settings
-    for name, obj in inspect.getmembers(self.ui):
+    for name, obj in savedwidgets(self):
         if isinstance(obj, QComboBox):
             name = obj.objectName()  # get combobox name
             index = obj.currentIndex()  # get current index from combobox
@@ -45,24 +57,21 @@ def guisave(self):
 
 def guirestore(self):
     settings = self.settings
-    for name, obj in inspect.getmembers(self.ui):
+    for name, obj in savedwidgets(self):
         if isinstance(obj, QComboBox):
             index = obj.currentIndex()  # get current region from combobox
             # text   = obj.itemText(index)   # get the text for new selected index
             name = obj.objectName()
 
-            value = (settings.value(name))
+            value = settings.value(name).toString()  # QVariant with API v1
 
-            if value == "":
+            if value.isEmpty():
                 continue
 
             index = obj.findText(value)  # get the corresponding index for specified string in combobox
 
-            if index == -1:  # add to list if not found
-                obj.insertItems(0, [value])
-                index = obj.findText(value)
-                obj.setCurrentIndex(index)
-            else:
+            # the items are the only valid choices, e.g. supported resolutions
+            if index != -1:
                 obj.setCurrentIndex(index)  # preselect a combobox value by index
 
         if isinstance(obj, QLineEdit):
@@ -5,30 +5,83 @@
 author: Jacob Kosberg
 """
 
+from clock import monotonic
+# taken before the other imports, so the startup report includes them
+STARTED = monotonic()
+
 import sys
 import argparse
 
-from WorkbenchUI import CameraSettings, MainWindow, Worker
+from WorkbenchUI import CameraSettings, MainWindow, RigWindow, Worker
 from transformed_stereo_cameras import StereoPair
 from PyQt4 import QtGui
 
+class StartupTimer(object):
+    """Records when each startup milestone was reached, up to the first frame."""
+
+    def __init__(self, start):
+        self.start = start
+        self.milestones = []
+
+    def mark(self, milestone):
+        # may be called from the worker thread; list appends are atomic
+        self.milestones.append((monotonic() - self.start, milestone))
+
+    def firstFrame(self, framePair):
+        self.mark("first frame")
+        print "Startup: " + ", ".join("{} at {:.0f} ms".format(milestone, seconds * 1000)
+                                      for seconds, milestone in sorted(self.milestones))
+
 def main():
+    timer = StartupTimer(STARTED)
+    timer.mark("imports")
     parser = argparse.ArgumentParser(description="UI utility for point cloud reconstruction.")
-    parser.add_argument("devices", type=int, nargs=2, help="Device numbers "
+    parser.add_argument("devices", type=int, nargs="*", help="Device numbers "
                         "for the cameras that should be accessed in order "
                         " (left, right).")
+    parser.add_argument("--rig", type=int, nargs=2, action="append", default=[],
+                        metavar=("LEFT", "RIGHT"), help="Device numbers of "
+                        "another stereo pair. Every pair is captured by a "
+                        "process of its own.")
+    parser.add_argument("--rig_output", default="captures",
+                        help="Folder for captures of several rigs.")
+    parser.add_argument("--rig_size", type=int, nargs=2, default=[1920, 1080],
+                        metavar=("WIDTH", "HEIGHT"),
+                        help="Frame size of every rig.")
+    # rendering.ENGINES, not imported at startup
+    parser.add_argument("--engine", default="sgbm", choices=["pyramid", "sgbm", "tiled"],
+                        help="Disparity engine used by Render. \"pyramid\" is "
+                        "faster but approximate.")
     args = parser.parse_args()
+    if len(args.devices) != 2 and (args.devices or not args.rig):
+        parser.error("Expected two device numbers (left, right).")
+    if args.rig:
+        runRigs([args.devices] + args.rig if args.devices else args.rig, args)
+        return
 
     with StereoPair(args.devices) as pair:
+        timer.mark("cameras")
         app = QtGui.QApplication(['Stereo Imaging'])
         thread = Worker(pair)
+        thread.disparityEngine = args.engine
+        thread.bus.request(timer.firstFrame)
         thread.start()
         mainWindow = MainWindow(pair, args.devices[0], args.devices[1], thread)
         mainWindow.show()
+        timer.mark("windows")
         sys.exit(app.exec_())
 
 
+def runRigs(rigs, args):
+    from multi_rig import RigSupervisor
+    width, height = args.rig_size
+    # rig processes are started before Qt is
+    with RigSupervisor(rigs, args.rig_output, width, height) as supervisor:
+        app = QtGui.QApplication(['Stereo Imaging'])
+        window = RigWindow(supervisor)
+        window.show()
+        app.exec_()
+
 
 if __name__ == '__main__':
     main()
-
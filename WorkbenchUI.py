@@ -9,18 +9,30 @@ import os
 import time
 import cv2
 import operator
+from datetime import datetime
 
 from SaveState import guisave, guirestore
-from PyQt4 import QtGui, QtCore, uic
-from stereovision.ui_utils import find_files, get_calibrator
-from stereovision.blockmatchers import StereoBM, StereoSGBM
-from stereovision.calibration import StereoCalibration
-from stereovision.stereo_cameras import CalibratedPair
+from chessboard_detector import ChessboardDetector
+from rectification_cache import load_calibration
+from render_cache import RenderCache
+from frame_bus import FrameBus
+from image_writer import ImageWriterPool
+from capture_catalog import CaptureCatalog, find_catalog, wall_clock
+import instrumentation
+from recording import RecordingWriter
+from scheduler import Scheduler
+from clock import monotonic
+from ui_forms import load_ui
+from viewport import StereoViewport
+from PyQt4 import QtGui, QtCore
+
+# The reconstruction stack (stereovision, block matchers, point clouds) is
+# imported where it is first used, so capture sessions start without it.
 
 class MainWindow(QtGui.QMainWindow):
     def __init__(self, pair, leftCam, rightCam, worker):
         QtGui.QMainWindow.__init__(self)
-        self.ui = uic.loadUi('workbench_ui/main.ui', self)
+        self.ui = load_ui('workbench_ui/main.ui', self)
         self.setWindowTitle("Stereo Workbench")
         self.setFixedSize(self.size())
         self.settings = QtCore.QSettings('workbench_ui/main.ini', QtCore.QSettings.IniFormat)
@@ -33,6 +45,14 @@ class MainWindow(QtGui.QMainWindow):
         worker.chessboardCount = self.chessboardCountSpinBox.value()
         worker.scale = self.viewportScaleSpinBox.value()
         worker.interval = self.intervalSpinBox.value()
+        worker.disparityScale = self.disparityScaleSpinBox.value()
+
+        # Live preview, drawn by the GUI independently of the capture rate
+        self.viewport = StereoViewport(self.viewportArea)
+        viewportLayout = QtGui.QVBoxLayout(self.viewportArea)
+        viewportLayout.setContentsMargins(0, 0, 0, 0)
+        viewportLayout.addWidget(self.viewport)
+        worker.setViewport(self.viewport)
 
         self.settingsWindows = [CameraSettings(self.pair, leftCam, isLeft=True),
                                 CameraSettings(self.pair, rightCam, isLeft=False)]
@@ -59,6 +79,22 @@ class MainWindow(QtGui.QMainWindow):
         self.intervalEnabled.stateChanged.connect(
             lambda: self.worker.setIntervalEnabled(self.intervalEnabled.isChecked()))
 
+        # Image format of captures, chessboard images are always PNG
+        self.imageEncodingComboBox.currentIndexChanged.connect(
+            lambda: self.worker.setImageEncoding(str(self.imageEncodingComboBox.currentText())))
+        self.pngCompressionSpinBox.valueChanged.connect(
+            lambda: self.worker.setPngCompression(self.pngCompressionSpinBox.value()))
+        self.jpegQualitySpinBox.valueChanged.connect(
+            lambda: self.worker.setJpegQuality(self.jpegQualitySpinBox.value()))
+        self.worker.setImageEncoding(str(self.imageEncodingComboBox.currentText()))
+        self.worker.setPngCompression(self.pngCompressionSpinBox.value())
+        self.worker.setJpegQuality(self.jpegQualitySpinBox.value())
+
+        # Recording, never resumed from the saved state
+        self.recordEnabled.setChecked(False)
+        self.recordEnabled.stateChanged.connect(
+            lambda: self.worker.setRecording(self.recordEnabled.isChecked()))
+
         """ Stereo Tools """
         # Calibration
         self.chessboardCountSpinBox.valueChanged.connect(
@@ -72,6 +108,31 @@ class MainWindow(QtGui.QMainWindow):
         self.captureChessboardButton.clicked.connect(lambda: self.worker.setCaptureChessboards(True))
         self.calibrateButton.clicked.connect(lambda: self.worker.optimizeCalibration())
 
+        # Live disparity
+        self.disparityPreviewEnabled.stateChanged.connect(
+            lambda: self.worker.setDisparityPreview(self.disparityPreviewEnabled.isChecked()))
+        self.disparityScaleSpinBox.valueChanged.connect(
+            lambda: self.worker.setDisparityScale(self.disparityScaleSpinBox.value()))
+        self.worker.setDisparityPreview(self.disparityPreviewEnabled.isChecked())
+
+        # Performance stats
+        self.statsLabel = QtGui.QLabel()
+        self.statusbar.addWidget(self.statsLabel)
+        self.statsTimer = QtCore.QTimer(self)
+        self.statsTimer.timeout.connect(self.updateStats)
+        self.statsEnabled.stateChanged.connect(
+            lambda: self.setStatsEnabled(self.statsEnabled.isChecked()))
+        self.exportStatsButton.clicked.connect(self.exportStats)
+        self.setStatsEnabled(self.statsEnabled.isChecked())
+
+        # Image writer backlog, always shown
+        self.writerLabel = QtGui.QLabel()
+        self.statusbar.addPermanentWidget(self.writerLabel)
+        self.writerTimer = QtCore.QTimer(self)
+        self.writerTimer.timeout.connect(self.updateWriterStats)
+        self.writerTimer.start(1000)
+        self.updateWriterStats()
+
         # Rendering
         self.renderButton.clicked.connect(lambda: self.worker.render(
             str(self.leftImagePath.text()),
@@ -87,21 +148,135 @@ class MainWindow(QtGui.QMainWindow):
     def changeViewportScale(self, scale):
         self.worker.setScale(scale)
 
+    def setStatsEnabled(self, enabled):
+        instrumentation.enable(enabled)
+        if enabled:
+            instrumentation.reset()
+            self.statsTimer.start(1000)
+        else:
+            self.statsTimer.stop()
+            self.statsLabel.clear()
+
+    def updateStats(self):
+        stats = instrumentation.summary()
+        if not stats:
+            return
+        fps = stats.get("frame", {}).get("rate", 0.0)
+        stages = [(name, item) for name, item in stats.items() if name != "frame"]
+        slowest = sorted(stages, key=lambda stage: -stage[1]["p50"])[:2]
+        self.statsLabel.setText("{:.1f} fps | ".format(fps) + " | ".join(
+            "{} {:.0f}/{:.0f} ms".format(name, item["p50"] * 1000, item["p99"] * 1000)
+            for name, item in slowest))
+        self.statsLabel.setToolTip(instrumentation.format_summary(stats))
+
+    def updateWriterStats(self):
+        writer = self.worker.writer
+        self.writerLabel.setText("Writer: {} queued, {} written, {} dropped, {} failed".format(
+            writer.queue_depth, writer.written, writer.dropped, writer.errors))
+
+    def exportStats(self):
+        path = QtGui.QFileDialog.getSaveFileName(self, "Export Stats", "stats.json",
+            "JSON (*.json);;CSV (*.csv);;Chrome trace (*.trace.json)")
+        if path:
+            instrumentation.export(str(path))
+            print "Stats exported to " + str(path)
+
     def openSettings(self, isLeft):
         self.settingsWindows[0 if isLeft else 1].show()
 
     def closeEvent(self, event):
-        self.worker.running = False
+        self.writerTimer.stop()
+        self.worker.stop()
+        self.viewport.stop()
         for window in self.settingsWindows:
             window.closeEvent(event)
         guisave(self)
         event.accept()
 
 
+class RigWindow(QtGui.QMainWindow):
+    """Preview, interval capture and throughput of several rigs, see multi_rig."""
+
+    def __init__(self, supervisor):
+        QtGui.QMainWindow.__init__(self)
+        self.setWindowTitle("Stereo Workbench - {} rigs".format(len(supervisor.rigs)))
+        self.supervisor = supervisor
+
+        central = QtGui.QWidget(self)
+        layout = QtGui.QVBoxLayout(central)
+        grid = QtGui.QGridLayout()
+        columns = 2 if len(supervisor.rigs) > 1 else 1
+        self.viewports = []
+        self.rigLabels = []
+        for rig in range(len(supervisor.rigs)):
+            viewport = StereoViewport(maxFps=15)
+            viewport.setMinimumSize(480, 180)
+            label = QtGui.QLabel("Rig {}".format(rig))
+            cell = QtGui.QVBoxLayout()
+            cell.addWidget(viewport, 1)
+            cell.addWidget(label)
+            grid.addLayout(cell, rig // columns, rig % columns)
+            self.viewports.append(viewport)
+            self.rigLabels.append(label)
+        layout.addLayout(grid, 1)
+
+        controls = QtGui.QHBoxLayout()
+        self.captureButton = QtGui.QPushButton("Capture All")
+        self.captureButton.clicked.connect(lambda: self.supervisor.capture())
+        self.intervalEnabled = QtGui.QCheckBox("Interval (s)")
+        self.intervalSpinBox = QtGui.QSpinBox()
+        self.intervalSpinBox.setRange(1, 86400)
+        self.intervalSpinBox.setValue(60)
+        self.intervalEnabled.stateChanged.connect(self.setInterval)
+        self.intervalSpinBox.valueChanged.connect(self.setInterval)
+        for widget in (self.captureButton, self.intervalEnabled, self.intervalSpinBox):
+            controls.addWidget(widget)
+        controls.addStretch()
+        layout.addLayout(controls)
+        self.setCentralWidget(central)
+
+        # the supervisor thread hands over references, the GUI draws them
+        supervisor.subscribe(lambda rig, framePair: self.viewports[rig].submit(
+            framePair.raw, framePair.rotation))
+        self.statsTimer = QtCore.QTimer(self)
+        self.statsTimer.timeout.connect(self.updateStats)
+        self.statsTimer.start(1000)
+
+    def setInterval(self):
+        self.supervisor.set_interval(self.intervalSpinBox.value()
+                                     if self.intervalEnabled.isChecked() else None)
+
+    def updateStats(self):
+        for rig, stats in enumerate(self.supervisor.stats()):
+            self.rigLabels[rig].setText(
+                "Rig {}: {:.1f} fps captured, {:.1f} fps received, {} skipped{}{}".format(
+                    rig, stats["published_fps"], stats["received_fps"],
+                    stats["skipped"],
+                    ", {} rejected for their size".format(stats["rejected"])
+                    if stats["rejected"] else "",
+                    "" if stats["alive"] else ", stopped"))
+
+    def closeEvent(self, event):
+        self.statsTimer.stop()
+        for viewport in self.viewports:
+            viewport.stop()
+        event.accept()
+
+
 class CameraSettings(QtGui.QWidget):
+    # (property, requested value, applied value), from the grab thread
+    propertyApplied = QtCore.pyqtSignal(int, float, float)
+
+    propertyNames = {cv2.CAP_PROP_BRIGHTNESS: "Brightness",
+                     cv2.CAP_PROP_CONTRAST: "Contrast",
+                     cv2.CAP_PROP_GAIN: "Gain",
+                     cv2.CAP_PROP_EXPOSURE: "Exposure",
+                     cv2.CAP_PROP_FRAME_WIDTH: "Width",
+                     cv2.CAP_PROP_FRAME_HEIGHT: "Height"}
+
     def __init__(self, pair, cam, isLeft):
         QtGui.QWidget.__init__(self)
-        self.ui = uic.loadUi('workbench_ui/parameters.ui', self)
+        self.ui = load_ui('workbench_ui/parameters.ui', self)
         self.pair = pair
         self.cam = cam
         self.isLeft = isLeft
@@ -115,6 +290,11 @@ class CameraSettings(QtGui.QWidget):
         self.connectObjs((self.gainSlider, self.gainSpinBox), self.setGain)
         self.connectObjs((self.exposureSlider, self.exposureSpinBox), self.setExposure)
         self.connectObjs((self.rotationSlider, self.rotationSpinBox), self.setRotation)
+        self.resolutionComboBox.currentIndexChanged.connect(self.setResolution)
+
+        # camera settings are applied by the capture side, which reports back
+        self.propertyApplied.connect(self.showAppliedValue)
+        self.pair.property_callbacks.append(self.onPropertyApplied)
 
         # restore settings
         self.settings = QtCore.QSettings('workbench_ui/parameters'+str(cam)+'.ini', QtCore.QSettings.IniFormat)
@@ -138,22 +318,41 @@ class CameraSettings(QtGui.QWidget):
         setFunction()
 
     def setBrightness(self):
-        self.pair.captures[self.getCamIndex()].set(cv2.CAP_PROP_BRIGHTNESS, self.brightnessSpinBox.value())
+        self.pair.set_property(self.getCamIndex(), cv2.CAP_PROP_BRIGHTNESS, self.brightnessSpinBox.value())
         self.changedValue()
 
     def setContrast(self):
-        self.pair.captures[self.getCamIndex()].set(cv2.CAP_PROP_CONTRAST, self.contrastSpinBox.value())
+        self.pair.set_property(self.getCamIndex(), cv2.CAP_PROP_CONTRAST, self.contrastSpinBox.value())
         self.changedValue()
 
     def setGain(self):
-        self.pair.captures[self.getCamIndex()].set(cv2.CAP_PROP_GAIN, self.gainSpinBox.value())
+        self.pair.set_property(self.getCamIndex(), cv2.CAP_PROP_GAIN, self.gainSpinBox.value())
         self.changedValue()
 
     def setExposure(self):
         # the -1 fixes weird off-by-one openCV bug
-        self.pair.captures[self.getCamIndex()].set(cv2.CAP_PROP_EXPOSURE, self.exposureSpinBox.value()-1)
+        self.pair.set_property(self.getCamIndex(), cv2.CAP_PROP_EXPOSURE, self.exposureSpinBox.value()-1)
+        self.changedValue()
+
+    def setResolution(self):
+        width, height = [int(size) for size in
+                         str(self.resolutionComboBox.currentText()).split("x")]
+        self.pair.set_resolution(self.getCamIndex(), width, height)
         self.changedValue()
 
+    def onPropertyApplied(self, index, prop, requested, applied):
+        # called on the grab thread; the signal hands over to the GUI thread
+        if index == self.getCamIndex():
+            self.propertyApplied.emit(prop, requested, applied)
+
+    def showAppliedValue(self, prop, requested, applied):
+        name = self.propertyNames.get(prop, str(prop))
+        if applied == requested:
+            self.appliedLabel.setText("{} set to {:g}".format(name, applied))
+        else:
+            self.appliedLabel.setText("{} is {:g} (requested {:g})".format(
+                name, applied, requested))
+
     def setRotation(self):
         self.pair.set_rotation(self.isLeft, self.rotationSpinBox.value())
         self.changedValue()
@@ -181,71 +380,198 @@ class Worker(QtCore.QThread):
         self.chessboardRows = 6
         self.chessboardColumns = 9
         self.chessboardSize = 0.5571 #cm
+        self.chessboardSearchScale = 0.5
+        self.fastCalibration = True
+        self.outlierThreshold = 1.0
+        self.maxOutlierFraction = 0.2
+        self.fixedPointMaps = True
+        self.plyFormat = "binary"
+        self.disparityEngine = "sgbm"
+        self.renderCache = RenderCache()
+        self.pointCloudFilters = {}
+        self.disparityPreview = None
+        self.disparityScale = 50
+        self.viewport = None
+        self.recorder = None
+        self.recordingSlots = 256
+        self.frameRate = 60
+        self.chessboardDelay = 2.0
+        self.scheduler = Scheduler()
+        self.bus = FrameBus(pair)
+        self.bus.subscribe(self.show_frames)
+        self.writer = ImageWriterPool()
+        self.catalogs = {}
 
     def run(self):
+        """
+        Publish pairs at up to ``frameRate`` per second and run the capture
+        schedules, sleeping in between.
+        """
+        self.scheduler.add("frames", 1.0 / self.frameRate, self.tick, delay=0)
         while self.running:
             if self.captureChessboards:
-                for i in range(self.chessboardCount):
-                    self.captureAndSaveChessboardPair(i)
-                    start = time.time()
-                    while time.time() < start + 2:
-                        self.show_frames()
+                self.captureChessboardPairs()
                 self.captureChessboards = False
-                
-            elif self.intervalEnabled:
-                start = time.time()
-                while time.time() < start + self.interval:
-                    self.show_frames()
-                self.captureBoth()
-            else:
-                self.show_frames()
-                
+            self.scheduler.run_pending()
+            self.scheduler.wait()
+
         self.kill()
 
-    def captureAndSaveChessboardPair(self, imgNum, show=True):
+    def captureChessboardPairs(self):
+        """
+        Save ``chessboardCount`` pairs showing the chessboard in both cameras.
+
+        Detection runs in the background on the latest published pair, so the
+        preview keeps running at full rate while the board is searched for.
+        """
         self.verifyPathExists(self.chessboardCapturePath)
-        found_chessboard = [False, False]
-        while not all(found_chessboard):
-            frames = self.pair.get_frames()
-            if show:
-                self.show_frames()
-            for i, frame in enumerate(frames):
-                (found_chessboard[i],
-                 corners) = cv2.findChessboardCorners(frame,
-                 (self.chessboardRows, self.chessboardColumns),
-                 flags=cv2.CALIB_CB_FAST_CHECK)
-
-        for side, frame in zip(("left", "right"), frames):
+        # the views are numbered from 1 again, replacing earlier runs' files
+        self.getCatalog(self.chessboardCapturePath).new_session()
+        detector = ChessboardDetector((self.chessboardRows, self.chessboardColumns),
+                                      scale=self.chessboardSearchScale)
+        i = 0
+        lastIndex = None
+        resume = 0
+        while i < self.chessboardCount and self.running:
+            self.scheduler.wait()
+            self.scheduler.run_pending()
+            framePair = self.bus.latest
+            if framePair is None or framePair.index == lastIndex:
+                continue
+            lastIndex = framePair.index
+            # give the user time to move the board
+            if monotonic() < resume:
+                continue
+            found = detector.poll()
+            if not found:
+                detector.submit(framePair)
+                continue
+            self.saveChessboardPair(found[0], i)
+            i += 1
+            resume = monotonic() + self.chessboardDelay
+            detector.discard()
+        detector.close()
+
+    def saveChessboardPair(self, framePair, imgNum):
+        paths = []
+        for side, frame in zip(("left", "right"), framePair.frames):
             number_string = str(imgNum + 1).zfill(len(str(self.chessboardCount)))
             filename = "{}_{}.png".format(side, number_string)
             filepath = os.path.join(self.chessboardCapturePath, filename)
-            cv2.imwrite(filepath, frame)
+            # calibration input must be lossless and must not be dropped
+            paths.append(self.writer.submit(filepath, frame, encoding="png", block=True))
+        self.catalogPair(self.chessboardCapturePath, framePair, paths, kind="chessboard")
 
     def verifyPathExists(self, path):
         if path in [None, ""]:
             raise ValueError("Path cannot be empty!")
 
-    def show_frames(self):
-        self.pair.show_frames(wait=1, scale=self.scale)
+    def tick(self):
+        """Acquire one frame pair and publish it to every consumer."""
+        return self.bus.publish()
+
+    def setViewport(self, viewport):
+        """Show the preview in ``viewport`` instead of HighGUI windows."""
+        self.viewport = viewport
+
+    def show_frames(self, framePair):
+        preview = self.disparityPreview
+        disparity = None
+        if preview:
+            preview.submit(framePair.frames)
+            disparity = preview.image
+        if self.viewport:
+            # hands over references only, the GUI draws when it gets to it
+            frames, rotation = list(framePair.raw), list(framePair.rotation)
+            if disparity is not None:
+                frames.append(disparity)
+                rotation.append(0)
+            self.viewport.submit(frames, rotation)
+            return
+        if disparity is not None:
+            cv2.imshow(preview.window, disparity)
+        self.pair.show_frames(wait=1, scale=self.scale, frames=framePair.raw)
 
     def captureBoth(self):
-        for i in [0, 1]:
-            self.captureImage(i)
+        self.bus.request(lambda framePair: self.saveFrames(framePair, (0, 1)))
 
     def captureImage(self, isLeft):
-        images = self.pair.get_frames()
         cam = 0 if isLeft else 1
-        cv2.imwrite(self.getImageFilepath(self.imagesPath, cam), images[cam])
-
+        self.bus.request(lambda framePair: self.saveFrames(framePair, (cam,)))
+
+    def saveFrames(self, framePair, cams):
+        # both sides are named after the grab time, so their names match
+        timestamp = wall_clock(framePair.timestamp)
+        paths = [None, None]
+        for cam in cams:
+            paths[cam] = self.writer.submit(self.getImageFilepath(self.imagesPath, cam, timestamp),
+                                            framePair.frames[cam])
+        if any(paths):
+            self.catalogPair(self.imagesPath, framePair, paths)
+
+    def getCatalog(self, path):
+        """Return the catalog of the capture folder ``path``, opening it once."""
+        catalog = self.catalogs.get(path)
+        if catalog is None:
+            catalog = self.catalogs[path] = CaptureCatalog(path)
+        return catalog
+
+    def catalogPair(self, path, framePair, paths, kind="capture"):
+        """Record the (left, right) ``paths`` saved from ``framePair``."""
+        self.getCatalog(path).add(wall_clock(framePair.timestamp), paths,
+                                  framePair.rotation,
+                                  [dict(properties) for properties in self.pair.properties],
+                                  kind)
+
+    def setRecording(self, enabled):
+        """Start or stop recording every published pair at full rate."""
+        if self.recorder:
+            recorder, self.recorder = self.recorder, None
+            self.bus.unsubscribe(self.recordFrames)
+            recorder.close()
+            print("Recorded {} pairs to {}, dropped: {}".format(
+                recorder.written, recorder.path, recorder.dropped))
+        if not enabled:
+            return
+        self.verifyPathExists(self.imagesPath)
+        path = os.path.join(self.imagesPath,
+                            time.strftime("Recording_%Y-%m-%d_%H-%M-%S"))
+        self.recorder = RecordingWriter(path, self.recordingSlots)
+        self.bus.subscribe(self.recordFrames)
+        print "Recording to " + path
+
+    def recordFrames(self, framePair):
+        recorder = self.recorder
+        if recorder:
+            recorder.write(framePair.raw, framePair.timestamps, framePair.rotation)
+
+    def getChessboardPairs(self):
+        """
+        Return the (left, right) chessboard images of the latest chessboard
+        session in the catalog, or of the whole folder without a catalog.
+        """
+        catalog = find_catalog(self.chessboardCapturePath)
+        if catalog is not None:
+            with catalog:
+                sessions = catalog.sessions(kind="chessboard")
+                if sessions:
+                    return [entry.paths for entry in
+                            catalog.pairs(kind="chessboard", session=sessions[-1][0])]
+        from stereovision.ui_utils import find_files
+        input_files_list = find_files(self.chessboardCapturePath)
+        return zip(input_files_list, input_files_list[1:])[::2]
 
     def optimizeCalibration(self):
-        input_files_list = find_files(self.chessboardCapturePath)
-        input_files = zip(input_files_list, input_files_list[1:])[::2]
+        from stereovision.ui_utils import get_calibrator
+        input_files = self.getChessboardPairs()
         calibrator = get_calibrator(list(input_files),
             self.chessboardRows,
             self.chessboardColumns, 
             self.chessboardSize)
         print("Calibrating cameras. This can take a while.")
+        if self.fastCalibration:
+            self.optimizeCalibrationFast(input_files, calibrator)
+            return
 
         i = 1
         removed = []
@@ -263,6 +589,28 @@ class Worker(QtCore.QThread):
         self.showError(input_files, sorted_errors)
         print avg_errors
 
+    def optimizeCalibrationFast(self, input_files, calibrator):
+        """
+        Drop every pair above ``outlierThreshold`` per round, warm-starting
+        each round from the last one, and export only the final calibration.
+        """
+        from fast_calibration import reject_outliers
+        start = time.time()
+        calibration, rounds = reject_outliers(calibrator,
+            threshold=self.outlierThreshold,
+            max_fraction=self.maxOutlierFraction)
+        calibration.export(self.calibrationPath)
+
+        print "Round\tImages\tAvg error\tMax error\tRemoved\tSeconds"
+        for i, calibrationRound in enumerate(rounds):
+            print "{}\t{}\t{:.4f}\t\t{:.4f}\t\t{}\t{:.2f}".format(i + 1,
+                calibrationRound["images"], calibrationRound["avg_error"],
+                calibrationRound["max_error"], len(calibrationRound["removed"]),
+                calibrationRound["seconds"])
+        print "Calibration optimization completed with {} rounds in {:.1f} s.".format(
+            len(rounds), time.time() - start)
+        self.showError(input_files, rounds[-1]["errors"])
+
     def calibrate(self, input_files, calibrator, showErrors=False):
         calibration = calibrator.calibrate_cameras()
         calibration.export(self.calibrationPath)
@@ -285,32 +633,38 @@ class Worker(QtCore.QThread):
                 print input_names,"\t\t\t",error
 
     def render(self, leftImagePath, rightImagePath, outputPath):
+        from rendering import load_block_matcher, render_pair
         image_pair = [cv2.imread(os.path.abspath(image)) for image in [leftImagePath, rightImagePath]]
         use_stereobm = False
-        if use_stereobm:
-            block_matcher = StereoBM()
-        else:
-            block_matcher = StereoSGBM()
-
-        block_matcher.load_settings("bm_settings.txt")
-        camera_pair = CalibratedPair(None,
-                                    StereoCalibration(input_folder=self.calibrationPath),
-                                    block_matcher)
-        rectified_pair = camera_pair.calibration.rectify(image_pair)
-
-        points = camera_pair.get_point_cloud(rectified_pair)
-        points = points.filter_infinity()
-        points.write_ply(outputPath)
+        block_matcher = load_block_matcher("bm_settings.txt", use_stereobm,
+                                           self.disparityEngine)
+        calibration = load_calibration(self.calibrationPath,
+                                       fixed_point=self.fixedPointMaps)
+        try:
+            render_pair(image_pair, calibration, block_matcher, outputPath,
+                        ply_format=self.plyFormat, filters=self.pointCloudFilters,
+                        cache=self.renderCache)
+        finally:
+            if hasattr(block_matcher, "close"):
+                block_matcher.close()
         print "Rendered! output: " + outputPath
 
-    def getImageFilepath(self, path, cam):
+    def getImageFilepath(self, path, cam, timestamp=None):
         self.verifyPathExists(path)
-        date_string = time.strftime("%Y-%m-%d_%H-%M-%S")
+        if timestamp is None:
+            timestamp = time.time()
+        # microseconds, so captures within a second get names of their own
+        date_string = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d_%H-%M-%S-%f")
         fileName = ["Left", "Right"][cam] + "_"  + date_string + ".png"
         return os.path.join(path, fileName)
 
     def setIntervalEnabled(self, enabled):
+        """Capture both cameras every ``interval`` seconds, on the interval."""
         self.intervalEnabled = enabled
+        if enabled:
+            self.scheduler.add("interval", self.interval, self.captureBoth)
+        else:
+            self.scheduler.remove("interval")
 
     def setChessboardCount(self, count):
         self.chessboardCount = count
@@ -332,6 +686,64 @@ class Worker(QtCore.QThread):
 
     def setInterval(self, interval):
         self.interval = interval
+        if self.intervalEnabled:
+            self.setIntervalEnabled(True)
+
+    def addSchedule(self, name, interval, callback, delay=None):
+        """
+        Run ``callback`` on the capture thread every ``interval`` seconds,
+        alongside interval capture, e.g. a burst of captures every hour.
+        """
+        self.scheduler.add(name, interval, callback, delay)
+
+    def removeSchedule(self, name):
+        self.scheduler.remove(name)
+
+    def setDisparityPreview(self, enabled):
+        """Start or stop the live disparity preview."""
+        if self.disparityPreview:
+            self.disparityPreview.stop()
+            self.disparityPreview = None
+        if not enabled:
+            return
+        from disparity_preview import DisparityPreview
+        from rendering import load_block_matcher
+        try:
+            calibration = load_calibration(self.calibrationPath,
+                                           fixed_point=self.fixedPointMaps)
+            block_matcher = load_block_matcher("bm_settings.txt")
+        except (IOError, OSError) as error:
+            print "Cannot start disparity preview: {}".format(error)
+            return
+        self.disparityPreview = DisparityPreview(calibration, block_matcher,
+                                                 self.disparityScale / 100.0)
+
+    def setDisparityScale(self, scale):
+        self.disparityScale = scale
+        if self.disparityPreview:
+            self.setDisparityPreview(True)
+
+    def setImageEncoding(self, encoding):
+        self.writer.encoding = encoding
+
+    def setPngCompression(self, level):
+        self.writer.png_compression = level
+
+    def setJpegQuality(self, quality):
+        self.writer.jpeg_quality = quality
+
+    def stop(self):
+        """Stop the capture loop and write out every queued image."""
+        self.running = False
+        self.scheduler.wake()
+        self.wait(5000)
+        self.setDisparityPreview(False)
+        self.setRecording(False)
+        self.writer.close()
+        for catalog in self.catalogs.values():
+            catalog.close()
+        print("Images written: {}, dropped: {}, failed: {}".format(
+            self.writer.written, self.writer.dropped, self.writer.errors))
 
     def kill(self):
         self.running = False
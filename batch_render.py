@@ -0,0 +1,272 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Render every stereo pair in a capture directory to point clouds.
+
+Pairs are read from the folder's capture catalog if it has one, optionally
+limited to a time range, without listing the folder. ``--check_catalog`` lists
+it anyway and reports pairs missing from the catalog. Otherwise left and right
+images are paired by file name (``Left_<stamp>.png`` and
+``Right_<stamp>.png``, or any other extension the image writer produces;
+``.npy`` arrays are loaded as they were saved). Pairs are rendered by a pool of
+processes. Each process loads the block matcher settings and the calibration
+once and keeps them for every pair it renders. Progress and per-stage timings
+are printed as pairs finish. Point clouds are written under a temporary name
+and renamed when complete, and pairs whose point cloud already exists are
+skipped, so an interrupted run resumes where it stopped.
+"""
+
+from argparse import ArgumentParser
+import multiprocessing
+import os
+import re
+import time
+from datetime import datetime
+
+import cv2
+from stereovision.ui_utils import STEREO_BM_FLAG
+
+from capture_catalog import find_catalog
+from image_writer import EXTENSIONS, read_image
+from ply_writer import COORDINATE_TYPES
+from rectification_cache import load_calibration
+from render_cache import RenderCache
+from rendering import ENGINES, load_block_matcher, render_pair
+
+#: Splits capture file names into side and the stamp shared by both sides;
+#: only names with an extension the image writer produces are captures
+PAIR_PATTERN = re.compile(r"^(left|right)_?(.*)({})$".format(
+    "|".join(re.escape(extension)
+             for extension in sorted(set(EXTENSIONS.values())))),
+    re.IGNORECASE)
+
+#: Format of --start and --end, as in capture file names
+TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+#: Calibration and block matcher of the current worker process
+_worker_state = {}
+
+
+def find_pairs(folder):
+    """Return sorted (left, right, stamp) tuples for the images in ``folder``."""
+    sides = {}
+    for name in os.listdir(folder):
+        match = PAIR_PATTERN.match(name)
+        if not match:
+            continue
+        sides.setdefault(match.group(2), {})[match.group(1).lower()] = (
+            os.path.join(folder, name))
+    return [(paths["left"], paths["right"], stamp)
+            for stamp, paths in sorted(sides.items()) if len(paths) == 2]
+
+
+def catalog_pairs(catalog, start=None, end=None):
+    """
+    Yield (left, right, stamp) for the captures in ``catalog`` grabbed from
+    wall clock ``start`` up to ``end``, in grab order.
+    """
+    for entry in catalog.pairs(start, end, kind="capture"):
+        match = PAIR_PATTERN.match(os.path.basename(entry.left))
+        stamp = (match.group(2) if match else
+                 os.path.splitext(os.path.basename(entry.left))[0])
+        yield entry.left, entry.right, stamp
+
+
+def _parse_time(text):
+    """
+    Return the wall clock time of ``text`` in ``TIME_FORMAT``, optionally
+    followed by "-" and microseconds.
+    """
+    seconds, fraction = text, ""
+    if text.count("-") > 4:
+        seconds, _, fraction = text.rpartition("-")
+    moment = datetime.strptime(seconds, TIME_FORMAT)
+    if fraction:
+        moment = moment.replace(microsecond=int(fraction.ljust(6, "0")[:6]))
+    return time.mktime(moment.timetuple()) + moment.microsecond * 1e-6
+
+
+def _init_worker(calibration_folder, bm_settings, use_stereobm, engine,
+                 fixed_point, render_options, threads):
+    """Load calibration and block matcher once per worker process."""
+    # the pool already keeps every core busy
+    cv2.setNumThreads(1)
+    _worker_state["calibration"] = load_calibration(calibration_folder,
+                                                    fixed_point=fixed_point)
+    block_matcher = load_block_matcher(bm_settings, use_stereobm, engine)
+    if hasattr(block_matcher, "workers"):
+        # share the cores left over by the process pool
+        block_matcher.workers = threads
+    _worker_state["block_matcher"] = block_matcher
+    _worker_state["render_options"] = render_options
+
+
+def _render_job(job):
+    """Render one pair. Return (job, stage timings, total seconds, error)."""
+    left, right, output = job
+    start = time.time()
+    partial_output = output + ".part"
+    try:
+        image_pair = [read_image(left), read_image(right)]
+        if any(image is None for image in image_pair):
+            raise IOError("Could not read {} or {}".format(left, right))
+        timings = render_pair(image_pair, _worker_state["calibration"],
+                              _worker_state["block_matcher"], partial_output,
+                              **_worker_state["render_options"])
+        os.rename(partial_output, output)
+    except Exception as error:
+        return job, {}, time.time() - start, str(error)
+    return job, timings, time.time() - start, None
+
+
+def main():
+    parser = ArgumentParser(description="Render all stereo pairs in a capture "
+                            "directory to point clouds using a process pool.",
+                            parents=[STEREO_BM_FLAG])
+    parser.add_argument("calibration_folder",
+                        help="Directory where calibration files for the stereo "
+                        "pair are stored.")
+    parser.add_argument("image_folder",
+                        help="Directory where input images are stored.")
+    parser.add_argument("output_folder",
+                        help="Directory to write point clouds to.")
+    parser.add_argument("--bm_settings", default="bm_settings.txt",
+                        help="Block matcher settings file.")
+    parser.add_argument("--processes", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of render processes.")
+    parser.add_argument("--engine", default="sgbm", choices=sorted(ENGINES),
+                        help="Disparity engine. \"pyramid\" narrows the "
+                        "full-resolution search with a low-resolution pass, "
+                        "\"tiled\" matches stripes on several threads.")
+    parser.add_argument("--float_maps", help="Cache the rectification maps as "
+                        "float instead of fixed-point maps.",
+                        action="store_true")
+    parser.add_argument("--ascii", help="Write ASCII instead of binary PLY.",
+                        action="store_true")
+    parser.add_argument("--coordinates", default="float32",
+                        choices=sorted(COORDINATE_TYPES),
+                        help="Coordinate type of binary PLY output.")
+    parser.add_argument("--quantization", type=float,
+                        help="Grid step for int16/int32 coordinates.")
+    parser.add_argument("--point_dtype", default="float32",
+                        choices=["float16", "float32", "float64"],
+                        help="Type points are computed in. float16 halves "
+                        "their memory at reduced precision.")
+    parser.add_argument("--near", type=float,
+                        help="Drop points closer than this depth.")
+    parser.add_argument("--far", type=float,
+                        help="Drop points farther than this depth.")
+    parser.add_argument("--voxel_size", type=float,
+                        help="Merge points per voxel of this size.")
+    parser.add_argument("--outlier_radius", type=float,
+                        help="Distance within which neighbours are searched "
+                        "for outlier removal.")
+    parser.add_argument("--min_neighbors", type=int, default=4,
+                        help="Neighbours within the radius a point needs to "
+                        "be kept, or with --std_ratio, the number of nearest "
+                        "neighbours averaged.")
+    parser.add_argument("--std_ratio", type=float,
+                        help="Use statistical outlier removal, dropping points "
+                        "whose mean distance to their nearest neighbours is "
+                        "this many standard deviations above the mean.")
+    parser.add_argument("--cache", help="Reuse and store disparity maps and "
+                        "point clouds in the render cache.",
+                        action="store_true")
+    parser.add_argument("--cache_size", type=int, default=4096,
+                        help="Render cache size limit in MB.")
+    parser.add_argument("--scan", help="Pair images by file name even if the "
+                        "image folder has a capture catalog.",
+                        action="store_true")
+    parser.add_argument("--start", type=_parse_time,
+                        help="Only render pairs grabbed at or after this "
+                        "time, as YYYY-mm-dd_HH-MM-SS[-ffffff]. Needs a catalog.")
+    parser.add_argument("--end", type=_parse_time,
+                        help="Only render pairs grabbed before this time.")
+    parser.add_argument("--check_catalog", help="Also list the image "
+                        "folder and report pairs that are not in its "
+                        "catalog, e.g. saved before it existed.",
+                        action="store_true")
+    args = parser.parse_args()
+    catalog = None if args.scan else find_catalog(args.image_folder)
+    if (args.start or args.end) and catalog is None:
+        parser.error("--start and --end need a capture catalog.")
+    render_options = {"ply_format": "ascii" if args.ascii else "binary",
+                      "coordinate_type": args.coordinates,
+                      "quantization": args.quantization,
+                      "point_dtype": args.point_dtype,
+                      "filters": {"near": args.near, "far": args.far,
+                                  "voxel_size": args.voxel_size,
+                                  "outlier_radius": args.outlier_radius,
+                                  "min_neighbors": args.min_neighbors,
+                                  "std_ratio": args.std_ratio},
+                      "cache": RenderCache(max_bytes=args.cache_size << 20)
+                               if args.cache else None}
+
+    if not os.path.isdir(args.output_folder):
+        os.makedirs(args.output_folder)
+    jobs = []
+    if catalog is not None:
+        with catalog:
+            pairs = list(catalog_pairs(catalog, args.start, args.end))
+            cataloged = (set(os.path.abspath(left) for left, right, stamp
+                             in catalog_pairs(catalog))
+                         if args.check_catalog else None)
+        if cataloged is not None:
+            # images saved before the folder had a catalog are not listed in it
+            uncataloged = [left for left, right, stamp in
+                           find_pairs(args.image_folder)
+                           if os.path.abspath(left) not in cataloged]
+            print("{} pairs in {} are not in its catalog{}.".format(
+                len(uncataloged), args.image_folder,
+                ", run with --scan to render them" if uncataloged else ""))
+    else:
+        pairs = find_pairs(args.image_folder)
+    for left, right, stamp in pairs:
+        output = os.path.join(args.output_folder, stamp + ".ply")
+        if not os.path.exists(output):
+            jobs.append((left, right, output))
+    print("{} pairs found, {} already rendered, {} to render.".format(
+        len(pairs), len(pairs) - len(jobs), len(jobs)))
+    if not jobs:
+        return
+
+    # build the map cache entry once instead of racing in every worker
+    load_calibration(args.calibration_folder, fixed_point=not args.float_maps)
+    pool = multiprocessing.Pool(args.processes, _init_worker,
+                                (args.calibration_folder, args.bm_settings,
+                                 args.use_stereobm, args.engine,
+                                 not args.float_maps, render_options,
+                                 max(multiprocessing.cpu_count() //
+                                     args.processes, 1)))
+    start = time.time()
+    rendered, failed = 0, 0
+    try:
+        results = pool.imap_unordered(_render_job, jobs)
+        for done in range(1, len(jobs) + 1):
+            # waiting with a timeout keeps Ctrl-C working on Python 2
+            job, timings, seconds, error = results.next(timeout=86400)
+            name = os.path.basename(job[2])
+            if error:
+                failed += 1
+                print("[{}/{}] {} failed: {}".format(done, len(jobs), name,
+                                                    error))
+                continue
+            rendered += 1
+            stages = ", ".join("{} {:.2f}".format(stage, timings[stage])
+                               for stage in sorted(timings))
+            print("[{}/{}] {} {:.2f} s ({})".format(done, len(jobs), name,
+                                                   seconds, stages))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print("Interrupted, run again to resume.")
+    pool.join()
+    elapsed = time.time() - start
+    print("Rendered {} pairs in {:.1f} s, {} failed.".format(rendered, elapsed,
+                                                             failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the workbench's hot paths.
+
+``engines`` compares the disparity engines: every engine computes the
+disparity of the same rectified pair with the same block matcher settings.
+Each one's best time over a few runs is reported, together with how closely
+its result matches the single-call ``sgbm`` engine: the fraction of pixels
+that are identical, and the fraction within one pixel of disparity where both
+results are valid.
+
+``suite`` needs no cameras or image files. It times frame capture, preview,
+chessboard search, calibration and rendering on synthetic scenes from
+``frame_sources`` at several resolutions, and writes the results as JSON
+together with the commit and platform they were measured on. A previous
+result file can be compared against, failing on regressions.
+"""
+
+from argparse import ArgumentParser
+import datetime
+from multiprocessing import cpu_count
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy
+import simplejson
+from stereovision.calibration import StereoCalibrator
+
+from chessboard_detector import find_chessboard
+from clock import monotonic
+from fast_calibration import calibrate_cameras, compute_rectification_maps
+from frame_sources import (SIDES, RandomDotScene, SyntheticSource,
+                           chessboard_views, identity_calibration,
+                           synthetic_pair)
+from rectification_cache import load_calibration
+from rendering import ENGINES, load_block_matcher, render_pair
+from transformed_stereo_cameras import StereoPair, rotate_scaled
+
+#: Suite resolutions as (width, height)
+RESOLUTIONS = {"720p": (1280, 720),
+               "1080p": (1920, 1080),
+               "4k": (3840, 2160)}
+
+#: Chessboard inside corners (rows, columns) used by the suite
+PATTERN_SIZE = (6, 9)
+
+
+def best_time(function, repeat=3):
+    """Call ``function`` ``repeat`` times. Return (best seconds, last result)."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def compare_disparity(reference, disparity, invalid):
+    """
+    Return the fraction of identical pixels and the fraction of pixels valid
+    in both maps that differ by at most one disparity.
+    """
+    identical = numpy.mean(disparity == reference)
+    valid = (reference > invalid) & (disparity > invalid)
+    if not valid.any():
+        return identical, 0.0
+    close = numpy.abs(disparity[valid] - reference[valid]) <= 1
+    return identical, numpy.mean(close)
+
+
+def benchmark_engines(pair, bm_settings, engines, repeat=3, workers=None):
+    """
+    Time ``engines`` on the rectified ``pair``.
+
+    Return a list of dicts with the engine name, seconds, speedup over
+    ``sgbm`` and the ``compare_disparity`` fractions.
+    """
+    gray = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3
+            else image for image in pair]
+    reference_matcher = load_block_matcher(bm_settings, engine="sgbm")
+    invalid = reference_matcher.minDisparity - 1
+    reference_seconds, reference = best_time(
+        lambda: reference_matcher.get_disparity(gray), repeat)
+    results = []
+    for engine in engines:
+        if engine == "sgbm":
+            seconds, disparity = reference_seconds, reference
+        else:
+            block_matcher = load_block_matcher(bm_settings, engine=engine)
+            if workers and hasattr(block_matcher, "workers"):
+                block_matcher.workers = workers
+            try:
+                seconds, disparity = best_time(
+                    lambda: block_matcher.get_disparity(gray), repeat)
+            finally:
+                if hasattr(block_matcher, "close"):
+                    block_matcher.close()
+        identical, close = compare_disparity(reference, disparity, invalid)
+        results.append({"engine": engine, "seconds": seconds,
+                        "speedup": reference_seconds / seconds,
+                        "identical": identical, "within_one": close})
+    return results
+
+
+def bench_get_frames(width, height, repeat=3, frames=60):
+    """
+    Time ``StereoPair.get_frames`` on unpaced synthetic cameras.
+
+    The capture engine's grab threads deliver frames as fast as they can, so
+    this measures the cost of acquiring, matching and rotating a pair.
+    """
+    pair = StereoPair(None, captures=synthetic_pair(width, height, frames=4))
+    with pair:
+        pair.rotation = [90, -90]
+        pair.get_frames()
+
+        def run():
+            for _ in range(frames):
+                pair.get_frames()
+
+        seconds, _ = best_time(run, repeat)
+    return {"seconds": seconds / frames, "fps": frames / seconds}
+
+
+def bench_show_frames(width, height, repeat=3, frames=30, display=False):
+    """
+    Time preparing (and with ``display``, showing) a preview of a pair.
+
+    Without a display only the rotation and resize of ``show_frames`` run.
+    """
+    scene = RandomDotScene(width, height, frames=1)
+    raw = scene.frames[0]
+    pair = StereoPair(None, threaded=False,
+                      captures=[SyntheticSource(scene, side)
+                                for side in SIDES])
+    with pair:
+        pair.rotation = [90, -90]
+        if display:
+            def run():
+                for _ in range(frames):
+                    pair.show_frames(1, frames=raw)
+        else:
+            def run():
+                for _ in range(frames):
+                    for frame, angle in zip(raw, pair.rotation):
+                        rotate_scaled(frame, angle, 0.8)
+        seconds, _ = best_time(run, repeat)
+    return {"seconds": seconds / frames, "fps": frames / seconds}
+
+
+def bench_chessboard(width, height, repeat=3):
+    """Time finding a chessboard in both frames of a pair."""
+    scene = RandomDotScene(width, height, frames=1, chessboard=PATTERN_SIZE)
+    seconds, corners = best_time(
+        lambda: [find_chessboard(frame, PATTERN_SIZE)
+                 for frame in scene.frames[0]], repeat)
+    return {"seconds": seconds,
+            "found": all(item is not None for item in corners)}
+
+
+def bench_calibration(width, height, repeat=3, views=20):
+    """
+    Time calibrating from ``views`` chessboard pairs and computing the
+    rectification maps. The chessboard search is not included.
+    """
+    calibrator = StereoCalibrator(PATTERN_SIZE[0], PATTERN_SIZE[1], 1.0,
+                                  (width, height))
+    for view in chessboard_views(width, height, PATTERN_SIZE, views):
+        corners = [find_chessboard(frame, PATTERN_SIZE) for frame in view]
+        if any(item is None for item in corners):
+            continue
+        calibrator.object_points.append(calibrator.corner_coordinates)
+        for side, item in zip(SIDES, corners):
+            calibrator.image_points[side].append(item.reshape(-1, 2))
+            calibrator.image_count += 1
+    if not calibrator.object_points:
+        return {"seconds": None, "views": 0}
+    seconds, _ = best_time(
+        lambda: compute_rectification_maps(calibrate_cameras(calibrator),
+                                           (width, height)), repeat)
+    return {"seconds": seconds, "views": len(calibrator.object_points)}
+
+
+def bench_render(width, height, repeat=3, bm_settings="bm_settings.txt",
+                 engine="pyramid"):
+    """
+    Time ``render_pair`` of a synthetic pair, without cache or filters.
+
+    Return the best total time and the stage timings of that run.
+    """
+    scene = RandomDotScene(width, height, frames=1)
+    calibration = identity_calibration(width, height)
+    block_matcher = load_block_matcher(bm_settings, engine=engine)
+    output = tempfile.mkdtemp()
+    try:
+        best = None
+        for _ in range(repeat):
+            start = monotonic()
+            timings = render_pair(scene.frames[0], calibration, block_matcher,
+                                  os.path.join(output, "benchmark.ply"))
+            seconds = monotonic() - start
+            if best is None or seconds < best[0]:
+                best = seconds, timings
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+        if hasattr(block_matcher, "close"):
+            block_matcher.close()
+    return {"seconds": best[0], "stages": best[1], "engine": engine}
+
+
+#: Suite benchmarks in the order they run, with the options each one takes
+BENCHMARKS = [("get_frames", bench_get_frames, ()),
+              ("show_frames", bench_show_frames, ("display",)),
+              ("chessboard", bench_chessboard, ()),
+              ("calibration", bench_calibration, ()),
+              ("render", bench_render, ("bm_settings", "engine"))]
+
+
+def _git(*args):
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(("git",) + args, cwd=folder,
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Describe the commit and machine the benchmarks run on."""
+    return {"commit": _git("rev-parse", "HEAD"),
+            "dirty": bool(_git("status", "--porcelain",
+                               "--untracked-files=no")),
+            "date": datetime.datetime.utcnow().isoformat() + "Z",
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": numpy.__version__,
+            "cpus": cpu_count()}
+
+
+def run_suite(resolutions, benchmarks, repeat=3, **options):
+    """
+    Run ``benchmarks`` (names in ``BENCHMARKS``) at each of ``resolutions``
+    (names in ``RESOLUTIONS``). ``options`` are passed to the benchmarks that
+    take them. Return {resolution: {benchmark: result}}; every result holds
+    the best "seconds" per operation.
+    """
+    results = {}
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        results[resolution] = {}
+        for name, function, accepted in BENCHMARKS:
+            if name not in benchmarks:
+                continue
+            kwargs = dict((key, value) for key, value in options.items()
+                          if key in accepted)
+            results[resolution][name] = function(width, height, repeat,
+                                                 **kwargs)
+            print("{:<8}{:<14}{:>10.4f} s".format(
+                resolution, name, results[resolution][name]["seconds"] or 0))
+            sys.stdout.flush()
+    return results
+
+
+def compare_results(baseline, results, tolerance=0.1):
+    """
+    Compare suite ``results`` with ``baseline`` results.
+
+    Return a list of (resolution, benchmark, old seconds, new seconds,
+    regressed) for the benchmarks in both. A benchmark regressed if it got
+    slower by more than ``tolerance``, a fraction of the old time.
+    """
+    rows = []
+    for resolution in sorted(results):
+        for name, result in sorted(results[resolution].items()):
+            old = baseline.get(resolution, {}).get(name, {}).get("seconds")
+            new = result["seconds"]
+            if not old or not new:
+                continue
+            rows.append((resolution, name, old, new,
+                         new > old * (1 + tolerance)))
+    return rows
+
+
+def engines_command(parser, args):
+    pair = [cv2.imread(args.left), cv2.imread(args.right)]
+    if any(image is None for image in pair):
+        parser.error("Could not read {} or {}".format(args.left, args.right))
+    if args.calibration_folder:
+        pair = load_calibration(args.calibration_folder).rectify(pair)
+    results = benchmark_engines(pair, args.bm_settings, args.engines,
+                                args.repeat, args.workers)
+    print("{:<10}{:>10}{:>10}{:>12}{:>12}".format("engine", "seconds",
+                                                "speedup", "identical",
+                                                "within 1"))
+    for result in results:
+        print("{engine:<10}{seconds:>10.3f}{speedup:>9.2f}x"
+              "{identical:>12.2%}{within_one:>12.2%}".format(**result))
+
+
+def suite_command(parser, args):
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = simplejson.load(baseline_file)
+    report = environment()
+    report["repeat"] = args.repeat
+    report["results"] = run_suite(args.resolutions, args.benchmarks,
+                                  args.repeat, display=args.display,
+                                  bm_settings=args.bm_settings,
+                                  engine=args.engine)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            simplejson.dump(report, output_file, indent=2, sort_keys=True)
+    if not args.compare:
+        return 0
+    print("\nCompared with {} ({})".format(args.compare,
+                                          baseline.get("commit")))
+    rows = compare_results(baseline["results"], report["results"],
+                           args.tolerance)
+    print("{:<8}{:<14}{:>10}{:>10}{:>10}".format("", "", "before", "after",
+                                                 "speedup"))
+    for resolution, name, old, new, regressed in rows:
+        print("{:<8}{:<14}{:>10.4f}{:>10.4f}{:>9.2f}x{}".format(
+            resolution, name, old, new, old / new,
+            "  REGRESSION" if regressed else ""))
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the disparity engines or "
+                            "run the camera-free benchmark suite.")
+    commands = parser.add_subparsers(dest="command")
+
+    engines = commands.add_parser("engines", help="Time the disparity "
+                                  "engines on an image pair and compare "
+                                  "their results with the single-call SGBM "
+                                  "disparity.")
+    engines.add_argument("left", help="Left image.")
+    engines.add_argument("right", help="Right image.")
+    engines.add_argument("--calibration_folder",
+                         help="Rectify the images with this calibration "
+                         "first. Without it the images must already be "
+                         "rectified.")
+    engines.add_argument("--bm_settings", default="bm_settings.txt",
+                         help="Block matcher settings file.")
+    engines.add_argument("--engines", nargs="+", default=sorted(ENGINES),
+                         choices=sorted(ENGINES), help="Engines to compare.")
+    engines.add_argument("--workers", type=int,
+                         help="Threads for the tiled engine. Defaults to the "
+                         "number of cores.")
+    engines.add_argument("--repeat", type=int, default=3,
+                         help="Runs per engine; the best time is reported.")
+    engines.set_defaults(function=engines_command)
+
+    suite = commands.add_parser("suite", help="Time capture, preview, "
+                                "chessboard search, calibration and "
+                                "rendering on synthetic scenes.")
+    suite.add_argument("--resolutions", nargs="+",
+                       default=["720p", "1080p", "4k"],
+                       choices=sorted(RESOLUTIONS),
+                       help="Resolutions to run at.")
+    suite.add_argument("--benchmarks", nargs="+",
+                       default=[entry[0] for entry in BENCHMARKS],
+                       choices=[entry[0] for entry in BENCHMARKS],
+                       help="Benchmarks to run.")
+    suite.add_argument("--repeat", type=int, default=3,
+                       help="Runs per benchmark; the best time is reported.")
+    suite.add_argument("--bm_settings", default="bm_settings.txt",
+                       help="Block matcher settings file for rendering.")
+    suite.add_argument("--engine", default="pyramid",
+                       choices=sorted(ENGINES),
+                       help="Disparity engine for rendering.")
+    suite.add_argument("--display", action="store_true",
+                       help="Show the preview windows in show_frames.")
+    suite.add_argument("--output", help="Write the results to this JSON "
+                       "file.")
+    suite.add_argument("--compare", help="Results JSON of an earlier run to "
+                       "compare with. Exits with status 1 on regressions.")
+    suite.add_argument("--tolerance", type=float, default=0.1,
+                       help="Slowdown, as a fraction, tolerated before a "
+                       "benchmark counts as regressed.")
+    suite.set_defaults(function=suite_command)
+
+    args = parser.parse_args()
+    sys.exit(args.function(parser, args))
+
+
+if __name__ == "__main__":
+    main()
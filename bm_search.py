@@ -0,0 +1,227 @@
+"""
+Headless block matcher parameter search.
+
+Candidate settings are scored on rectified image pairs without ground truth,
+using two objective measures of a disparity map: the fraction of pixels with a
+valid disparity, and the fraction of those that are left-right consistent,
+i.e. matching right-to-left (on the mirrored pair) finds the same disparity
+again. A candidate's score is the fraction of pixels that are both valid and
+consistent, averaged over the pairs. The pairs are rectified, converted to
+gray and kept in memory once, and candidates are evaluated on a thread pool,
+as OpenCV releases the GIL while matching.
+
+Functions:
+
+    * ``search_space`` - Candidate values for each tunable parameter
+    * ``load_pairs`` - Read and rectify image pairs into memory
+    * ``apply_settings`` - Set parameters on a ``BlockMatcher``
+    * ``score_pair`` - Valid ratio and left-right consistency of one pair
+    * ``evaluate`` - Score candidates on a set of pairs in parallel
+    * ``random_search`` - Score randomly drawn candidates
+    * ``grid_search`` - Score every combination of candidate values
+    * ``successive_halving`` - Keep the best half of the candidates on ever
+      more pairs
+"""
+
+import itertools
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import random
+
+import cv2
+import numpy
+from stereovision.blockmatchers import StereoBM, StereoSGBM
+
+#: Candidate values per parameter. P1 and P2 are given per pixel of the
+#: matching window and scaled by ``SADWindowSize`` squared.
+SEARCH_SPACES = {
+    StereoSGBM: {"minDisparity": [0, 8, 16, 32],
+                 "numDisparities": [64, 96, 128, 160, 176, 192, 256],
+                 "SADWindowSize": [1, 3, 5, 7, 9, 11],
+                 "P1": [4, 8, 16, 24, 32],
+                 "P2": [32, 64, 96, 120, 160],
+                 "disp12MaxDiff": [1, 2, 5, 10, 50],
+                 "uniquenessRatio": range(5, 16),
+                 "speckleWindowSize": range(0, 201, 25),
+                 "speckleRange": [1, 2, 4, 8, 16, 32],
+                 "fullDP": [0, 1]},
+    StereoBM: {"search_range": [64, 96, 128, 160, 192, 256],
+               "window_size": range(5, 42, 4)}}
+
+#: Parameters whose search values are scaled by the window area
+WINDOW_PENALTIES = ("P1", "P2")
+
+
+def search_space(block_matcher, parameters=None):
+    """
+    Return {parameter: candidate values} for ``block_matcher``.
+
+    Only parameters listed in its ``parameter_maxima`` are searched, and
+    values above their maxima are dropped. ``parameters`` restricts the search
+    to those names.
+    """
+    space = {}
+    for kind, values in SEARCH_SPACES.items():
+        if isinstance(block_matcher, kind):
+            space = values
+    maxima = block_matcher.parameter_maxima
+    space = dict((name, [value for value in values
+                         if maxima[name] is None or value <= maxima[name]])
+                 for name, values in space.items() if name in maxima)
+    if parameters:
+        space = dict((name, values) for name, values in space.items()
+                     if name in parameters)
+    return space
+
+
+def load_pairs(calibration, files):
+    """Rectify consecutive (left, right) ``files`` to gray image pairs."""
+    pairs = []
+    for left, right in zip(files[::2], files[1::2]):
+        images = [cv2.imread(left), cv2.imread(right)]
+        if any(image is None for image in images):
+            raise IOError("Could not read {} or {}".format(left, right))
+        rectified = calibration.rectify(images)
+        pairs.append([cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                      for image in rectified])
+    return pairs
+
+
+def apply_settings(block_matcher, settings):
+    """
+    Set ``settings`` on ``block_matcher``.
+
+    Penalties are set in the order their mutual check (P1 < P2) accepts.
+    """
+    settings = dict(settings)
+    penalties = [(name, settings.pop(name)) for name in ("P1", "P2")
+                 if name in settings]
+    if penalties and penalties[0][1] >= block_matcher.P2:
+        penalties.reverse()
+    for name, value in settings.items() + penalties:
+        setattr(block_matcher, name, value)
+    return block_matcher
+
+
+def _candidate_settings(block_matcher, values):
+    """Turn searched values into settings, scaling penalties by window area."""
+    settings = dict(values)
+    window = settings.get("SADWindowSize",
+                          getattr(block_matcher, "SADWindowSize", None))
+    for name in WINDOW_PENALTIES:
+        if name in settings and window:
+            settings[name] *= window * window
+    if settings.get("P1", 0) >= settings.get("P2", numpy.inf):
+        settings["P2"] = settings["P1"] + 1
+    return settings
+
+
+def _random_candidates(block_matcher, count, parameters, seed):
+    space = search_space(block_matcher, parameters)
+    generator = random.Random(seed)
+    return [_candidate_settings(block_matcher,
+                                [(name, generator.choice(values))
+                                 for name, values in sorted(space.items())])
+            for _ in range(count)]
+
+
+def score_pair(block_matcher, pair):
+    """
+    Return (valid ratio, consistency) of ``block_matcher`` on a gray pair.
+
+    Consistency is the fraction of valid pixels whose disparity the mirrored
+    right-to-left match confirms within one pixel.
+    """
+    invalid = getattr(block_matcher, "minDisparity", 0) - 1
+    left = block_matcher.get_disparity(pair)
+    right = block_matcher.get_disparity([cv2.flip(pair[1], 1),
+                                         cv2.flip(pair[0], 1)])
+    right = cv2.flip(right, 1)
+    valid = left > invalid
+    if not valid.any():
+        return 0.0, 0.0
+    rows, columns = numpy.nonzero(valid)
+    matched = columns - numpy.rint(left[valid]).astype(int)
+    inside = matched >= 0
+    confirmed = numpy.zeros(len(rows), bool)
+    confirmed[inside] = numpy.abs(right[rows[inside], matched[inside]] -
+                                  left[valid][inside]) <= 1
+    return valid.mean(), confirmed.mean()
+
+
+def evaluate(block_matcher, candidates, pairs, workers=None):
+    """
+    Score ``candidates`` (settings dicts) on ``pairs``.
+
+    Each candidate is applied to a fresh instance of ``block_matcher``'s
+    class, starting from its current settings. Return a list of
+    (score, settings, metrics) sorted best first. Invalid combinations score
+    None and sort last. Raise ValueError without ``pairs``.
+    """
+    if not pairs:
+        raise ValueError("No image pairs to score candidates on.")
+    base = dict((name, getattr(block_matcher, name))
+                for name in block_matcher.parameter_maxima)
+
+    def run(settings):
+        matcher = type(block_matcher)()
+        try:
+            apply_settings(matcher, base)
+            apply_settings(matcher, settings)
+        except Exception as error:
+            return None, settings, {"error": str(error)}
+        scores = [score_pair(matcher, pair) for pair in pairs]
+        valid = numpy.mean([score[0] for score in scores])
+        consistency = numpy.mean([score[1] for score in scores])
+        return (valid * consistency, settings,
+                {"valid": valid, "consistency": consistency})
+
+    pool = ThreadPool(workers or cpu_count())
+    try:
+        results = pool.map(run, candidates)
+    finally:
+        pool.close()
+    return sorted(results, key=lambda result: (result[0] is not None,
+                                                result[0]), reverse=True)
+
+
+def random_search(block_matcher, pairs, candidates=50, parameters=None,
+                  workers=None, seed=None):
+    """Score ``candidates`` random draws from the search space."""
+    drawn = _random_candidates(block_matcher, candidates, parameters, seed)
+    return evaluate(block_matcher, drawn, pairs, workers)
+
+
+def grid_search(block_matcher, pairs, parameters=None, workers=None):
+    """
+    Score every combination of the search space's values.
+
+    The grid grows quickly; restrict it with ``parameters``.
+    """
+    space = search_space(block_matcher, parameters)
+    names = sorted(space)
+    grid = [_candidate_settings(block_matcher, zip(names, values))
+            for values in itertools.product(*[space[name] for name in names])]
+    return evaluate(block_matcher, grid, pairs, workers)
+
+
+def successive_halving(block_matcher, pairs, candidates=64, parameters=None,
+                       workers=None, seed=None):
+    """
+    Score random candidates on one pair, keep the better half, and repeat on
+    twice as many pairs until one candidate is left or all pairs are used.
+
+    Most of the time goes to promising candidates, so many more can be tried
+    than with ``random_search`` on all pairs.
+    """
+    alive = _random_candidates(block_matcher, candidates, parameters, seed)
+    budget = 1
+    while True:
+        results = evaluate(block_matcher, alive, pairs[:budget], workers)
+        if len(alive) == 1 or budget >= len(pairs):
+            return results
+        alive = [settings for score, settings, _ in results
+                 if score is not None][:max(len(alive) // 2, 1)]
+        if not alive:
+            return results
+        budget = min(budget * 2, len(pairs))
@@ -0,0 +1,248 @@
+"""
+Per-folder catalog of captured stereo pairs.
+
+Captures used to be identified only by their file names, so every later step
+had to list and sort the whole capture folder to pair left and right images
+again, which takes minutes with hundreds of thousands of files. The workbench
+instead records every pair it saves in a SQLite database next to the images:
+its grab time (wall clock, sub-second), the left and right file paths, the
+camera rotations and the camera properties in effect. Each run of the
+workbench that writes to a folder is a session of the catalog. Pairs are
+indexed by time, so tools stream the pairs of a time range without touching
+the directory.
+
+Paths are stored relative to the catalog's folder, so the folder can be moved
+as a whole. Catalog entries are written once the images were queued for
+writing; an image that failed to write is still listed.
+
+Classes:
+
+    * ``CatalogEntry`` - One cataloged pair
+    * ``CaptureCatalog`` - Record and query the pairs of a capture folder
+
+Functions:
+
+    * ``find_catalog`` - Open the catalog of a folder, if it has one
+    * ``wall_clock`` - Wall clock time of a monotonic timestamp
+"""
+
+from collections import namedtuple
+import os
+import sqlite3
+import threading
+import time
+
+import cv2
+import simplejson
+
+from clock import monotonic
+
+#: File name of the catalog in a capture folder
+CATALOG_NAME = "catalog.sqlite"
+
+#: Names the camera properties are stored under
+PROPERTY_NAMES = {cv2.CAP_PROP_FRAME_WIDTH: "width",
+                  cv2.CAP_PROP_FRAME_HEIGHT: "height",
+                  cv2.CAP_PROP_BRIGHTNESS: "brightness",
+                  cv2.CAP_PROP_CONTRAST: "contrast",
+                  cv2.CAP_PROP_GAIN: "gain",
+                  cv2.CAP_PROP_EXPOSURE: "exposure"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pairs (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions (id),
+    timestamp REAL NOT NULL,
+    kind TEXT NOT NULL,
+    left TEXT,
+    right TEXT,
+    rotation_left INTEGER NOT NULL,
+    rotation_right INTEGER NOT NULL,
+    properties TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pairs_timestamp ON pairs (timestamp);
+CREATE INDEX IF NOT EXISTS pairs_session ON pairs (session, kind);
+"""
+
+_COLUMNS = ("id, session, timestamp, kind, left, right, rotation_left, "
+            "rotation_right, properties")
+
+#: Rows fetched from the database at a time while streaming entries
+_FETCH_SIZE = 1024
+
+
+class CatalogEntry(namedtuple("CatalogEntry", "id session timestamp kind left "
+                              "right rotation properties")):
+
+    """
+    A cataloged pair.
+
+    ``timestamp`` is the wall clock grab time in seconds since the epoch.
+    ``left`` and ``right`` are absolute paths, None for a side that was not
+    captured. ``properties`` holds a {name: value} dict per camera.
+    """
+
+    __slots__ = ()
+
+    @property
+    def paths(self):
+        """Return the (left, right) paths."""
+        return self.left, self.right
+
+
+def wall_clock(timestamp):
+    """Return the wall clock time of the ``clock.monotonic`` ``timestamp``."""
+    return time.time() - (monotonic() - timestamp)
+
+
+def _property_names(properties):
+    """Return {property: value} ``properties`` keyed by readable names."""
+    return dict((PROPERTY_NAMES.get(prop, str(prop)), value)
+                for prop, value in properties.items())
+
+
+class CaptureCatalog(object):
+
+    """
+    The catalog of the capture folder ``folder``.
+
+    The first ``add`` starts a new session, as does the first ``add`` after
+    ``new_session``. A catalog may be shared by several threads; entries are
+    committed as they are added.
+    """
+
+    def __init__(self, folder):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        #: Folder the cataloged paths are relative to
+        self.folder = os.path.abspath(folder)
+        #: Path of the database
+        self.path = os.path.join(self.folder, CATALOG_NAME)
+        #: Session of this catalog's ``add`` calls, None until the first
+        self.session = None
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        # the capture thread must not wait for the disk on every pair
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    def new_session(self):
+        """Record the following pairs in a session of their own."""
+        with self._lock:
+            self.session = None
+
+    def add(self, timestamp, paths, rotation=(0, 0), properties=None,
+            kind="capture"):
+        """
+        Record a pair grabbed at the wall clock ``timestamp`` and saved to
+        (left, right) ``paths``, either of which may be None. ``properties``
+        holds a {property: value} dict per camera. ``kind`` tells captures
+        apart from e.g. chessboard views. Return the id of the pair.
+        """
+        properties = [_property_names(camera)
+                      for camera in properties or ({}, {})]
+        row = [timestamp, kind] + [self._relative(path) for path in paths]
+        row += [int(angle) for angle in rotation]
+        row.append(simplejson.dumps(properties))
+        with self._lock, self._connection:
+            if self.session is None:
+                self.session = self._connection.execute(
+                    "INSERT INTO sessions (started) VALUES (?)",
+                    (time.time(),)).lastrowid
+            return self._connection.execute(
+                "INSERT INTO pairs (session, timestamp, kind, left, right, "
+                "rotation_left, rotation_right, properties) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [self.session] + row).lastrowid
+
+    def pairs(self, start=None, end=None, kind=None, session=None,
+              complete=True):
+        """
+        Yield the ``CatalogEntry`` of every pair grabbed from wall clock
+        ``start`` up to, but not including, ``end``, in grab order. Only
+        pairs of ``kind`` and ``session`` are listed if given, and only pairs
+        with both sides if ``complete`` is set.
+        """
+        conditions, values = [], []
+        for condition, value in (("timestamp >= ?", start),
+                                 ("timestamp < ?", end),
+                                 ("kind = ?", kind),
+                                 ("session = ?", session)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        if complete:
+            conditions.append("left IS NOT NULL AND right IS NOT NULL")
+        query = "SELECT {} FROM pairs".format(_COLUMNS)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp, id"
+        # a connection of its own: commits of pairs added meanwhile would
+        # reset a cursor of the shared one
+        connection = sqlite3.connect(self.path)
+        try:
+            cursor = connection.execute(query, values)
+            while True:
+                rows = cursor.fetchmany(_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self._entry(row)
+        finally:
+            connection.close()
+
+    def sessions(self, kind=None):
+        """
+        Return (session, started) for every session, oldest first, only those
+        with pairs of ``kind`` if given.
+        """
+        query = "SELECT id, started FROM sessions"
+        values = []
+        if kind is not None:
+            query += (" WHERE id IN (SELECT DISTINCT session FROM pairs "
+                      "WHERE kind = ?)")
+            values.append(kind)
+        with self._lock:
+            return self._connection.execute(query + " ORDER BY id",
+                                            values).fetchall()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM pairs").fetchone()[0]
+
+    def _relative(self, path):
+        if path is None:
+            return None
+        return os.path.relpath(os.path.abspath(path), self.folder)
+
+    def _entry(self, row):
+        (pair_id, session, timestamp, kind, left, right, rotation_left,
+         rotation_right, properties) = row
+        paths = [None if path is None else os.path.join(self.folder, path)
+                 for path in (left, right)]
+        return CatalogEntry(pair_id, session, timestamp, kind, paths[0],
+                            paths[1], (rotation_left, rotation_right),
+                            simplejson.loads(properties))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def find_catalog(folder):
+    """Return the ``CaptureCatalog`` of ``folder``, or None if it has none."""
+    if not os.path.exists(os.path.join(folder, CATALOG_NAME)):
+        return None
+    return CaptureCatalog(folder)
@@ -0,0 +1,278 @@
+"""
+Threaded, timestamp-synchronized frame acquisition for stereo cameras.
+
+Every camera gets its own grab thread, so both sensors are triggered as close
+together as the devices allow instead of one after the other. Frames are
+retrieved into a small ring of preallocated buffers, stamped with the
+monotonic time at which ``grab()`` returned, and paired by nearest timestamp
+when a consumer asks for frames. Consumers never wait on device I/O, only on
+the arrival of a newer frame.
+
+Camera properties are set on the grab threads as well: ``set_property`` only
+records the requested value and returns, and the grab thread applies it before
+its next grab. Requests arriving faster than that, such as slider drags, are
+coalesced to the latest value per property, and the value the camera reports
+afterwards is passed to the property callbacks.
+
+Classes:
+
+    * ``BufferPool`` - Recycles frame buffers once no consumer references them
+    * ``CameraGrabber`` - Grabs frames from a single capture on its own thread
+    * ``SynchronizedCapture`` - Pairs frames from several grabbers by timestamp
+"""
+
+from functools import partial
+import sys
+import threading
+import time
+
+import numpy
+
+from clock import monotonic
+import instrumentation
+
+
+class BufferPool(object):
+
+    """
+    A pool of reusable numpy buffers.
+
+    A buffer is handed out again only when nothing but the pool refers to it
+    anymore, so consumers may keep frames (or views into them) for as long as
+    they like without the pool overwriting them.
+    """
+
+    #: References held on a pooled buffer while it is being checked: the pool's
+    #: list, the loop variable and the argument to ``sys.getrefcount``
+    _idle_refcount = 3
+
+    def __init__(self, max_buffers=8):
+        """``max_buffers`` limits how many buffers are kept for reuse."""
+        self.max_buffers = max_buffers
+        self._buffers = []
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        """Return an unused buffer of ``shape`` and ``dtype``."""
+        dtype = numpy.dtype(dtype)
+        with self._lock:
+            for buf in self._buffers:
+                if (buf.shape == shape and buf.dtype == dtype and
+                        sys.getrefcount(buf) <= self._idle_refcount):
+                    return buf
+            # Buffers of a stale size are useless after a resolution change
+            self._buffers = [buf for buf in self._buffers
+                             if buf.shape == shape and buf.dtype == dtype]
+            buf = numpy.empty(shape, dtype)
+            if len(self._buffers) < self.max_buffers:
+                self._buffers.append(buf)
+            return buf
+
+
+class CameraGrabber(threading.Thread):
+
+    """
+    Continuously grab frames from one ``cv2.VideoCapture``.
+
+    Frames are retrieved into a ring of ``ring_size`` buffers that are
+    allocated once and then reused. A slot is invalidated while it is being
+    written to, so readers holding ``condition`` only ever see complete frames.
+    """
+
+    def __init__(self, capture, condition, ring_size=4, on_property=None):
+        """
+        ``capture`` is the video capture to read from. ``condition`` is
+        notified whenever a new frame is available. ``on_property`` is called
+        with (property, requested value, applied value) on the grab thread
+        after a property was set.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        #: Video capture frames are grabbed from
+        self.capture = capture
+        #: Condition shared with the consumer, guards the ring
+        self.condition = condition
+        #: Frame buffers, reused round-robin
+        self.buffers = [None] * ring_size
+        #: Grab timestamp for each buffer, None if the slot holds no frame
+        self.timestamps = [None] * ring_size
+        #: Index of the most recently completed slot
+        self.head = -1
+        #: Number of frames grabbed so far
+        self.frame_count = 0
+        #: Number of failed grabs or retrieves
+        self.failures = 0
+        self.on_property = on_property
+        self.running = True
+        self._properties = {}
+        self._properties_lock = threading.Lock()
+
+    def set_properties(self, properties):
+        """
+        Request the {property: value} ``properties`` to be set before the next
+        grab. They replace any not yet applied requests for the same
+        properties and are applied together, e.g. a frame width and height.
+        """
+        with self._properties_lock:
+            self._properties.update(properties)
+
+    def _apply_properties(self):
+        with self._properties_lock:
+            pending, self._properties = self._properties, {}
+        for prop, value in sorted(pending.items()):
+            with instrumentation.stage("capture.set"):
+                self.capture.set(prop, value)
+                applied = self.capture.get(prop)
+            if self.on_property:
+                self.on_property(prop, value, applied)
+
+    def run(self):
+        ring_size = len(self.buffers)
+        while self.running:
+            if self._properties:
+                self._apply_properties()
+            start = monotonic()
+            if not self.capture.grab():
+                self.failures += 1
+                time.sleep(0.01)
+                continue
+            timestamp = monotonic()
+            instrumentation.record("capture.grab", start, timestamp)
+            slot = (self.head + 1) % ring_size
+            with self.condition:
+                self.timestamps[slot] = None
+            with instrumentation.stage("capture.retrieve"):
+                retrieved, frame = self.capture.retrieve(self.buffers[slot])
+            if not retrieved or frame is None:
+                self.failures += 1
+                continue
+            with self.condition:
+                self.buffers[slot] = frame
+                self.timestamps[slot] = timestamp
+                self.head = slot
+                self.frame_count += 1
+                self.condition.notify_all()
+
+    def latest(self):
+        """Return the newest slot index, or None. Hold ``condition``."""
+        if self.head < 0 or self.timestamps[self.head] is None:
+            return None
+        return self.head
+
+    def nearest(self, timestamp):
+        """Return the slot whose frame is closest in time. Hold ``condition``."""
+        best, best_delta = None, None
+        for slot, stamp in enumerate(self.timestamps):
+            if stamp is None:
+                continue
+            delta = abs(stamp - timestamp)
+            if best is None or delta < best_delta:
+                best, best_delta = slot, delta
+        return best
+
+    def stop(self):
+        """Stop grabbing and wait for the thread to finish."""
+        self.running = False
+        if self.is_alive():
+            self.join(1.0)
+
+
+class SynchronizedCapture(object):
+
+    """
+    Acquire frames from several captures at once and match them in time.
+
+    ``get_frames`` returns one frame per capture. The camera whose newest frame
+    is the oldest serves as the reference; the other cameras contribute the
+    buffered frame closest to it in time. Matched frames are copied out of the
+    ring into pooled buffers, so they stay valid for as long as the caller
+    keeps them.
+    """
+
+    def __init__(self, captures, ring_size=4, timeout=1.0):
+        """
+        Start one ``CameraGrabber`` per capture.
+
+        ``timeout`` is the longest ``get_frames`` waits for a newer frame
+        before returning the most recent one again.
+        """
+        self.condition = threading.Condition()
+        #: Callables called with (capture index, property, requested value,
+        #: applied value) on the grab thread once a property was set
+        self.property_callbacks = []
+        #: One grab thread per capture
+        self.grabbers = [CameraGrabber(capture, self.condition, ring_size,
+                                       partial(self._property_applied, i))
+                         for i, capture in enumerate(captures)]
+        self.timeout = timeout
+        #: Grab timestamps of the most recently returned frames
+        self.timestamps = [None] * len(captures)
+        #: Largest time difference between the most recently returned frames
+        self.skew = 0.0
+        self._pool = BufferPool(max_buffers=4 * len(captures))
+        self._returned = [0] * len(captures)
+        for grabber in self.grabbers:
+            grabber.start()
+
+    def _has_new_frames(self):
+        return all(grabber.frame_count > returned for grabber, returned in
+                   zip(self.grabbers, self._returned))
+
+    def get_frames(self):
+        """
+        Return the next matched set of frames.
+
+        Waits until every camera has delivered a frame newer than the ones last
+        returned, or until ``timeout`` expires. Cameras that have not delivered
+        any frame yet are reported as None.
+        """
+        start = monotonic()
+        deadline = start + self.timeout
+        with self.condition:
+            while not self._has_new_frames():
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            latest = [grabber.latest() for grabber in self.grabbers]
+            available = [(grabber.timestamps[slot], grabber) for grabber, slot
+                         in zip(self.grabbers, latest) if slot is not None]
+            if not available:
+                return [None] * len(self.grabbers)
+            reference = min(available)[0]
+            frames = []
+            for i, grabber in enumerate(self.grabbers):
+                slot = grabber.nearest(reference)
+                if slot is None:
+                    frames.append(None)
+                    self.timestamps[i] = None
+                    continue
+                source = grabber.buffers[slot]
+                frame = self._pool.acquire(source.shape, source.dtype)
+                numpy.copyto(frame, source)
+                frames.append(frame)
+                self.timestamps[i] = grabber.timestamps[slot]
+                self._returned[i] = grabber.frame_count
+        stamps = [stamp for stamp in self.timestamps if stamp is not None]
+        self.skew = max(stamps) - min(stamps)
+        instrumentation.record("capture.sync", start)
+        return frames
+
+    def set_property(self, index, prop, value):
+        """Request property ``prop`` of capture ``index`` to be set."""
+        self.grabbers[index].set_properties({prop: value})
+
+    def set_properties(self, index, properties):
+        """Request several {property: value} to be set at once."""
+        self.grabbers[index].set_properties(properties)
+
+    def _property_applied(self, index, prop, value, applied):
+        for callback in list(self.property_callbacks):
+            callback(index, prop, value, applied)
+
+    def stop(self):
+        """Stop all grab threads."""
+        for grabber in self.grabbers:
+            grabber.running = False
+        for grabber in self.grabbers:
+            grabber.stop()
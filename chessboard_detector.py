@@ -0,0 +1,140 @@
+"""
+Coarse-to-fine chessboard detection for both cameras at once.
+
+``cv2.findChessboardCorners`` on a full 1080p frame is slow, and the capture
+loop used to run it on both cameras in turn, every frame. Here the board is
+searched for in a downscaled grayscale frame, and the corners found are refined
+with ``cv2.cornerSubPix`` in a full-resolution crop around the board only. The
+left and right searches run concurrently on a thread pool; OpenCV releases the
+GIL while it works. While a search is running, newer frames are skipped rather
+than queued, so detection never lags behind the preview.
+
+Functions:
+
+    * ``find_chessboard`` - Find chessboard corners in a single image
+
+Classes:
+
+    * ``ChessboardDetector`` - Find chessboards in stereo pairs in the background
+"""
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy
+
+import instrumentation
+
+#: Termination criteria for sub-pixel corner refinement
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 30, 0.01)
+
+#: Flags for the search in the downscaled image
+SEARCH_FLAGS = (cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE +
+                cv2.CALIB_CB_FAST_CHECK)
+
+
+def _to_gray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def find_chessboard(image, pattern_size, scale=0.5, window=11):
+    """
+    Find chessboard corners in ``image`` and return them at full resolution.
+
+    ``pattern_size`` is the number of inside corners as (rows, columns). The
+    board is searched for in the image shrunk by ``scale``; its corners are
+    then refined with a ``window`` x ``window`` sub-pixel search in a
+    full-resolution crop around the board. Return None if no board was found.
+    """
+    if scale < 1:
+        small = cv2.resize(image, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = image
+    with instrumentation.stage("chessboard.find"):
+        found, corners = cv2.findChessboardCorners(_to_gray(small),
+                                                   pattern_size,
+                                                   flags=SEARCH_FLAGS)
+    if not found:
+        return None
+    corners = numpy.ascontiguousarray(corners / scale, numpy.float32)
+
+    # the coarse corners are off by up to 1 / scale pixels, the refinement
+    # window has to reach past that
+    x, y, width, height = cv2.boundingRect(corners)
+    margin = window + int(numpy.ceil(1.0 / scale))
+    x0, y0 = max(x - margin, 0), max(y - margin, 0)
+    x1 = min(x + width + margin, image.shape[1])
+    y1 = min(y + height + margin, image.shape[0])
+    region = _to_gray(image[y0:y1, x0:x1])
+    corners -= (x0, y0)
+    cv2.cornerSubPix(region, corners, (window, window), (-1, -1),
+                     SUBPIX_CRITERIA)
+    corners += (x0, y0)
+    return corners
+
+
+class ChessboardDetector(object):
+
+    """
+    Search stereo pairs for chessboards without blocking the caller.
+
+    ``submit`` starts a search on a ``FramePair`` if the previous one has
+    finished, otherwise the pair is skipped. ``poll`` returns the pair and its
+    corners once a search has found the board in every frame.
+    """
+
+    def __init__(self, pattern_size, scale=0.5, workers=2):
+        """
+        ``pattern_size`` is the number of inside corners as (rows, columns),
+        ``scale`` the factor frames are shrunk by for the coarse search.
+        """
+        self._find = partial(find_chessboard, pattern_size=pattern_size,
+                             scale=scale)
+        self._pool = ThreadPool(workers)
+        self._pending = None
+        #: Number of pairs skipped because a search was still running
+        self.skipped = 0
+        #: Number of searches started
+        self.searched = 0
+
+    def submit(self, frame_pair):
+        """Search ``frame_pair`` unless a search is running. Return whether."""
+        if self._pending is not None:
+            self.skipped += 1
+            return False
+        result = self._pool.map_async(self._find, frame_pair.frames)
+        self._pending = (frame_pair, result)
+        self.searched += 1
+        return True
+
+    def poll(self):
+        """
+        Collect a finished search.
+
+        Return (frame pair, corners) if the board was found in every frame,
+        otherwise None. The detector accepts new pairs once a finished search
+        has been collected.
+        """
+        if self._pending is None or not self._pending[1].ready():
+            return None
+        frame_pair, result = self._pending
+        self._pending = None
+        corners = result.get()
+        if any(side is None for side in corners):
+            return None
+        return frame_pair, corners
+
+    def discard(self):
+        """Forget the running search, e.g. after the board was moved."""
+        if self._pending is not None:
+            self._pending[1].wait()
+            self._pending = None
+
+    def close(self):
+        """Shut down the worker threads."""
+        self._pool.close()
+        self._pool.join()
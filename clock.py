@@ -0,0 +1,47 @@
+"""
+Monotonic clock shared by the capture, scheduling and timing code.
+
+Functions:
+
+    * ``monotonic`` - Seconds from an arbitrary origin that never jump back
+
+Python 2.7 has no ``time.monotonic``. On Windows ``time.clock`` is backed by
+the performance counter and is monotonic; on POSIX systems ``clock_gettime``
+is called through ``ctypes``. ``time.time`` is only used as a last resort.
+"""
+
+import ctypes
+import ctypes.util
+import sys
+import time
+
+
+def _posix_monotonic():
+    """Return a ``clock_gettime(CLOCK_MONOTONIC)`` wrapper or None."""
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    library = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+    try:
+        clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    # CLOCK_MONOTONIC is 1 on Linux, 6 on macOS
+    clock_id = 6 if sys.platform == "darwin" else 1
+
+    def clock():
+        value = timespec()
+        if clock_gettime(clock_id, ctypes.pointer(value)):
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return value.tv_sec + value.tv_nsec * 1e-9
+    return clock
+
+
+if hasattr(time, "monotonic"):
+    monotonic = time.monotonic
+elif sys.platform == "win32":
+    monotonic = time.clock
+else:
+    monotonic = _posix_monotonic() or time.time
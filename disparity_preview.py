@@ -0,0 +1,130 @@
+"""
+Live, low-latency disparity preview.
+
+Frames are rectified and matched at a reduced resolution on a background
+thread. Rectification remaps straight from the full-resolution frames into the
+small image using downscaled maps, so no full-size intermediate image is made,
+and the block matcher's disparity range is scaled to match. Only the newest
+submitted pair is kept: if matching is slower than the cameras, older pairs are
+dropped instead of queued, so the preview never lags by more than one
+computation.
+
+Classes:
+
+    * ``DisparityPreview`` - Compute disparity of the latest frames in the
+      background
+"""
+
+import threading
+
+import cv2
+import numpy
+
+from clock import monotonic
+from fast_blockmatchers import scaled_matcher
+import instrumentation
+
+
+def _scaled_maps(calibration, side, scale):
+    """Return float maps producing a rectified image shrunk by ``scale``."""
+    map_x = calibration.undistortion_map[side]
+    map_y = calibration.rectification_map[side]
+    if map_y is None:
+        # fixed-point maps from the rectification cache hold whole-pixel (x, y)
+        # pairs; resizing interpolates between them again
+        map_x, map_y = map_x[..., 0], map_x[..., 1]
+    map_x = numpy.asarray(map_x, numpy.float32)
+    map_y = numpy.asarray(map_y, numpy.float32)
+    height, width = map_x.shape[:2]
+    size = (int(width * scale), int(height * scale))
+    # sample the maps at the small image's pixels; values still address the
+    # full-resolution frame
+    return (cv2.resize(map_x, size, interpolation=cv2.INTER_LINEAR),
+            cv2.resize(map_y, size, interpolation=cv2.INTER_LINEAR))
+
+
+class DisparityPreview(object):
+
+    """
+    Compute disparity maps of the newest frames on a background thread.
+
+    ``submit`` hands over a rectifiable (left, right) pair. ``image`` holds the
+    latest colorized disparity map with the preview rate drawn on it.
+    """
+
+    #: Window the preview is shown in
+    window = "Disparity"
+
+    def __init__(self, calibration, block_matcher, scale=0.5):
+        """
+        ``calibration`` is a ``StereoCalibration`` and ``block_matcher`` a
+        ``BlockMatcher`` whose settings are scaled down by ``scale``.
+        """
+        self.scale = scale
+        self._maps = [_scaled_maps(calibration, side, scale)
+                      for side in ("left", "right")]
+        self._matcher = scaled_matcher(block_matcher, scale)
+        #: Latest colorized disparity map, or None
+        self.image = None
+        #: Rate of completed disparity maps per second
+        self.fps = 0.0
+        #: Number of pairs replaced by a newer one before being processed
+        self.dropped = 0
+        self._pending = None
+        self._condition = threading.Condition()
+        self.running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, frames):
+        """Queue ``frames`` for processing, replacing any unprocessed pair."""
+        with self._condition:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = frames
+            self._condition.notify()
+
+    def compute(self, frames):
+        """Return the disparity of ``frames`` at the preview's resolution."""
+        gray = []
+        for frame, (map_x, map_y) in zip(frames, self._maps):
+            small = cv2.remap(frame, map_x, map_y, cv2.INTER_LINEAR)
+            if small.ndim == 3:
+                small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            gray.append(small)
+        return self._matcher.compute(gray[0], gray[1])
+
+    def _colorize(self, disparity):
+        image = cv2.normalize(disparity, None, 0, 255, cv2.NORM_MINMAX,
+                              cv2.CV_8U)
+        image = cv2.applyColorMap(image, cv2.COLORMAP_JET)
+        cv2.putText(image, "{:.1f} fps".format(self.fps), (10, 25),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        return image
+
+    def _run(self):
+        last = None
+        while self.running:
+            with self._condition:
+                while self._pending is None and self.running:
+                    self._condition.wait(0.5)
+                frames, self._pending = self._pending, None
+            if frames is None:
+                continue
+            with instrumentation.stage("disparity_preview"):
+                disparity = self.compute(frames)
+            now = monotonic()
+            if last is not None:
+                rate = 1.0 / max(now - last, 1e-6)
+                # smoothed so the number stays readable
+                self.fps = rate if not self.fps else 0.9 * self.fps + 0.1 * rate
+            last = now
+            self.image = self._colorize(disparity)
+
+    def stop(self):
+        """Stop the background thread."""
+        self.running = False
+        with self._condition:
+            self._condition.notify()
+        self._thread.join(1.0)
@@ -0,0 +1,239 @@
+"""
+Faster block matchers for high-resolution image pairs.
+
+The matchers here are drop-in replacements for ``stereovision``'s
+``StereoSGBM``: they load the same settings files and return disparity maps in
+the same units.
+
+Classes:
+
+    * ``PyramidSGBM`` - Coarse-to-fine SGBM with per-band disparity ranges
+    * ``TiledSGBM`` - SGBM computed in overlapping stripes on a thread pool
+
+Functions:
+
+    * ``scaled_matcher`` - Create an OpenCV matcher for downscaled images
+"""
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy
+from stereovision.blockmatchers import StereoSGBM
+
+
+def _round_up(value, multiple):
+    return int(numpy.ceil(float(value) / multiple)) * multiple
+
+
+def scaled_matcher(block_matcher, scale):
+    """
+    Build an OpenCV matcher like ``block_matcher``, for images shrunk by
+    ``scale``.
+
+    ``block_matcher`` is a ``StereoSGBM`` or ``StereoBM``. Its disparity range
+    is scaled and rounded up to what OpenCV accepts.
+    """
+    if hasattr(block_matcher, "numDisparities"):
+        return cv2.StereoSGBM_create(
+            minDisparity=int(block_matcher.minDisparity * scale),
+            numDisparities=_round_up(block_matcher.numDisparities * scale, 16),
+            blockSize=block_matcher.SADWindowSize,
+            P1=block_matcher.P1,
+            P2=block_matcher.P2,
+            disp12MaxDiff=block_matcher.disp12MaxDiff,
+            uniquenessRatio=block_matcher.uniquenessRatio,
+            speckleWindowSize=int(block_matcher.speckleWindowSize * scale ** 2),
+            speckleRange=block_matcher.speckleRange,
+            mode=int(block_matcher.fullDP))
+    return cv2.StereoBM_create(
+        numDisparities=_round_up(block_matcher.search_range * scale, 16),
+        blockSize=block_matcher.window_size)
+
+
+def _match_rows(matcher, pair, top, bottom, margin):
+    """
+    Return ``matcher``'s raw disparity for rows ``top`` to ``bottom``,
+    matching ``margin`` extra rows above and below for context.
+    """
+    height = pair[0].shape[0]
+    start, stop = max(top - margin, 0), min(bottom + margin, height)
+    raw = matcher.compute(pair[0][start:stop], pair[1][start:stop])
+    return raw[top - start:bottom - start]
+
+
+class PyramidSGBM(StereoSGBM):
+
+    """
+    ``StereoSGBM`` that narrows its disparity search with a coarse pass.
+
+    Disparity is first computed on the pair shrunk by ``pyramid_scale``. The
+    full-resolution image is then matched in horizontal bands of
+    ``band_height`` rows, each searching only the disparities the coarse pass
+    found in that band, widened by ``search_margin`` pixels. SGBM's time and,
+    in full-DP mode, memory grow with the number of disparities searched, so a
+    band covering a narrow depth range costs a fraction of the full search.
+    Bands without coarse matches fall back to the full range. Settings are the
+    ``StereoSGBM`` ones and describe the full-resolution search.
+    """
+
+    def __init__(self, pyramid_scale=0.25, band_height=64, search_margin=8,
+                 **kwargs):
+        """
+        ``pyramid_scale`` is the coarse pass's image scale; other keyword
+        arguments are passed to ``StereoSGBM``.
+        """
+        #: Scale of the coarse pass
+        self.pyramid_scale = pyramid_scale
+        #: Rows matched per band at full resolution
+        self.band_height = band_height
+        #: Disparities searched beyond the coarse estimate, in pixels
+        self.search_margin = search_margin
+        #: Matcher for the full-resolution bands, re-ranged per band
+        self._band_matcher = None
+        super(PyramidSGBM, self).__init__(**kwargs)
+
+    def _replace_bm(self):
+        """Replace the full-resolution and band matchers with current values."""
+        super(PyramidSGBM, self)._replace_bm()
+        self._band_matcher = cv2.StereoSGBM_create(
+            minDisparity=self._min_disparity,
+            numDisparities=self._num_disp,
+            blockSize=self._sad_window_size,
+            uniquenessRatio=self._uniqueness,
+            speckleWindowSize=self._speckle_window_size,
+            speckleRange=self._speckle_range,
+            disp12MaxDiff=self._max_disparity,
+            P1=self._P1,
+            P2=self._P2,
+            mode=int(self._full_dp))
+
+    def _coarse_disparity(self, pair):
+        """Return coarse disparity in full-resolution pixels, NaN if invalid."""
+        small = [cv2.resize(image, None, fx=self.pyramid_scale,
+                            fy=self.pyramid_scale, interpolation=cv2.INTER_AREA)
+                 for image in pair]
+        matcher = scaled_matcher(self, self.pyramid_scale)
+        raw = matcher.compute(small[0], small[1])
+        disparity = raw.astype(numpy.float32) / (16 * self.pyramid_scale)
+        disparity[raw < matcher.getMinDisparity() * 16] = numpy.nan
+        return disparity
+
+    def _band_range(self, coarse, top, bottom):
+        """Return (minimum, number) of disparities to search in a band."""
+        full_min = self._min_disparity
+        full_max = full_min + self._num_disp
+        # one coarse row of padding on each side
+        rows = coarse[max(int(top * self.pyramid_scale) - 1, 0):
+                      int(numpy.ceil(bottom * self.pyramid_scale)) + 1]
+        found = rows[~numpy.isnan(rows)]
+        if found.size < 0.01 * rows.size or not found.size:
+            return full_min, self._num_disp
+        # percentiles keep a few mismatches from widening the search
+        low, high = numpy.percentile(found, [0.5, 99.5])
+        low = max(int(low) - self.search_margin, full_min)
+        high = min(int(numpy.ceil(high)) + self.search_margin, full_max)
+        count = min(_round_up(max(high - low, 1), 16), self._num_disp)
+        return min(low, full_max - count), count
+
+    def get_disparity(self, pair):
+        """Compute disparity from image pair (left, right)."""
+        coarse = self._coarse_disparity(pair)
+        height = pair[0].shape[0]
+        invalid = self._min_disparity - 1
+        disparity = numpy.empty(pair[0].shape[:2], numpy.float32)
+        # context rows so aggregation at band edges sees neighbouring rows
+        margin = max(self._sad_window_size, 16)
+        for top in range(0, height, self.band_height):
+            bottom = min(top + self.band_height, height)
+            low, count = self._band_range(coarse, top, bottom)
+            self._band_matcher.setMinDisparity(low)
+            self._band_matcher.setNumDisparities(count)
+            raw = _match_rows(self._band_matcher, pair, top, bottom, margin)
+            band = disparity[top:bottom]
+            band[:] = raw / 16.0
+            band[raw < low * 16] = invalid
+        return disparity
+
+
+class TiledSGBM(StereoSGBM):
+
+    """
+    ``StereoSGBM`` that matches horizontal stripes of the pair in parallel.
+
+    This matcher splits the rectified pair into one stripe per worker thread,
+    matches each stripe with ``overlap`` extra rows above and below so its
+    aggregation paths see the neighbouring image, and keeps only the stripe's
+    own rows. OpenCV releases the GIL while matching, so the stripes may run
+    on several cores; whether that is faster than a single ``StereoSGBM``
+    call depends on the OpenCV build, so time it with ``benchmarks.py
+    engines`` first. ``close`` stops the worker threads.
+    """
+
+    def __init__(self, workers=None, overlap=None, **kwargs):
+        """
+        ``workers`` defaults to the number of cores. ``overlap`` defaults to a
+        margin derived from the window size and the disparity range.
+        """
+        #: Number of stripes matched in parallel
+        self.workers = workers or cpu_count()
+        #: Extra rows matched above and below each stripe, or None for auto
+        self.overlap = overlap
+        #: Thread pool, created on first use
+        self._pool = None
+        self._pool_size = 0
+        super(TiledSGBM, self).__init__(**kwargs)
+
+    @property
+    def stripe_margin(self):
+        """Rows of context matched above and below each stripe."""
+        if self.overlap is not None:
+            return self.overlap
+        # smoothness paths carry information further the wider the search;
+        # at the production settings this leaves stripes identical to a
+        # single pass on all but a few pixels, and within a pixel on nearly all
+        return self._sad_window_size // 2 + self._num_disp // 4
+
+    def _create_matcher(self):
+        """Return an OpenCV matcher with current values. One per thread."""
+        return cv2.StereoSGBM_create(minDisparity=self._min_disparity,
+                                     numDisparities=self._num_disp,
+                                     blockSize=self._sad_window_size,
+                                     uniquenessRatio=self._uniqueness,
+                                     speckleWindowSize=self._speckle_window_size,
+                                     speckleRange=self._speckle_range,
+                                     disp12MaxDiff=self._max_disparity,
+                                     P1=self._P1,
+                                     P2=self._P2,
+                                     mode=int(self._full_dp))
+
+    def get_disparity(self, pair):
+        """Compute disparity from image pair (left, right)."""
+        height = pair[0].shape[0]
+        stripes = max(min(self.workers, height // (2 * self.stripe_margin + 1)),
+                      1)
+        if stripes == 1:
+            return super(TiledSGBM, self).get_disparity(pair)
+        if self._pool is None or self._pool_size != self.workers:
+            self.close()
+            self._pool = ThreadPool(self.workers)
+            self._pool_size = self.workers
+        margin = self.stripe_margin
+
+        def match_stripe(index):
+            top = height * index // stripes
+            bottom = height * (index + 1) // stripes
+            return _match_rows(self._create_matcher(), pair, top, bottom,
+                               margin)
+
+        raw = numpy.vstack(self._pool.map(match_stripe, range(stripes)))
+        return raw.astype(numpy.float32) / 16.0
+
+    def close(self):
+        """Stop the worker threads. They are started again when needed."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_size = 0
@@ -0,0 +1,138 @@
+"""
+Fast outlier rejection for stereo calibration.
+
+Removing one badly detected image pair at a time means one complete stereo
+calibration, rectification and export per removed pair. Here every round drops
+all pairs whose error exceeds a threshold (up to a fraction of the remaining
+pairs), each round starts from the previous round's intrinsics, the expensive
+rectification maps are only computed for the final solution, and nothing is
+written to disk until the end.
+
+Functions:
+
+    * ``calibrate_cameras`` - Stereo calibration, optionally warm-started
+    * ``compute_rectification_maps`` - Add undistortion/rectification maps
+    * ``reject_outliers`` - Calibrate while dropping outliers in batches
+"""
+
+import operator
+import time
+
+import cv2
+import numpy
+from stereovision.calibration import StereoCalibration
+
+#: Termination criteria used by ``StereoCalibrator.calibrate_cameras``
+CRITERIA = (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 100, 1e-5)
+
+#: Flags used by ``StereoCalibrator.calibrate_cameras``
+FLAGS = (cv2.CALIB_FIX_ASPECT_RATIO + cv2.CALIB_ZERO_TANGENT_DIST +
+         cv2.CALIB_SAME_FOCAL_LENGTH)
+
+
+def calibrate_cameras(calibrator, initial=None):
+    """
+    Calibrate cameras from the corners collected by ``calibrator``.
+
+    This mirrors ``StereoCalibrator.calibrate_cameras`` but leaves out the
+    rectification maps. If ``initial`` is a ``StereoCalibration``, its camera
+    matrices and distortion coefficients are used as the starting point.
+    """
+    calib = StereoCalibration()
+    flags = FLAGS
+    if initial is not None:
+        flags += cv2.CALIB_USE_INTRINSIC_GUESS
+        for side in ("left", "right"):
+            calib.cam_mats[side] = initial.cam_mats[side].copy()
+            calib.dist_coefs[side] = initial.dist_coefs[side].copy()
+    (calib.cam_mats["left"], calib.dist_coefs["left"],
+     calib.cam_mats["right"], calib.dist_coefs["right"],
+     calib.rot_mat, calib.trans_vec, calib.e_mat,
+     calib.f_mat) = cv2.stereoCalibrate(calibrator.object_points,
+                                        calibrator.image_points["left"],
+                                        calibrator.image_points["right"],
+                                        calib.cam_mats["left"],
+                                        calib.dist_coefs["left"],
+                                        calib.cam_mats["right"],
+                                        calib.dist_coefs["right"],
+                                        calibrator.image_size,
+                                        criteria=CRITERIA,
+                                        flags=flags)[1:]
+    (calib.rect_trans["left"], calib.rect_trans["right"],
+     calib.proj_mats["left"], calib.proj_mats["right"],
+     calib.disp_to_depth_mat, calib.valid_boxes["left"],
+     calib.valid_boxes["right"]) = cv2.stereoRectify(calib.cam_mats["left"],
+                                                   calib.dist_coefs["left"],
+                                                   calib.cam_mats["right"],
+                                                   calib.dist_coefs["right"],
+                                                   calibrator.image_size,
+                                                   calib.rot_mat,
+                                                   calib.trans_vec,
+                                                   flags=0)
+    # Same replacement of Q as in StereoCalibrator.calibrate_cameras
+    width, height = calibrator.image_size
+    focal_length = 0.8 * width
+    calib.disp_to_depth_mat = numpy.float32([[1, 0, 0, -0.5 * width],
+                                             [0, -1, 0, 0.5 * height],
+                                             [0, 0, 0, -focal_length],
+                                             [0, 0, 1, 0]])
+    return calib
+
+
+def compute_rectification_maps(calibration, image_size):
+    """Compute the undistortion and rectification maps of ``calibration``."""
+    for side in ("left", "right"):
+        (calibration.undistortion_map[side],
+         calibration.rectification_map[side]) = cv2.initUndistortRectifyMap(
+                                                calibration.cam_mats[side],
+                                                calibration.dist_coefs[side],
+                                                calibration.rect_trans[side],
+                                                calibration.proj_mats[side],
+                                                image_size,
+                                                cv2.CV_32FC1)
+    return calibration
+
+
+def reject_outliers(calibrator, threshold=1.0, max_fraction=0.2,
+                    min_images=10):
+    """
+    Calibrate, dropping image pairs whose error is above ``threshold``.
+
+    Each round removes every pair with an error above ``threshold``, but no
+    more than ``max_fraction`` of the pairs (at least one), worst first, and
+    never so many that fewer than ``min_images`` images (as counted by the
+    calibrator's ``image_count``) would be left. It stops when no pair
+    exceeds the threshold or no more pairs may be removed. Return the final
+    calibration, including its rectification maps, and a list with one dict
+    per round holding the number of images, average and highest error,
+    removed pairs and duration.
+    """
+    calibration = None
+    rounds = []
+    while True:
+        start = time.time()
+        images = calibrator.image_count
+        calibration = calibrate_cameras(calibrator, calibration)
+        avg_error = calibrator.check_calibration(calibration)
+        sorted_errors = sorted(calibrator.error_data.items(),
+                               reverse=True, key=operator.itemgetter(1))
+        outliers = [index for index, error in sorted_errors
+                    if error > threshold]
+        # error_data has an entry per pair, image_count counts each side;
+        # the final round must still have min_images images
+        images_per_pair = max(calibrator.image_count // len(sorted_errors), 1)
+        removable = max(calibrator.image_count - min_images, 0) // images_per_pair
+        outliers = outliers[:min(max(1, int(len(sorted_errors) * max_fraction)),
+                                 removable)]
+        done = not outliers
+        if not done:
+            calibrator.remove_images(outliers)
+        rounds.append({"images": images,
+                       "avg_error": avg_error,
+                       "max_error": sorted_errors[0][1],
+                       "removed": [] if done else outliers,
+                       "errors": sorted_errors,
+                       "seconds": time.time() - start})
+        if done:
+            break
+    return compute_rectification_maps(calibration, calibrator.image_size), rounds
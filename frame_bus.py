@@ -0,0 +1,117 @@
+"""
+Single-acquisition frame distribution for the workbench.
+
+Each tick acquires one pair of frames from the ``StereoPair`` and hands the
+very same arrays to every consumer: the preview, still captures, chessboard
+detection and interval recording. Consumers therefore never trigger device
+reads of their own, and everything saved from one tick shows the same moment.
+
+Classes:
+
+    * ``FramePair`` - One acquired stereo pair, shared by reference
+    * ``FrameBus`` - Acquires a pair once per tick and publishes it
+"""
+
+import threading
+
+from clock import monotonic
+import instrumentation
+from transformed_stereo_cameras import rotate_bound
+
+
+class FramePair(object):
+
+    """
+    A stereo pair acquired in a single tick.
+
+    ``raw`` holds the frames as delivered by the cameras. ``frames`` holds the
+    rotated frames; they are computed on first access and then shared by all
+    consumers. Consumers must not modify either.
+    """
+
+    def __init__(self, raw, rotation, timestamp, index, timestamps=None):
+        #: Unrotated (left, right) frames
+        self.raw = raw
+        #: Rotation of each camera at acquisition time, in degrees
+        self.rotation = list(rotation)
+        #: Monotonic acquisition time in seconds
+        self.timestamp = timestamp
+        #: Monotonic grab time of each frame, if known, else ``timestamp``
+        self.timestamps = list(timestamps or [timestamp] * len(raw))
+        #: Sequence number of the pair on its bus
+        self.index = index
+        self._frames = None
+
+    @property
+    def frames(self):
+        """Return the rotated (left, right) frames."""
+        if self._frames is None:
+            with instrumentation.stage("rotate"):
+                self._frames = [rotate_bound(frame, angle) for frame, angle
+                                in zip(self.raw, self.rotation)]
+        return self._frames
+
+
+class FrameBus(object):
+
+    """
+    Publish every acquired ``FramePair`` to its subscribers.
+
+    Subscribers are callables taking a ``FramePair``. They are called on the
+    thread that calls ``publish``, in subscription order. ``request`` registers
+    a callable for the next published pair only and may be called from any
+    thread.
+    """
+
+    def __init__(self, pair):
+        """``pair`` is the ``StereoPair`` frames are acquired from."""
+        self.pair = pair
+        #: Most recently published ``FramePair``
+        self.latest = None
+        #: Number of pairs published so far
+        self.count = 0
+        self._subscribers = []
+        self._requests = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """Call ``callback`` with every published pair."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling ``callback``."""
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def request(self, callback):
+        """Call ``callback`` once, with the next published pair."""
+        with self._lock:
+            self._requests.append(callback)
+
+    def publish(self):
+        """Acquire one pair from the cameras, publish and return it."""
+        start = monotonic()
+        raw = self.pair.get_raw_frames()
+        timestamp = monotonic()
+        timestamps = None
+        engine = getattr(self.pair, "engine", None)
+        if engine:
+            stamps = [stamp for stamp in engine.timestamps if stamp is not None]
+            if stamps:
+                timestamp = min(stamps)
+                timestamps = [timestamp if stamp is None else stamp
+                              for stamp in engine.timestamps]
+        frame_pair = FramePair(raw, self.pair.rotation, timestamp, self.count,
+                               timestamps)
+        with self._lock:
+            callbacks = self._subscribers + self._requests
+            self._requests = []
+        self.latest = frame_pair
+        self.count += 1
+        for callback in callbacks:
+            callback(frame_pair)
+        # one sample per published pair, so its rate is the frame rate
+        instrumentation.record("frame", start)
+        return frame_pair
@@ -0,0 +1,376 @@
+"""
+Camera-free frame sources for ``StereoPair``.
+
+The sources here behave like ``cv2.VideoCapture`` as far as ``StereoPair``
+and the capture engine use it (``grab``, ``retrieve``, ``read``, ``get``,
+``set``, ``release``), so they can be passed as ``StereoPair(captures=...)``
+to run the workbench, the benchmarks or tests without cameras.
+
+Classes:
+
+    * ``RandomDotScene`` - Random-dot stereogram with a known disparity map
+    * ``SyntheticSource`` - One camera's view of a ``RandomDotScene``
+    * ``ReplaySource`` - Frames replayed from image files or a video
+
+Functions:
+
+    * ``synthetic_pair`` - Left and right sources of a new scene
+    * ``replay_pair`` - Left and right sources replaying a capture
+    * ``chessboard_views`` - Generate stereo views of a chessboard in random
+      poses
+    * ``identity_calibration`` - Calibration of already rectified cameras
+"""
+
+import time
+
+import cv2
+import numpy
+
+from clock import monotonic
+from image_writer import read_image
+
+SIDES = ("left", "right")
+
+
+class RandomDotScene(object):
+
+    """
+    A random-dot stereo scene with ground-truth disparity.
+
+    The scene is a tilted plane with a box in front of it, covered in random
+    dots. ``disparity`` holds the exact disparity of every left image pixel:
+    ``left[y, x]`` shows what ``right[y, x - disparity[y, x]]`` does.
+    ``frames`` different dot patterns are rendered up front and cycled, so
+    consecutive frames differ without per-frame rendering cost. With
+    ``chessboard`` set to (rows, columns) of inside corners, a flat chessboard
+    at constant disparity is drawn over the scene.
+    """
+
+    def __init__(self, width, height, min_disparity=16, max_disparity=128,
+                 frames=2, chessboard=None, seed=0):
+        generator = numpy.random.RandomState(seed)
+        rows, columns = numpy.mgrid[0:height, 0:width].astype(numpy.float32)
+        disparity = (min_disparity + (max_disparity - min_disparity) * 0.6 *
+                     rows / height)
+        box = ((numpy.abs(columns - 0.6 * width) < 0.12 * width) &
+               (numpy.abs(rows - 0.45 * height) < 0.15 * height))
+        disparity[box] = max_disparity
+        #: Disparity of each left image pixel
+        self.disparity = disparity
+        #: (left, right) images of each frame
+        self.frames = []
+        margin = int(numpy.ceil(max_disparity)) + 1
+        # dots a few pixels across survive the downscaling in previews and
+        # coarse matching
+        dot = max(width // 640, 1)
+        for _ in range(frames):
+            texture = generator.randint(0, 256, (height // dot + 1,
+                                                 (width + margin) // dot + 1))
+            texture = cv2.resize(texture.astype(numpy.uint8), None, fx=dot,
+                                 fy=dot, interpolation=cv2.INTER_NEAREST)
+            texture = texture[:height, :width + margin]
+            left = cv2.remap(texture, columns - disparity + margin, rows,
+                             cv2.INTER_LINEAR)
+            right = texture[:, margin:margin + width]
+            pair = [cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+                    for image in (left, right)]
+            if chessboard:
+                self._draw_chessboard(pair, chessboard, min_disparity)
+            self.frames.append(pair)
+
+    def _draw_chessboard(self, pair, pattern_size, disparity):
+        """Draw a chessboard at constant ``disparity`` on both images."""
+        height, width = pair[0].shape[:2]
+        rows, columns = pattern_size
+        square = min(width // (2 * (columns + 3)), height // (2 * (rows + 3)))
+        board = numpy.full(((rows + 3) * square, (columns + 3) * square), 255,
+                           numpy.uint8)
+        for row in range(rows + 1):
+            for column in range(columns + 1):
+                if (row + column) % 2:
+                    continue
+                board[(row + 1) * square:(row + 2) * square,
+                      (column + 1) * square:(column + 2) * square] = 0
+        board = cv2.cvtColor(board, cv2.COLOR_GRAY2BGR)
+        top = (height - board.shape[0]) // 2
+        left = (width - board.shape[1]) // 2
+        shifts = (disparity // 2, disparity // 2 - disparity)
+        for image, shift in zip(pair, shifts):
+            x = left + int(shift)
+            image[top:top + board.shape[0], x:x + board.shape[1]] = board
+        x = left + int(shifts[0])
+        self.disparity[top:top + board.shape[0],
+                       x:x + board.shape[1]] = disparity
+
+
+class _PacedSource(object):
+
+    """Base for sources that can deliver frames at a fixed rate."""
+
+    fps = None
+    _next = None
+
+    def _pace(self):
+        """With ``fps`` set, sleep until the next frame is due."""
+        if not self.fps:
+            return
+        now = monotonic()
+        if self._next is None or self._next < now:
+            # late, or first frame: restart the schedule from now
+            self._next = now
+        time.sleep(self._next - now)
+        self._next += 1.0 / self.fps
+
+
+class SyntheticSource(_PacedSource):
+
+    """
+    One camera's view of a ``RandomDotScene``, usable as a ``VideoCapture``.
+
+    With ``fps`` set, ``grab`` waits for the next frame time like a camera;
+    otherwise frames are delivered as fast as they are requested.
+    """
+
+    def __init__(self, scene, side, fps=None):
+        #: Scene being viewed
+        self.scene = scene
+        self.index = SIDES.index(side)
+        self.fps = fps
+        self.properties = {}
+        self._frame = -1
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        self._pace()
+        self._frame += 1
+        return True
+
+    def retrieve(self, image=None):
+        frames = self.scene.frames
+        frame = frames[self._frame % len(frames)][self.index]
+        if (image is not None and image.shape == frame.shape and
+                image.dtype == frame.dtype and image.flags.writeable):
+            numpy.copyto(image, frame)
+            return True, image
+        return True, frame.copy()
+
+    def read(self, image=None):
+        self.grab()
+        return self.retrieve(image)
+
+    def get(self, prop):
+        height, width = self.scene.frames[0][0].shape[:2]
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(height)
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps or 0)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self._frame + 1)
+        return self.properties.get(prop, 0.0)
+
+    def set(self, prop, value):
+        if prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT):
+            # the scene's size is fixed
+            return False
+        self.properties[prop] = value
+        return True
+
+    def release(self):
+        pass
+
+
+class ReplaySource(_PacedSource):
+
+    """
+    Frames replayed from a list of image files or from a video file.
+
+    ``source`` is a list of image paths, in any encoding ``image_writer``
+    writes, or the path of a video. With
+    ``loop``, replay starts over at the end; otherwise ``grab`` then fails.
+    ``preload`` decodes all images up front so replay speed does not depend
+    on image decoding. ``fps`` paces ``grab`` like ``SyntheticSource``.
+    """
+
+    def __init__(self, source, loop=True, fps=None, preload=False):
+        self.loop = loop
+        self.fps = fps
+        self.properties = {}
+        self._video = None
+        self._files = None
+        self._images = None
+        if isinstance(source, basestring):
+            self._video = cv2.VideoCapture(source)
+            if not self._video.isOpened():
+                raise IOError("Could not open {}".format(source))
+        else:
+            self._files = list(source)
+            if not self._files:
+                raise ValueError("No images to replay.")
+            if preload:
+                self._images = [read_image(path) for path in self._files]
+        self._frame = -1
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        self._pace()
+        if self._video is not None:
+            if self._video.grab():
+                return True
+            if not self.loop:
+                return False
+            self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            return self._video.grab()
+        if self._frame + 1 >= len(self._files) and not self.loop:
+            return False
+        self._frame += 1
+        return True
+
+    def retrieve(self, image=None):
+        if self._video is not None:
+            return self._video.retrieve(image)
+        index = self._frame % len(self._files)
+        if self._images is not None:
+            return True, self._images[index].copy()
+        frame = read_image(self._files[index])
+        return frame is not None, frame
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, prop):
+        if self._video is not None:
+            return self._video.get(prop)
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self._files))
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self._frame + 1)
+        return self.properties.get(prop, 0.0)
+
+    def set(self, prop, value):
+        if self._video is not None:
+            return self._video.set(prop, value)
+        self.properties[prop] = value
+        return True
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+
+
+def synthetic_pair(width, height, fps=None, **kwargs):
+    """
+    Return (left, right) ``SyntheticSource`` views of a new ``RandomDotScene``.
+
+    Keyword arguments are passed to ``RandomDotScene``.
+    """
+    scene = RandomDotScene(width, height, **kwargs)
+    return [SyntheticSource(scene, side, fps) for side in SIDES]
+
+
+def replay_pair(left, right=None, **kwargs):
+    """
+    Return (left, right) ``ReplaySource`` sources.
+
+    ``left`` is either a capture directory, whose ``Left_*``/``Right_*`` image
+    pairs are replayed in name order, or together with ``right`` the two
+    video files or image lists to replay. Keyword arguments are passed to
+    ``ReplaySource``.
+    """
+    if right is None:
+        from batch_render import find_pairs
+        pairs = find_pairs(left)
+        if not pairs:
+            raise ValueError("No image pairs found in {}".format(left))
+        left, right = [[pair[i] for pair in pairs] for i in (0, 1)]
+    return [ReplaySource(source, **kwargs) for source in (left, right)]
+
+
+def _board_texture(pattern_size, pixels):
+    """Chessboard with a one-square white border, ``pixels`` per square."""
+    rows, columns = pattern_size
+    squares = numpy.indices((rows + 1, columns + 1)).sum(axis=0) % 2
+    board = numpy.where(squares, 255, 0).astype(numpy.uint8)
+    board = numpy.pad(board, 1, "constant", constant_values=255)
+    return cv2.resize(board, None, fx=pixels, fy=pixels,
+                      interpolation=cv2.INTER_NEAREST)
+
+
+def chessboard_views(width, height, pattern_size, count=20, baseline=0.1,
+                     seed=0):
+    """
+    Yield ``count`` stereo image pairs of a chessboard in random poses.
+
+    The cameras are identical pinhole cameras ``baseline`` apart, with a focal
+    length of 0.8 * ``width``. ``pattern_size`` is (rows, columns) of inside
+    corners. Pairs are (left, right) BGR images, rendered as they are
+    requested.
+    """
+    generator = numpy.random.RandomState(seed)
+    focal = 0.8 * width
+    camera = numpy.array([[focal, 0, width / 2.0], [0, focal, height / 2.0],
+                          [0, 0, 1]])
+    rows, columns = pattern_size
+    pixels = 32
+    texture = _board_texture(pattern_size, pixels)
+    # a board spanning about 40% of the image width at distance 1
+    square = 0.4 * width / focal / (columns + 3)
+    # texture pixels to board plane coordinates, centred on the board
+    to_board = numpy.array([[square / pixels, 0,
+                             -square * (columns + 3) / 2.0],
+                            [0, square / pixels, -square * (rows + 3) / 2.0],
+                            [0, 0, 1]])
+    for _ in range(count):
+        angles = generator.uniform(-0.4, 0.4, 3) * (1, 1, 0.3)
+        rotation = cv2.Rodrigues(angles)[0]
+        translation = numpy.array([generator.uniform(-0.15, 0.15),
+                                   generator.uniform(-0.1, 0.1),
+                                   generator.uniform(0.9, 1.3)])
+        pair = []
+        for offset in (0, -baseline):
+            shifted = translation + (offset, 0, 0)
+            homography = camera.dot(numpy.column_stack(
+                (rotation[:, 0], rotation[:, 1], shifted))).dot(to_board)
+            image = cv2.warpPerspective(texture, homography, (width, height),
+                                        flags=cv2.INTER_LINEAR,
+                                        borderValue=128)
+            pair.append(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+        yield pair
+
+
+def identity_calibration(width, height):
+    """
+    Return a ``StereoCalibration`` of ideal, already rectified cameras.
+
+    Rectification leaves images unchanged, and the reprojection matrix uses
+    the focal length of 0.8 * ``width`` also assumed by ``chessboard_views``.
+    """
+    from stereovision.calibration import StereoCalibration
+    calibration = StereoCalibration()
+    for side in SIDES:
+        calibration.cam_mats[side] = numpy.eye(3)
+        calibration.dist_coefs[side] = numpy.zeros((1, 5))
+        calibration.rect_trans[side] = numpy.eye(3)
+        calibration.proj_mats[side] = numpy.eye(3, 4)
+        calibration.valid_boxes[side] = numpy.array([0, 0, width, height])
+        calibration.undistortion_map[side] = numpy.tile(
+            numpy.arange(width, dtype=numpy.float32), (height, 1))
+        calibration.rectification_map[side] = numpy.tile(
+            numpy.arange(height, dtype=numpy.float32)[:, None], (1, width))
+    calibration.rot_mat = numpy.eye(3)
+    calibration.trans_vec = numpy.zeros((3, 1))
+    calibration.e_mat = numpy.zeros((3, 3))
+    calibration.f_mat = numpy.zeros((3, 3))
+    focal = 0.8 * width
+    calibration.disp_to_depth_mat = numpy.float32([[1, 0, 0, -0.5 * width],
+                                                   [0, -1, 0, 0.5 * height],
+                                                   [0, 0, 0, -focal],
+                                                   [0, 0, 1, 0]])
+    return calibration
@@ -0,0 +1,148 @@
+"""
+Background image writing with a bounded queue.
+
+Encoding a 1080p PNG takes long enough to stall the capture loop, so frames
+are handed to a pool of writer threads instead. OpenCV releases the GIL while
+encoding, so the threads really do run in parallel. The queue is bounded: when
+the storage cannot keep up, ``submit`` either blocks or drops the image,
+depending on the pool's policy, and counts what it dropped.
+
+Classes:
+
+    * ``ImageWriterPool`` - Encode and write images on worker threads
+
+Functions:
+
+    * ``read_image`` - Read an image in any of the written encodings
+"""
+
+import os
+import Queue
+import threading
+
+import cv2
+import numpy
+
+import instrumentation
+
+#: File extension written for each supported encoding
+EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "npy": ".npy"}
+
+
+def read_image(path):
+    """
+    Return the image at ``path``, or None if OpenCV cannot read it. ``.npy``
+    files are loaded with ``numpy.load``.
+    """
+    if path.lower().endswith(EXTENSIONS["npy"]):
+        return numpy.load(path)
+    return cv2.imread(path)
+
+
+class ImageWriterPool(object):
+
+    """
+    Write images to disk on background threads.
+
+    ``encoding`` is one of ``EXTENSIONS``. ``png_compression`` (0-9) and
+    ``jpeg_quality`` (0-100) are passed to ``cv2.imwrite``; ``npy`` writes the
+    raw array with ``numpy.save``. If ``block`` is set, ``submit`` waits for
+    room in the queue, otherwise images that do not fit are dropped.
+    """
+
+    def __init__(self, workers=2, max_queue=16, encoding="png",
+                 png_compression=3, jpeg_quality=95, block=False):
+        if encoding not in EXTENSIONS:
+            raise ValueError("Unknown encoding: {}".format(encoding))
+        #: Default encoding for submitted images
+        self.encoding = encoding
+        #: PNG compression level, 0 (fastest) to 9 (smallest)
+        self.png_compression = png_compression
+        #: JPEG quality, 0 to 100
+        self.jpeg_quality = jpeg_quality
+        #: Whether ``submit`` waits for room instead of dropping images
+        self.block = block
+        #: Number of images written successfully
+        self.written = 0
+        #: Number of images dropped because the queue was full
+        self.dropped = 0
+        #: Number of images that could not be written
+        self.errors = 0
+        self._counter_lock = threading.Lock()
+        self._queue = Queue.Queue(max_queue)
+        self._threads = [threading.Thread(target=self._run)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def queue_depth(self):
+        """Return the number of images waiting to be written."""
+        return self._queue.qsize()
+
+    def submit(self, path, image, encoding=None, block=None):
+        """
+        Queue ``image`` to be written to ``path``.
+
+        The extension of ``path`` is replaced by the one of the encoding used.
+        ``encoding`` and ``block`` override the pool's defaults for this image.
+        ``image`` must not be modified afterwards. Return the path the image
+        will be written to, or None if it was dropped.
+        """
+        encoding = encoding or self.encoding
+        if block is None:
+            block = self.block
+        if encoding not in EXTENSIONS:
+            raise ValueError("Unknown encoding: {}".format(encoding))
+        path = os.path.splitext(path)[0] + EXTENSIONS[encoding]
+        try:
+            self._queue.put((path, image, encoding), block)
+        except Queue.Full:
+            with self._counter_lock:
+                self.dropped += 1
+            return None
+        return path
+
+    def _write(self, path, image, encoding):
+        """Encode and write a single image."""
+        with instrumentation.stage("imwrite." + encoding):
+            self._encode(path, image, encoding)
+
+    def _encode(self, path, image, encoding):
+        if encoding == "npy":
+            numpy.save(path, image)
+            return
+        if encoding == "png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        if not cv2.imwrite(path, image, params):
+            raise IOError("Could not write {}".format(path))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+                with self._counter_lock:
+                    self.written += 1
+            except Exception as error:
+                with self._counter_lock:
+                    self.errors += 1
+                print("Image writer: {}".format(error))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until every queued image has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Write all queued images and stop the writer threads."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,171 @@
+"""
+Lightweight per-stage timing for the capture, preview and render paths.
+
+Code marks a stage with ``with stage("name"):`` or by passing a start time to
+``record``. While instrumentation is disabled, ``stage`` returns a shared no-op
+context manager and ``record`` only computes the duration it returns, so
+instrumented code costs a function call per stage. While enabled, each stage
+keeps its most recent samples in a ring buffer, from which rates and latency
+percentiles are computed, and which can be exported as JSON, CSV or a Chrome
+trace (load it in ``chrome://tracing`` or Perfetto).
+
+Functions:
+
+    * ``enable`` - Turn recording on or off
+    * ``stage`` - Context manager timing a block
+    * ``record`` - Record a stage that started at a given time
+    * ``reset`` - Forget all samples
+    * ``summary`` - Count, rate and percentiles per stage
+    * ``format_summary`` - One line per stage, for display
+    * ``export`` - Write samples to a JSON, CSV or Chrome trace file
+"""
+
+import collections
+import csv
+import os
+import threading
+
+import numpy
+import simplejson
+
+from clock import monotonic
+
+#: Samples kept per stage
+HISTORY = 1024
+
+#: Whether stages are being recorded
+enabled = False
+
+#: Stage name -> deque of (start, duration, thread id) in seconds
+_samples = {}
+_samples_lock = threading.Lock()
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.start)
+        return False
+
+
+def enable(on=True):
+    """Start (or with ``on`` False, stop) recording stages."""
+    global enabled
+    enabled = bool(on)
+
+
+def stage(name):
+    """Return a context manager recording the time spent in its block."""
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def record(name, start, end=None):
+    """
+    Record stage ``name`` from ``start`` to ``end`` (default now), both from
+    ``clock.monotonic``. Return the duration in seconds, even when disabled.
+    """
+    if end is None:
+        end = monotonic()
+    if enabled:
+        samples = _samples.get(name)
+        if samples is None:
+            with _samples_lock:
+                samples = _samples.setdefault(
+                    name, collections.deque(maxlen=HISTORY))
+        # deque appends are atomic, so stages may be recorded from any thread
+        samples.append((start, end - start, threading.current_thread().ident))
+    return end - start
+
+
+def reset():
+    """Forget every recorded sample."""
+    with _samples_lock:
+        _samples.clear()
+
+
+def _snapshot():
+    with _samples_lock:
+        return dict((name, list(samples)) for name, samples in _samples.items())
+
+
+def summary():
+    """
+    Return {stage: {"count", "rate", "p50", "p99", "max"}}.
+
+    ``count`` is the number of samples kept, ``rate`` how many times per
+    second the stage started over them, and the latencies are in seconds.
+    """
+    result = {}
+    for name, samples in _snapshot().items():
+        if not samples:
+            continue
+        starts = [start for start, _, _ in samples]
+        durations = numpy.array([duration for _, duration, _ in samples])
+        span = max(starts) - min(starts)
+        p50, p99 = numpy.percentile(durations, [50, 99])
+        result[name] = {"count": len(samples),
+                        "rate": (len(samples) - 1) / span if span else 0.0,
+                        "p50": p50, "p99": p99, "max": durations.max()}
+    return result
+
+
+def format_summary(stats=None):
+    """Return one "stage: rate, p50/p99" line per stage, slowest first."""
+    stats = summary() if stats is None else stats
+    lines = []
+    for name, item in sorted(stats.items(), key=lambda entry: -entry[1]["p50"]):
+        lines.append("{}: {:.1f}/s, p50 {:.1f} ms, p99 {:.1f} ms".format(
+            name, item["rate"], item["p50"] * 1000, item["p99"] * 1000))
+    return "\n".join(lines)
+
+
+def export(path):
+    """
+    Write the recorded samples to ``path``.
+
+    The format follows the file name: ``.csv`` writes one row per sample,
+    ``.trace.json`` a Chrome trace, and any other name JSON holding the
+    ``summary`` and the samples.
+    """
+    samples = _snapshot()
+    if path.endswith(".csv"):
+        with open(path, "wb") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["stage", "start", "duration", "thread"])
+            for name in sorted(samples):
+                for start, duration, thread in samples[name]:
+                    writer.writerow([name, repr(start), repr(duration), thread])
+    elif path.endswith(".trace.json"):
+        # complete events, in microseconds
+        events = [{"name": name, "ph": "X", "pid": os.getpid(), "tid": thread,
+                   "ts": start * 1e6, "dur": duration * 1e6}
+                  for name in samples
+                  for start, duration, thread in samples[name]]
+        with open(path, "w") as trace_file:
+            simplejson.dump({"traceEvents": events}, trace_file)
+    else:
+        with open(path, "w") as json_file:
+            simplejson.dump({"summary": summary(),
+                             "samples": samples}, json_file)
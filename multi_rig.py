@@ -0,0 +1,431 @@
+"""
+Several stereo rigs captured by separate processes, supervised by one.
+
+In a single workbench process every rig shares one interpreter, so the GIL
+caps the frame rate well before the cameras do. Here each rig is acquired by a
+process of its own, which publishes every pair into a ring of slots in shared
+memory. A single supervisor process reads the newest pair of each rig from its
+ring, without pickling or piping any frames, and hands it to the preview,
+runs the capture schedules and saves coordinated captures of all rigs, with a
+capture catalog per rig. It also keeps throughput statistics per rig.
+
+Ring slots are guarded by their sequence number: the rig clears it before
+overwriting a slot and sets it once the slot is complete, and the supervisor
+discards a copy whose slot changed while it was copying. Grab timestamps come
+from ``clock.monotonic``, which is system-wide on POSIX systems, so the
+timestamps of different rigs can be compared there.
+
+Classes:
+
+    * ``FrameRing`` - Shared-memory ring of frame pairs
+    * ``RigSupervisor`` - Run rig processes and distribute their pairs
+"""
+
+import ctypes
+from datetime import datetime
+import multiprocessing
+import os
+import Queue
+import signal
+import threading
+
+import cv2
+import numpy
+
+from capture_catalog import CaptureCatalog, wall_clock
+from clock import monotonic
+from frame_bus import FrameBus, FramePair
+from image_writer import ImageWriterPool
+from scheduler import Scheduler
+from transformed_stereo_cameras import StereoPair
+
+#: Header values per slot: left and right timestamp, left and right rotation
+_HEADER = 4
+
+
+class FrameRing(object):
+
+    """
+    A ring of ``slots`` stereo pairs of (height, width, 3) uint8 frames in
+    shared memory, written by one process and read by another.
+
+    Grayscale frames are converted. Pairs with frames of another size are
+    rejected, never resized: they are counted and not published, so a rig
+    delivering the wrong size stalls instead of saving altered images.
+    Create the ring before starting the processes using it.
+    """
+
+    def __init__(self, width, height, slots=4):
+        #: Shape of each frame
+        self.shape = (height, width, 3)
+        self.slots = slots
+        size = slots * 2 * height * width * 3
+        self._frames = multiprocessing.RawArray(ctypes.c_uint8, size)
+        self._headers = multiprocessing.RawArray(ctypes.c_double,
+                                                 slots * _HEADER)
+        #: Sequence number of each slot's pair, 0 while it is being written
+        self._sequences = multiprocessing.RawArray(ctypes.c_longlong, slots)
+        self._published = multiprocessing.RawValue(ctypes.c_longlong, 0)
+        self._rejected = multiprocessing.RawValue(ctypes.c_longlong, 0)
+        self._views = None
+
+    def __getstate__(self):
+        # the views are rebuilt in the receiving process
+        state = dict(self.__dict__)
+        state["_views"] = None
+        return state
+
+    def _get_views(self):
+        if self._views is None:
+            frames = numpy.frombuffer(self._frames, numpy.uint8)
+            headers = numpy.frombuffer(self._headers, numpy.float64)
+            self._views = (frames.reshape((self.slots, 2) + self.shape),
+                           headers.reshape(self.slots, _HEADER))
+        return self._views
+
+    @property
+    def published(self):
+        """Return the number of pairs written so far."""
+        return self._published.value
+
+    @property
+    def rejected(self):
+        """Return the number of pairs rejected for their frame size."""
+        return self._rejected.value
+
+    def write(self, frames, timestamps, rotation):
+        """
+        Copy (left, right) ``frames`` into the next slot. Return whether the
+        pair was published.
+        """
+        if any(frame is None for frame in frames):
+            return False
+        frames = [cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+                  if frame.ndim == 2 else frame for frame in frames]
+        shapes = [frame.shape for frame in frames]
+        if any(shape != self.shape for shape in shapes):
+            if not self._rejected.value:
+                print("Rejecting frames of {}, the rig ring holds frames of "
+                      "{}x{}.".format(
+                          " and ".join("{}x{}".format(shape[1], shape[0])
+                                       for shape in shapes),
+                          self.shape[1], self.shape[0]))
+            self._rejected.value += 1
+            return False
+        frame_views, headers = self._get_views()
+        sequence = self._published.value + 1
+        slot = sequence % self.slots
+        self._sequences[slot] = 0
+        for target, frame in zip(frame_views[slot], frames):
+            numpy.copyto(target, frame)
+        headers[slot] = list(timestamps) + list(rotation)
+        self._sequences[slot] = sequence
+        self._published.value = sequence
+        return True
+
+    def read(self, after=0):
+        """
+        Return (sequence, frames, timestamps, rotation) of the newest pair if
+        its sequence number is above ``after``, else None. The frames are
+        copies.
+        """
+        sequence = self._published.value
+        if sequence <= after:
+            return None
+        frame_views, headers = self._get_views()
+        slot = sequence % self.slots
+        if self._sequences[slot] != sequence:
+            return None
+        frames = frame_views[slot].copy()
+        header = headers[slot].copy()
+        if self._sequences[slot] != sequence:
+            # overwritten while copying
+            return None
+        return (sequence, list(frames), list(header[:2]),
+                [int(angle) for angle in header[2:]])
+
+
+def _apply_commands(pair, commands):
+    """Carry out the commands the supervisor sent to a rig."""
+    while True:
+        try:
+            command = commands.get_nowait()
+        except Queue.Empty:
+            return
+        name, arguments = command[0], command[1:]
+        if name == "property":
+            pair.set_property(*arguments)
+        elif name == "rotation":
+            index, angle = arguments
+            # a list of its own: the default is shared by all pairs
+            pair.rotation = list(pair.rotation)
+            pair.rotation[index] = angle
+
+
+def _run_rig(rig, ring, commands, running, frame_rate):
+    """
+    Acquire pairs of ``rig`` into ``ring`` at up to ``frame_rate`` per
+    second until ``running`` is cleared. ``rig`` is a (left, right) pair of
+    device numbers or a callable returning (left, right) captures.
+    """
+    # the supervisor handles Ctrl-C and stops the rigs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if callable(rig):
+        pair = StereoPair(None, captures=rig())
+    else:
+        pair = StereoPair(rig)
+    with pair:
+        bus = FrameBus(pair)
+        bus.subscribe(lambda framePair: ring.write(
+            framePair.raw, framePair.timestamps, framePair.rotation))
+        scheduler = Scheduler()
+        scheduler.add("frames", 1.0 / frame_rate, bus.publish, delay=0)
+        scheduler.add("commands", 0.1, lambda: _apply_commands(pair, commands))
+        while running.is_set():
+            scheduler.run_pending()
+            scheduler.wait(0.1)
+
+
+class RigSupervisor(object):
+
+    """
+    Run a capture process per rig and distribute the pairs they acquire.
+
+    ``rigs`` holds a (left, right) pair of device numbers per rig, or a
+    callable returning (left, right) captures, such as a
+    ``functools.partial`` of ``frame_sources.synthetic_pair``. Every rig
+    delivers (height, width) frames at up to ``frame_rate`` pairs per second;
+    pairs of another size are rejected, so such a rig is never delivering.
+
+    The supervisor polls the rings on a thread of its own. Subscribers are
+    called there with the rig's index and each new ``FramePair``; they must
+    not modify the frames. Rigs delivering faster than the supervisor polls
+    skip pairs, which are counted. Captures are saved under ``folder``, in a
+    ``rig<index>`` folder per rig. A rig whose process died or that delivered
+    nothing for ``stall_timeout`` seconds is left out of captures.
+    """
+
+    def __init__(self, rigs, folder="captures", width=1920, height=1080,
+                 frame_rate=30, slots=4, stall_timeout=5.0):
+        self.rigs = list(rigs)
+        self.folder = folder
+        self.frame_rate = frame_rate
+        #: Seconds without a pair after which a rig is considered stalled
+        self.stall_timeout = stall_timeout
+        #: Shared-memory ring of each rig
+        self.rings = [FrameRing(width, height, slots) for rig in self.rigs]
+        #: Most recent ``FramePair`` of each rig
+        self.latest = [None] * len(self.rigs)
+        #: Number of pairs received from each rig
+        self.received = [0] * len(self.rigs)
+        #: Number of pairs of each rig replaced before they were polled
+        self.skipped = [0] * len(self.rigs)
+        #: Runs polling and the capture schedules
+        self.scheduler = Scheduler()
+        self.writer = ImageWriterPool()
+        self._commands = [multiprocessing.Queue() for rig in self.rigs]
+        self._running = multiprocessing.Event()
+        self._processes = []
+        self._catalogs = {}
+        self._subscribers = []
+        self._requests = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._delivered = [monotonic()] * len(self.rigs)
+        self._stats = (monotonic(), [0] * len(self.rigs),
+                       [0] * len(self.rigs))
+
+    def start(self):
+        """Start the rig processes and the polling thread."""
+        self._running.set()
+        # opening the cameras counts against the stall timeout
+        self._delivered = [monotonic()] * len(self.rigs)
+        for rig, ring, commands in zip(self.rigs, self.rings, self._commands):
+            process = multiprocessing.Process(
+                target=_run_rig, args=(rig, ring, commands, self._running,
+                                       self.frame_rate))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        # poll twice per frame so no rig waits a whole frame to be read
+        self.scheduler.add("poll", 0.5 / self.frame_rate, self.poll, delay=0)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running.is_set():
+            self.scheduler.run_pending()
+            self.scheduler.wait()
+
+    def subscribe(self, callback):
+        """Call ``callback`` with (rig, ``FramePair``) for every new pair."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def request(self, callback, tag=None):
+        """
+        Call ``callback`` once, with the next ``FramePair`` of every rig, as
+        soon as all delivering rigs delivered one. Rigs that are not
+        delivering, see ``delivering``, get None instead. ``tag`` names the
+        request for ``pending``.
+        """
+        with self._lock:
+            self._requests.append((callback, [None] * len(self.rigs), tag))
+
+    def pending(self, tag):
+        """Return the number of unanswered requests tagged ``tag``."""
+        with self._lock:
+            return len([request for request in self._requests
+                        if request[2] == tag])
+
+    def delivering(self, rig):
+        """
+        Return whether the process of ``rig`` is alive and published a pair
+        within the last ``stall_timeout`` seconds.
+        """
+        return (rig < len(self._processes) and
+                self._processes[rig].is_alive() and
+                monotonic() - self._delivered[rig] <= self.stall_timeout)
+
+    def poll(self):
+        """
+        Publish the newest pair of every rig that delivered a new one, then
+        answer the requests every delivering rig has a pair for.
+        """
+        for rig, ring in enumerate(self.rings):
+            after = self.latest[rig].index if self.latest[rig] else 0
+            pair = ring.read(after)
+            if pair is None:
+                continue
+            sequence, frames, timestamps, rotation = pair
+            self.skipped[rig] += sequence - after - 1
+            self.received[rig] += 1
+            self._delivered[rig] = monotonic()
+            framePair = FramePair(frames, rotation, min(timestamps), sequence,
+                                  timestamps)
+            self.latest[rig] = framePair
+            with self._lock:
+                callbacks = list(self._subscribers)
+                for request in self._requests:
+                    if request[1][rig] is None:
+                        request[1][rig] = framePair
+            for callback in callbacks:
+                callback(rig, framePair)
+        if not self._requests:
+            return
+        # checked on every poll, so a stalled rig holds up nothing
+        delivering = [self.delivering(rig) for rig in range(len(self.rigs))]
+        with self._lock:
+            complete = [request for request in self._requests
+                        if all(framePair is not None or not live for
+                               framePair, live in zip(request[1], delivering))]
+            for request in complete:
+                self._requests.remove(request)
+        for callback, framePairs, tag in complete:
+            callback(framePairs)
+
+    def set_property(self, rig, index, prop, value):
+        """Set property ``prop`` of camera ``index`` of ``rig``."""
+        self._commands[rig].put(("property", index, prop, value))
+
+    def set_rotation(self, rig, index, angle):
+        """Rotate the frames of camera ``index`` of ``rig`` by ``angle``."""
+        self._commands[rig].put(("rotation", index, angle))
+
+    def set_interval(self, interval):
+        """Capture every rig every ``interval`` seconds, or stop if None."""
+        if interval:
+            self.scheduler.add("interval", interval, self._capture_interval)
+        else:
+            self.scheduler.remove("interval")
+
+    def capture(self, tag="capture"):
+        """Save the next pair of every rig."""
+        self.request(self.save, tag)
+
+    def _capture_interval(self):
+        # a single interval capture waits at a time, however long it takes
+        if self.pending("interval"):
+            print("Interval capture skipped, the previous one is still "
+                  "waiting for the rigs.")
+            return
+        self.capture("interval")
+
+    def save(self, framePairs):
+        """
+        Save a ``FramePair`` per rig, named after the earliest grab time of
+        all of them, and record each in its rig's catalog. Rigs without a
+        pair (None) are left out.
+        """
+        missing = [rig for rig, framePair in enumerate(framePairs)
+                   if framePair is None]
+        if missing:
+            print("Capture without rigs {}, which are not delivering.".format(
+                ", ".join(str(rig) for rig in missing)))
+        if len(missing) == len(framePairs):
+            return
+        timestamp = wall_clock(min(framePair.timestamp
+                                   for framePair in framePairs if framePair))
+        date_string = datetime.fromtimestamp(timestamp).strftime(
+            "%Y-%m-%d_%H-%M-%S-%f")
+        for rig, framePair in enumerate(framePairs):
+            if framePair is None:
+                continue
+            folder = os.path.join(self.folder, "rig{}".format(rig))
+            catalog = self._catalogs.get(folder)
+            if catalog is None:
+                catalog = self._catalogs[folder] = CaptureCatalog(folder)
+            paths = [self.writer.submit(os.path.join(
+                         folder, "{}_{}.png".format(side, date_string)), frame)
+                     for side, frame in zip(("Left", "Right"),
+                                            framePair.frames)]
+            if any(paths):
+                catalog.add(wall_clock(framePair.timestamp), paths,
+                            framePair.rotation)
+
+    def stats(self):
+        """
+        Return a dict per rig with the pairs published by the rig, received
+        and skipped by the supervisor, pairs rejected for their size, both
+        rates per second since the previous call, whether the process is
+        alive and whether the rig is delivering.
+        """
+        now = monotonic()
+        published = [ring.published for ring in self.rings]
+        since, last_published, last_received = self._stats
+        self._stats = (now, published, list(self.received))
+        seconds = max(now - since, 1e-9)
+        return [{"published": published[rig],
+                 "received": self.received[rig],
+                 "skipped": self.skipped[rig],
+                 "rejected": self.rings[rig].rejected,
+                 "published_fps": (published[rig] - last_published[rig]) /
+                                  seconds,
+                 "received_fps": (self.received[rig] - last_received[rig]) /
+                                 seconds,
+                 "alive": rig < len(self._processes) and
+                          self._processes[rig].is_alive(),
+                 "delivering": self.delivering(rig)}
+                for rig in range(len(self.rigs))]
+
+    def stop(self):
+        """Stop the rigs and the polling thread, then write queued captures."""
+        self._running.clear()
+        self.scheduler.wake()
+        if self._thread:
+            self._thread.join()
+        for process in self._processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.writer.close()
+        for catalog in self._catalogs.values():
+            catalog.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
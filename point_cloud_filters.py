@@ -0,0 +1,266 @@
+"""
+Vectorized point cloud filtering.
+
+A 1080p disparity map yields millions of points, many of them noise or
+redundant. These filters run between reprojection and writing and are built
+only from NumPy array operations, so each costs a few passes over the cloud.
+Neighbourhood queries use a spatial hash: points are binned into cubic cells,
+the occupied cells are sorted once, and each cell's 26 neighbours are looked up
+with ``searchsorted`` on the (much smaller) set of occupied cells. Cells are as
+large as the search radius, so the points of a cell's 3x3x3 block are the only
+candidates whose exact distance is checked.
+
+Functions:
+
+    * ``clip_depth`` - Keep points within a depth range
+    * ``voxel_downsample`` - Merge points per voxel, averaging their colors
+    * ``neighbor_counts`` - Count the points within a radius of each point
+    * ``mean_neighbor_distances`` - Mean distance to the nearest points
+    * ``remove_radius_outliers`` - Drop points with too few neighbours
+    * ``remove_statistical_outliers`` - Drop points in unusually sparse regions
+    * ``filter_point_cloud`` - Run the configured filters on a ``PointCloud``
+"""
+
+import itertools
+
+import numpy
+from stereovision.point_cloud import PointCloud
+
+from clock import monotonic
+import instrumentation
+
+#: Candidate point pairs examined at a time by the neighbourhood queries
+_PAIR_BUDGET = 1 << 22
+
+#: Cell keys used when the packed int64 keys would overflow
+_CELL_DTYPE = numpy.dtype([("x", numpy.int64), ("y", numpy.int64),
+                           ("z", numpy.int64)])
+
+
+def clip_depth(coordinates, colors, near=None, far=None):
+    """
+    Keep points whose depth lies between ``near`` and ``far``.
+
+    Depth is the absolute z coordinate, as the workbench's reprojection matrix
+    puts the scene at negative z. Either bound may be None.
+    """
+    depth = numpy.abs(coordinates[:, 2])
+    mask = numpy.ones(len(coordinates), bool)
+    if near is not None:
+        mask &= depth >= near
+    if far is not None:
+        mask &= depth <= far
+    return coordinates[mask], colors[mask]
+
+
+def _cell_keys(coordinates, cell_size):
+    """
+    Return a key per point identifying its cell, and a function returning the
+    keys of the cells at an (x, y, z) offset from given keys.
+
+    Cells are offset so that every neighbour of an occupied cell also has a
+    valid, unique key. Keys are the cell indices packed into an int64, or, if
+    the cells span too many of those, records of the three indices, which
+    sort the same way but take three times the memory.
+    """
+    if not numpy.isfinite(coordinates).all():
+        raise ValueError("Point coordinates must be finite.")
+    # in float64: float16 coordinates divided by a small cell overflow
+    scaled = numpy.floor(numpy.asarray(coordinates, numpy.float64) / cell_size)
+    low = scaled.min(axis=0)
+    if (scaled.max(axis=0) - low).max() >= 2 ** 62:
+        raise ValueError("Cell size {} is too small for points spanning "
+                         "{}.".format(cell_size, coordinates.ptp(axis=0)))
+    cells = (scaled - low).astype(numpy.int64) + 1
+    span = [int(size) for size in cells.max(axis=0) + 2]
+    if span[0] * span[1] * span[2] < 2 ** 63:
+        strides = numpy.array([span[1] * span[2], span[2], 1], numpy.int64)
+        return cells.dot(strides), lambda keys, offset: (
+            keys + numpy.dot(offset, strides))
+    keys = numpy.empty(len(cells), _CELL_DTYPE)
+    for axis, name in enumerate(_CELL_DTYPE.names):
+        keys[name] = cells[:, axis]
+
+    def shift(keys, offset):
+        shifted = keys.copy()
+        for name, step in zip(_CELL_DTYPE.names, offset):
+            shifted[name] += step
+        return shifted
+    return keys, shift
+
+
+def voxel_downsample(coordinates, colors, voxel_size):
+    """Replace all points in each ``voxel_size`` cube by their centroid."""
+    if not len(coordinates):
+        return coordinates, colors
+    keys = _cell_keys(coordinates, voxel_size)[0]
+    inverse, counts = numpy.unique(keys, return_inverse=True,
+                                   return_counts=True)[1:]
+    merged_coordinates = numpy.empty((len(counts), 3), coordinates.dtype)
+    merged_colors = numpy.empty((len(counts), 3), colors.dtype)
+    for axis in range(3):
+        merged_coordinates[:, axis] = numpy.bincount(
+            inverse, weights=coordinates[:, axis]) / counts
+        merged_colors[:, axis] = numpy.rint(numpy.bincount(
+            inverse, weights=colors[:, axis]) / counts)
+    return merged_coordinates, merged_colors
+
+
+def _neighbor_pairs(coordinates, radius):
+    """
+    Yield (points, neighbors, squared distances) of the point pairs at most
+    ``radius`` apart, in chunks holding every neighbour of their points.
+
+    Points are binned into cells of size ``radius``, so all neighbours of a
+    point lie in its block of 3x3x3 cells; the points of each block are the
+    candidates whose exact distance is checked. Each point is its own
+    neighbour. Chunks are made of whole cells and hold about
+    ``_PAIR_BUDGET`` candidates.
+    """
+    keys, shift = _cell_keys(coordinates, radius)
+    order = numpy.argsort(keys, kind="mergesort")
+    cells, starts, counts = numpy.unique(keys[order], return_index=True,
+                                         return_counts=True)
+    offsets = list(itertools.product((-1, 0, 1), repeat=3))
+
+    def block_ranges(first, last):
+        """Return (start, count) of every neighbour cell of cells[first:last]."""
+        ranges = []
+        for offset in offsets:
+            neighbors = shift(cells[first:last], offset)
+            index = numpy.searchsorted(cells, neighbors)
+            index[index == len(cells)] = 0
+            found = cells[index] == neighbors
+            ranges.append((starts[index], numpy.where(found, counts[index], 0)))
+        return ranges
+
+    candidates = numpy.zeros(len(cells), numpy.int64)
+    for first in range(0, len(cells), _PAIR_BUDGET):
+        last = first + _PAIR_BUDGET
+        for block_start, block_count in block_ranges(first, last):
+            candidates[first:last] += counts[first:last] * block_count
+    # cells are split where the running candidate count passes the budget
+    bounds = numpy.searchsorted(numpy.cumsum(candidates), numpy.arange(
+        _PAIR_BUDGET, candidates.sum(), _PAIR_BUDGET), side="right")
+    bounds = numpy.unique(numpy.concatenate([[0], bounds, [len(cells)]]))
+    limit = float(radius) ** 2
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        points, neighbors, distances = [], [], []
+        for block_start, block_count in block_ranges(first, last):
+            sizes = counts[first:last] * block_count
+            total = sizes.sum()
+            if not total:
+                continue
+            cell = numpy.repeat(numpy.arange(first, last), sizes)
+            width = numpy.repeat(block_count, sizes)
+            local = numpy.arange(total) - numpy.repeat(numpy.cumsum(sizes) -
+                                                      sizes, sizes)
+            point = order[starts[cell] + local // width]
+            neighbor = order[numpy.repeat(block_start, sizes) + local % width]
+            squared = ((coordinates[point] - coordinates[neighbor]) ** 2).sum(
+                axis=1)
+            near = squared <= limit
+            points.append(point[near])
+            neighbors.append(neighbor[near])
+            distances.append(squared[near])
+        if points:
+            yield (numpy.concatenate(points), numpy.concatenate(neighbors),
+                   numpy.concatenate(distances))
+
+
+def neighbor_counts(coordinates, radius):
+    """
+    Count the points within ``radius`` of each point, including the point
+    itself.
+    """
+    counts = numpy.zeros(len(coordinates), numpy.int64)
+    if not len(coordinates):
+        return counts
+    for points, neighbors, distances in _neighbor_pairs(
+            numpy.asarray(coordinates, numpy.float64), radius):
+        counts += numpy.bincount(points, minlength=len(coordinates))
+    return counts
+
+
+def mean_neighbor_distances(coordinates, radius, neighbors):
+    """
+    Return each point's mean distance to its ``neighbors`` nearest other
+    points, searching up to ``radius`` away. Neighbours missing within
+    ``radius`` count as ``radius`` away.
+    """
+    count = len(coordinates)
+    sums = numpy.zeros(count)
+    found = numpy.zeros(count, numpy.int64)
+    for points, others, distances in _neighbor_pairs(
+            numpy.asarray(coordinates, numpy.float64), radius):
+        other = points != others
+        points, distances = points[other], distances[other]
+        # rank each point's neighbours by distance, nearest first
+        order = numpy.lexsort((distances, points))
+        points, distances = points[order], distances[order]
+        group_starts = numpy.flatnonzero(numpy.r_[True, points[1:] !=
+                                                  points[:-1]])
+        ranks = numpy.arange(len(points)) - numpy.repeat(
+            group_starts, numpy.diff(numpy.r_[group_starts, len(points)]))
+        nearest = ranks < neighbors
+        sums += numpy.bincount(points[nearest],
+                               weights=numpy.sqrt(distances[nearest]),
+                               minlength=count)
+        found += numpy.bincount(points[nearest], minlength=count)
+    return (sums + (neighbors - found) * float(radius)) / neighbors
+
+
+def remove_radius_outliers(coordinates, colors, radius, min_neighbors):
+    """Drop points with no more than ``min_neighbors`` points within ``radius``."""
+    mask = neighbor_counts(coordinates, radius) > min_neighbors
+    return coordinates[mask], colors[mask]
+
+
+def remove_statistical_outliers(coordinates, colors, radius, std_ratio,
+                                neighbors=4):
+    """
+    Drop points whose mean distance to their ``neighbors`` nearest points is
+    more than ``std_ratio`` standard deviations above the mean of all points.
+    Neighbours are searched up to ``radius`` away, see
+    ``mean_neighbor_distances``.
+    """
+    if not len(coordinates):
+        return coordinates, colors
+    distances = mean_neighbor_distances(coordinates, radius, neighbors)
+    mask = distances <= distances.mean() + std_ratio * distances.std()
+    return coordinates[mask], colors[mask]
+
+
+def filter_point_cloud(points, near=None, far=None, voxel_size=None,
+                       outlier_radius=None, min_neighbors=4, std_ratio=None):
+    """
+    Filter ``points`` and return the new ``PointCloud`` and stage timings.
+
+    Stages run in this order and only if configured: depth clipping
+    (``near``/``far``), voxel downsampling (``voxel_size``) and outlier
+    removal (``outlier_radius``). Outlier removal is statistical, over the
+    distances to the ``min_neighbors`` nearest points, if ``std_ratio`` is
+    given, otherwise points with fewer than ``min_neighbors`` neighbours
+    within ``outlier_radius`` are dropped. Timings are in seconds, keyed
+    by stage name.
+    """
+    coordinates, colors = points.coordinates, points.colors
+    stages = []
+    if near is not None or far is not None:
+        stages.append(("clip", lambda c, k: clip_depth(c, k, near, far)))
+    if voxel_size:
+        stages.append(("voxel", lambda c, k: voxel_downsample(c, k,
+                                                              voxel_size)))
+    if outlier_radius and std_ratio is not None:
+        stages.append(("outliers", lambda c, k: remove_statistical_outliers(
+                                              c, k, outlier_radius, std_ratio,
+                                              min_neighbors)))
+    elif outlier_radius:
+        stages.append(("outliers", lambda c, k: remove_radius_outliers(
+                                          c, k, outlier_radius, min_neighbors)))
+    timings = {}
+    for name, stage in stages:
+        start = monotonic()
+        coordinates, colors = stage(coordinates, colors)
+        timings[name] = instrumentation.record("render." + name, start)
+    return PointCloud(coordinates, colors), timings
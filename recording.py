@@ -0,0 +1,306 @@
+"""
+Full-rate recording of synchronized stereo frames to memory-mapped segments.
+
+Saving stills encodes every image, which limits capture to a few pairs per
+second. A recording instead copies each matched pair of raw frames, unencoded,
+into a fixed-size slot of a preallocated segment file. Segments are ``.npy``
+files holding a structured array with one element per slot, so they describe
+their own layout and can be memory-mapped again with ``numpy.load``. A slot
+holds the pair's sequence number (0 while the slot is empty), the grab
+timestamp of each frame, the camera rotations and both frames. A new segment is
+started when one is full or the frame size changes.
+
+Classes:
+
+    * ``RecordingWriter`` - Copy frame pairs into segment files on a thread
+    * ``RecordingReader`` - Random access to the pairs of a recording
+    * ``RecordingSource`` - One camera of a recording, usable as a
+      ``VideoCapture``
+
+Functions:
+
+    * ``recording_pair`` - Left and right sources replaying a recording
+"""
+
+import glob
+import os
+import Queue
+import threading
+import time
+
+import cv2
+import numpy
+from numpy.lib.format import open_memmap
+import simplejson
+
+from clock import monotonic
+from frame_sources import SIDES, _PacedSource
+
+#: File describing a recording, next to its segments
+MANIFEST = "recording.json"
+
+#: Name pattern of segment files
+SEGMENT_NAME = "segment_{:05d}.npy"
+
+#: Bytes in front of the frames of a slot, so they start 64-byte aligned
+_SLOT_HEADER = 64
+
+
+def slot_dtype(frames):
+    """Return the dtype of a slot holding a pair shaped like ``frames``."""
+    fields = [("sequence", "<i8"), ("timestamps", "<f8", (2,)),
+              ("rotation", "<i2", (2,)), ("reserved", "V{}".format(
+                  _SLOT_HEADER - 8 - 16 - 4))]
+    fields += [(side, frame.dtype, frame.shape)
+               for side, frame in zip(SIDES, frames)]
+    return numpy.dtype(fields)
+
+
+class RecordingWriter(object):
+
+    """
+    Record stereo pairs into a folder of memory-mapped segment files.
+
+    ``write`` queues a pair and returns at once; a background thread copies
+    queued pairs into the current segment. The queue holds at most
+    ``max_queue`` pairs, further pairs are dropped and counted until the disk
+    catches up. Frames must not be modified after they were written.
+    """
+
+    def __init__(self, path, slots=256, max_queue=8):
+        """
+        Start a recording in the folder ``path``, which is created. Each
+        segment file has room for ``slots`` pairs.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        #: Folder holding the segments
+        self.path = path
+        #: Pairs per segment
+        self.slots = slots
+        #: Number of pairs recorded
+        self.written = 0
+        #: Number of pairs dropped because the queue was full
+        self.dropped = 0
+        #: File names of the segments, in order
+        self.segments = []
+        #: Wall clock and monotonic time at the start, to convert timestamps
+        self.started = (time.time(), monotonic())
+        self._segment = None
+        self._slot = 0
+        self._closed = False
+        self._queue = Queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        """Return the number of pairs waiting to be copied."""
+        return self._queue.qsize()
+
+    def write(self, frames, timestamps, rotation=(0, 0)):
+        """
+        Queue (left, right) ``frames`` grabbed at ``timestamps`` (from
+        ``clock.monotonic``). Return False if the pair was not recorded.
+        """
+        if self._closed or any(frame is None for frame in frames):
+            return False
+        try:
+            self._queue.put_nowait((frames, timestamps, rotation))
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._store(*item)
+
+    def _store(self, frames, timestamps, rotation):
+        dtype = slot_dtype(frames)
+        if (self._segment is None or self._slot == self.slots or
+                self._segment.dtype != dtype):
+            self._open_segment(dtype)
+        segment, slot = self._segment, self._slot
+        for side, frame in zip(SIDES, frames):
+            segment[side][slot] = frame
+        segment["timestamps"][slot] = timestamps
+        segment["rotation"][slot] = rotation
+        # set last: a slot with a sequence number is complete
+        segment["sequence"][slot] = self.written + 1
+        self._slot += 1
+        self.written += 1
+
+    def _open_segment(self, dtype):
+        self._close_segment()
+        name = SEGMENT_NAME.format(len(self.segments))
+        # sized for every slot up front, unused slots stay zero
+        self._segment = open_memmap(os.path.join(self.path, name), mode="w+",
+                                    dtype=dtype, shape=(self.slots,))
+        self._slot = 0
+        self.segments.append(name)
+        self._write_manifest()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.flush()
+            self._segment = None
+
+    def _write_manifest(self):
+        manifest = {"segments": self.segments, "slots": self.slots,
+                    "frames": self.written, "dropped": self.dropped,
+                    "wall_clock": self.started[0],
+                    "monotonic": self.started[1]}
+        with open(os.path.join(self.path, MANIFEST), "w") as manifest_file:
+            simplejson.dump(manifest, manifest_file, indent=2)
+
+    def close(self):
+        """Copy the queued pairs, then finish the recording."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._close_segment()
+        self._write_manifest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class RecordingReader(object):
+
+    """
+    The pairs of a recording, in recording order.
+
+    Segments are memory-mapped read-only, so opening a recording reads no
+    frames. Slots left empty, e.g. by an interrupted recording, are skipped;
+    the manifest is not needed to read a recording.
+    """
+
+    def __init__(self, path):
+        #: Folder holding the segments
+        self.path = path
+        #: Memory-mapped segments
+        self.segments = [numpy.load(name, mmap_mode="r") for name in
+                         sorted(glob.glob(os.path.join(path, "segment_*.npy")))]
+        self._index = []
+        for number, segment in enumerate(self.segments):
+            sequence = segment["sequence"]
+            for slot in numpy.flatnonzero(sequence > 0):
+                self._index.append((sequence[slot], number, slot))
+        self._index.sort()
+        #: Contents of the manifest, empty if there is none
+        self.manifest = {}
+        manifest = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as manifest_file:
+                self.manifest = simplejson.load(manifest_file)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, index):
+        """Return the slot of pair ``index``, a read-only structured scalar."""
+        _, number, slot = self._index[index]
+        return self.segments[number][slot]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def frames(self, index):
+        """Return the (left, right) frames of pair ``index``."""
+        slot = self[index]
+        return [slot[side] for side in SIDES]
+
+    def timestamps(self):
+        """Return the grab timestamps of every pair, shaped (pairs, 2)."""
+        return numpy.array([self[index]["timestamps"]
+                            for index in range(len(self))])
+
+
+class RecordingSource(_PacedSource):
+
+    """
+    One camera of a recording, usable as a ``VideoCapture``.
+
+    ``reader`` is a ``RecordingReader``; ``side`` is "left" or "right". With
+    ``loop``, replay starts over at the end; otherwise ``grab`` then fails.
+    ``fps`` paces ``grab`` like ``frame_sources.SyntheticSource``.
+    """
+
+    def __init__(self, reader, side, loop=True, fps=None):
+        if not len(reader):
+            raise ValueError("No frames recorded in {}".format(reader.path))
+        #: Recording being replayed
+        self.reader = reader
+        self.side = side
+        self.loop = loop
+        self.fps = fps
+        self.properties = {}
+        self._frame = -1
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        self._pace()
+        if self._frame + 1 >= len(self.reader) and not self.loop:
+            return False
+        self._frame += 1
+        return True
+
+    def retrieve(self, image=None):
+        frame = self.reader[self._frame % len(self.reader)][self.side]
+        if (image is not None and image.shape == frame.shape and
+                image.dtype == frame.dtype and image.flags.writeable):
+            numpy.copyto(image, frame)
+            return True, image
+        return True, numpy.array(frame)
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, prop):
+        frame = self.reader[max(self._frame, 0) % len(self.reader)][self.side]
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(frame.shape[1])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(frame.shape[0])
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.reader))
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self._frame + 1)
+        return self.properties.get(prop, 0.0)
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self._frame = int(value) - 1
+            return True
+        self.properties[prop] = value
+        return True
+
+    def release(self):
+        pass
+
+
+def recording_pair(path, **kwargs):
+    """
+    Return (left, right) ``RecordingSource`` sources replaying ``path``.
+
+    Keyword arguments are passed to ``RecordingSource``. The sources advance
+    independently; pass them to ``StereoPair(None, threaded=False,
+    captures=...)`` to replay the recorded pairs in lockstep.
+    """
+    reader = RecordingReader(path)
+    return [RecordingSource(reader, side, **kwargs) for side in SIDES]
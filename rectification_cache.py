@@ -0,0 +1,126 @@
+"""
+Persistent, memory-mapped cache of rectification maps.
+
+``StereoCalibration(input_folder=...)`` reads all four full-resolution float
+maps into memory every time a calibration is loaded. ``load_calibration`` only
+reads the small matrices and memory-maps the maps from a cache entry keyed by
+a hash of the calibration files, so loading costs a few page faults and the
+maps are shared between processes through the page cache. Entries can hold
+fixed-point maps (``CV_16SC2``), which are half the size and remap faster while
+giving the same nearest-neighbour result as the float maps.
+
+Functions:
+
+    * ``calibration_hash`` - Hash identifying a calibration folder
+    * ``load_calibration`` - Load a calibration with cached rectification maps
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy
+
+#: Calibration entries that hold the per-pixel remapping maps
+MAP_KEYS = ("undistortion_map", "rectification_map")
+
+#: Default location of the cache
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".stereoworkbench",
+                             "rectification")
+
+SIDES = ("left", "right")
+
+
+def calibration_hash(folder):
+    """
+    Return a hex digest identifying the calibration stored in ``folder``.
+
+    The matrices are hashed by content. The large map files are hashed by
+    size and modification time only, which changes whenever they are
+    re-exported.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(".npy"):
+            continue
+        path = os.path.join(folder, name)
+        digest.update(name)
+        if name.startswith(MAP_KEYS):
+            stat = os.stat(path)
+            digest.update("{}:{}".format(stat.st_size, stat.st_mtime))
+        else:
+            with open(path, "rb") as npy_file:
+                digest.update(npy_file.read())
+    return digest.hexdigest()
+
+
+def _load_matrices(folder):
+    """Load every calibration entry from ``folder`` except the maps."""
+    # imported here so importing the cache does not load stereovision
+    from stereovision.calibration import StereoCalibration
+    calibration = StereoCalibration()
+    for key, item in calibration.__dict__.items():
+        if key in MAP_KEYS:
+            continue
+        if isinstance(item, dict):
+            for side in SIDES:
+                item[side] = numpy.load(
+                    os.path.join(folder, "{}_{}.npy".format(key, side)))
+        else:
+            calibration.__dict__[key] = numpy.load(
+                os.path.join(folder, "{}.npy".format(key)))
+    return calibration
+
+
+def _build_entry(folder, entry, fixed_point):
+    """Convert the maps in ``folder`` and store them atomically in ``entry``."""
+    parent = os.path.dirname(entry)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(dir=parent)
+    try:
+        for side in SIDES:
+            maps = [numpy.load(os.path.join(folder, "{}_{}.npy".format(key,
+                                                                       side)))
+                    for key in MAP_KEYS]
+            if fixed_point:
+                # nearest-neighbour conversion needs no interpolation table
+                maps = [cv2.convertMaps(maps[0], maps[1], cv2.CV_16SC2,
+                                        nninterpolation=True)[0]]
+            for key, item in zip(MAP_KEYS, maps):
+                numpy.save(os.path.join(staging, "{}_{}.npy".format(key, side)),
+                           item)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # another process built the same entry first
+            if not os.path.isdir(entry):
+                raise
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+
+
+def load_calibration(folder, cache_dir=None, fixed_point=False):
+    """
+    Load the calibration in ``folder``, memory-mapping its maps from the cache.
+
+    The cache entry is created on first use. With ``fixed_point``, the maps are
+    stored as a single ``CV_16SC2`` map per side and ``rectification_map`` is
+    None, which ``cv2.remap`` accepts for nearest-neighbour remapping.
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE
+    name = calibration_hash(folder) + ("-fixed" if fixed_point else "")
+    entry = os.path.join(cache_dir, name)
+    if not os.path.isdir(entry):
+        _build_entry(folder, entry, fixed_point)
+    calibration = _load_matrices(folder)
+    for key in MAP_KEYS:
+        for side in SIDES:
+            path = os.path.join(entry, "{}_{}.npy".format(key, side))
+            if os.path.exists(path):
+                calibration.__dict__[key][side] = numpy.load(path,
+                                                             mmap_mode="r")
+    return calibration
@@ -0,0 +1,160 @@
+"""
+Content-addressed on-disk cache of disparity maps and point clouds.
+
+Rendering the same pair again with an unchanged calibration and block matcher
+repeats the whole SGBM computation. ``RenderCache`` stores each render's
+disparity map, point coordinates and colors under a key derived from the image
+contents, the calibration and the block matcher settings, so a repeated render
+reads them back memory-mapped instead. The rectification maps are not hashed:
+they follow from the calibration matrices and the image size, which are. The
+cache is bounded in size and evicts the least recently used entries.
+
+Classes:
+
+    * ``RenderCache`` - Size-bounded LRU cache of render results
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy
+import simplejson
+
+from rectification_cache import MAP_KEYS
+
+#: Default location of the cache
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".stereoworkbench",
+                             "renders")
+
+#: Arrays stored per entry
+ENTRY_ARRAYS = ("disparity", "points", "colors")
+
+#: Version of the entry contents, part of every key. Version 2 entries hold
+#: only the points with a valid disparity.
+ENTRY_VERSION = 2
+
+
+def _hash_array(digest, array):
+    digest.update("{}{}".format(array.dtype.str, array.shape))
+    digest.update(numpy.ascontiguousarray(array).data)
+
+
+def _entry_size(entry):
+    size = 0
+    for name in os.listdir(entry):
+        size += os.path.getsize(os.path.join(entry, name))
+    return size
+
+
+class RenderCache(object):
+
+    """
+    Disparity maps and point clouds stored by content hash.
+
+    Entries are directories of ``.npy`` files, written under a temporary name
+    and renamed into place, so processes rendering in parallel can share a
+    cache. An entry's modification time records its last use.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=4 << 30):
+        #: Directory holding the entries
+        self.cache_dir = cache_dir or DEFAULT_CACHE
+        #: Size the cache is trimmed to after each store
+        self.max_bytes = max_bytes
+        #: Number of lookups that found an entry
+        self.hits = 0
+        #: Number of lookups that did not
+        self.misses = 0
+
+    def key(self, image_pair, calibration, block_matcher,
+            point_dtype="float32"):
+        """
+        Return the key of rendering ``image_pair`` with ``calibration`` and
+        ``block_matcher`` into points of type ``point_dtype``.
+        """
+        digest = hashlib.sha1()
+        digest.update("v{}:{}".format(ENTRY_VERSION,
+                                      numpy.dtype(point_dtype).str))
+        for image in image_pair:
+            _hash_array(digest, image)
+        for key, item in sorted(calibration.__dict__.items()):
+            if key in MAP_KEYS:
+                # fixed-point and float maps rectify slightly differently
+                digest.update("{}:{}".format(key, getattr(item["left"],
+                                                          "dtype", None)))
+            elif isinstance(item, dict):
+                for side in sorted(item):
+                    _hash_array(digest, numpy.asarray(item[side]))
+            else:
+                _hash_array(digest, numpy.asarray(item))
+        settings = dict((name, getattr(block_matcher, name))
+                        for name in block_matcher.parameter_maxima)
+        settings.update((name, value)
+                        for name, value in vars(block_matcher).items()
+                        if not name.startswith("_"))
+        settings["class"] = type(block_matcher).__name__
+        digest.update(simplejson.dumps(settings, sort_keys=True))
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        Return the entry stored under ``key`` as a dict of read-only
+        memory-mapped arrays, or None.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            arrays = dict((name, numpy.load(os.path.join(entry, name + ".npy"),
+                                            mmap_mode="r"))
+                          for name in ENTRY_ARRAYS)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # missing, or evicted by another process while being read
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def store(self, key, disparity, points, colors):
+        """Store a render result under ``key`` and evict old entries."""
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        staging = tempfile.mkdtemp(dir=self.cache_dir, prefix=".")
+        try:
+            for name, array in zip(ENTRY_ARRAYS, (disparity, points, colors)):
+                numpy.save(os.path.join(staging, name + ".npy"), array)
+            try:
+                os.rename(staging, os.path.join(self.cache_dir, key))
+            except OSError:
+                # another process stored the same entry first
+                pass
+        finally:
+            if os.path.isdir(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry), _entry_size(entry),
+                                entry))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # entries mapped by a reader elsewhere may refuse deletion on
+            # Windows; they are retried on the next store
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
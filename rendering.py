@@ -0,0 +1,110 @@
+"""
+Point cloud rendering from stereo image pairs.
+
+This is the render path shared by the workbench's render button and the
+headless batch renderer.
+
+Functions:
+
+    * ``load_block_matcher`` - Create a block matcher from a settings file
+    * ``render_pair`` - Turn an image pair into a point cloud file
+"""
+
+import numpy
+from stereovision.blockmatchers import StereoBM, StereoSGBM
+from stereovision.point_cloud import PointCloud
+
+from clock import monotonic
+from fast_blockmatchers import PyramidSGBM, TiledSGBM
+import instrumentation
+from ply_writer import write_ply
+from point_cloud_filters import filter_point_cloud
+from transformed_stereo_cameras import CalibratedPair
+
+
+#: SGBM block matcher class for each disparity engine
+ENGINES = {"sgbm": StereoSGBM,
+           "pyramid": PyramidSGBM,
+           "tiled": TiledSGBM}
+
+
+def load_block_matcher(settings="bm_settings.txt", use_stereobm=False,
+                       engine="sgbm"):
+    """
+    Create a block matcher configured from ``settings``.
+
+    ``engine`` selects the SGBM implementation from ``ENGINES``; all of them
+    read the same settings. ``use_stereobm`` creates a ``StereoBM`` instead.
+    """
+    if use_stereobm:
+        block_matcher = StereoBM()
+    else:
+        block_matcher = ENGINES[engine]()
+    block_matcher.load_settings(settings)
+    return block_matcher
+
+
+def _record(timings, name, start):
+    """Add the time since ``start`` to stage ``name`` of a render."""
+    timings[name] = (timings.get(name, 0.0) +
+                     instrumentation.record("render." + name, start))
+
+
+def render_pair(image_pair, calibration, block_matcher, output_path,
+                ply_format="binary", coordinate_type="float32",
+                quantization=None, filters=None, cache=None,
+                point_dtype="float32"):
+    """
+    Rectify ``image_pair``, compute its point cloud and write it as PLY.
+
+    ``image_pair`` holds the unrectified (left, right) images. ``ply_format``
+    is "binary" or "ascii"; ``coordinate_type`` and ``quantization`` apply to
+    binary output and are passed to ``ply_writer.write_ply``. ``filters`` is
+    a dict of keyword arguments for ``point_cloud_filters.filter_point_cloud``.
+    ``cache`` is an optional ``render_cache.RenderCache``; on a hit,
+    rectification, disparity and reprojection are skipped. ``point_dtype`` is
+    the type the coordinates are computed in; "float16" halves their memory.
+    Return a dict with the time in seconds spent in each stage.
+    """
+    timings = {}
+    points = None
+    if cache is not None:
+        start = monotonic()
+        key = cache.key(image_pair, calibration, block_matcher, point_dtype)
+        entry = cache.load(key)
+        if entry is not None:
+            points = PointCloud(entry["points"], entry["colors"])
+        _record(timings, "cache", start)
+
+    if points is None:
+        start = monotonic()
+        rectified_pair = calibration.rectify(image_pair)
+        _record(timings, "rectify", start)
+
+        start = monotonic()
+        disparity = block_matcher.get_disparity(rectified_pair)
+        _record(timings, "disparity", start)
+
+        start = monotonic()
+        camera_pair = CalibratedPair(None, calibration, block_matcher)
+        points = camera_pair.get_point_cloud(rectified_pair, disparity,
+                                             numpy.dtype(point_dtype))
+        _record(timings, "reproject", start)
+
+        if cache is not None:
+            start = monotonic()
+            cache.store(key, disparity, points.coordinates, points.colors)
+            _record(timings, "cache", start)
+
+    if filters:
+        points, filter_timings = filter_point_cloud(points, **filters)
+        timings.update(filter_timings)
+
+    start = monotonic()
+    if ply_format == "ascii":
+        points.write_ply(output_path)
+    else:
+        write_ply(output_path, points.coordinates, points.colors,
+                  coordinate_type, quantization)
+    _record(timings, "write", start)
+    return timings
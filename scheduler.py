@@ -0,0 +1,134 @@
+"""
+Drift-free scheduling of periodic work on monotonic deadlines.
+
+A schedule runs its callback at fixed multiples of its interval from its first
+deadline, however long each run takes, so captures every 60 seconds stay on the
+minute over days of recording. Deadlines missed while a run or the host was
+busy are skipped rather than run back to back. All deadlines come from
+``clock.monotonic``, so changes of the wall clock do not affect them. Between
+deadlines the thread calling ``wait`` sleeps.
+
+Classes:
+
+    * ``Schedule`` - A named callback and its periodic deadlines
+    * ``Scheduler`` - Runs several schedules from one thread
+"""
+
+import math
+import threading
+
+from clock import monotonic
+
+
+class Schedule(object):
+
+    """A callback run every ``interval`` seconds, starting at ``deadline``."""
+
+    def __init__(self, name, interval, callback, deadline):
+        if interval <= 0:
+            raise ValueError("Interval must be positive: {}".format(interval))
+        self.name = name
+        #: Seconds between runs
+        self.interval = interval
+        self.callback = callback
+        #: First deadline; every deadline is a whole number of intervals later
+        self.origin = deadline
+        #: Monotonic time of the next run
+        self.deadline = deadline
+        #: Number of runs so far
+        self.runs = 0
+        #: Number of deadlines skipped because they had already passed
+        self.missed = 0
+
+    def advance(self, now):
+        """Move ``deadline`` to the first multiple of the interval after now."""
+        periods = int(math.floor((now - self.origin) / self.interval)) + 1
+        deadline = self.origin + periods * self.interval
+        self.missed += max(int(round((deadline - self.deadline) /
+                                     self.interval)) - 1, 0)
+        self.deadline = deadline
+
+
+class Scheduler(object):
+
+    """
+    Run named schedules from a single thread.
+
+    The owning thread alternates ``run_pending`` and ``wait``. Schedules may be
+    added, changed and removed from any thread; doing so wakes a waiting
+    scheduler so new deadlines take effect at once.
+    """
+
+    def __init__(self):
+        self._schedules = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def add(self, name, interval, callback, delay=None):
+        """
+        Run ``callback`` every ``interval`` seconds, first after ``delay``
+        seconds (default: one interval). Replace any schedule called ``name``.
+        Return the new ``Schedule``.
+        """
+        if delay is None:
+            delay = interval
+        schedule = Schedule(name, interval, callback, monotonic() + delay)
+        with self._lock:
+            self._schedules[name] = schedule
+        self.wake()
+        return schedule
+
+    def remove(self, name):
+        """Remove schedule ``name``, if there is one."""
+        with self._lock:
+            self._schedules.pop(name, None)
+        self.wake()
+
+    def get(self, name):
+        """Return schedule ``name``, or None."""
+        return self._schedules.get(name)
+
+    def next_deadline(self):
+        """Return the earliest deadline, or None without schedules."""
+        with self._lock:
+            deadlines = [schedule.deadline
+                         for schedule in self._schedules.values()]
+        return min(deadlines) if deadlines else None
+
+    def run_pending(self):
+        """
+        Run every schedule whose deadline has passed, earliest first, once.
+        Return the number of callbacks run.
+        """
+        now = monotonic()
+        with self._lock:
+            due = sorted((schedule for schedule in self._schedules.values()
+                          if schedule.deadline <= now),
+                         key=lambda schedule: schedule.deadline)
+            for schedule in due:
+                schedule.advance(now)
+        for schedule in due:
+            schedule.runs += 1
+            schedule.callback()
+        return len(due)
+
+    def wait(self, timeout=None):
+        """
+        Sleep until the next deadline, ``timeout`` seconds at most, or until
+        ``wake`` is called.
+        """
+        # cleared first: a schedule added after this is seen below or wakes
+        # the wait, instead of its wake being cleared away
+        self._wake.clear()
+        deadline = self.next_deadline()
+        delay = timeout
+        if deadline is not None:
+            delay = deadline - monotonic()
+            if timeout is not None:
+                delay = min(delay, timeout)
+        if delay is None or delay > 0:
+            self._wake.wait(delay)
+
+    def wake(self):
+        """Make a waiting ``wait`` return."""
+        self._wake.set()
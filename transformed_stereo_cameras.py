@@ -29,21 +29,56 @@ Classes:
 .. image:: classes_stereo_cameras.svg
 """
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import threading
+
 import cv2
 import numpy
 
-from stereovision.point_cloud import PointCloud
+from capture_engine import SynchronizedCapture
+import instrumentation
+from rectification_cache import load_calibration
+
+#: Affine transform and output size of recent rotations, keyed by
+#: (height, width, angle, scale), least recently used first
+_rotation_cache = OrderedDict()
+
+#: Number of rotations kept in ``_rotation_cache``
+ROTATION_CACHE_SIZE = 16
+
+# preview and capture threads rotate frames concurrently
+_rotation_lock = threading.Lock()
+
+#: Rows of a disparity map reprojected at a time by ``reproject_valid``
+REPROJECTION_BAND = 64
+
+#: ``cv2.rotate`` codes for clockwise quarter turns
+_quarter_turns = {1: cv2.ROTATE_90_CLOCKWISE,
+                  2: cv2.ROTATE_180,
+                  3: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+
+def _rotation_transform(shape, angle, scale):
+    """Return the cached affine transform and output size for a rotation."""
+    key = (shape[0], shape[1], angle, scale)
+    with _rotation_lock:
+        transform = _rotation_cache.pop(key, None)
+        if transform is not None:
+            # back at the end, as most recently used
+            _rotation_cache[key] = transform
+            return transform
 
-def rotate_bound(image, angle):
     # grab the dimensions of the image and then determine the
     # center
-    (h, w) = image.shape[:2]
+    (h, w) = shape[:2]
     (cX, cY) = (w // 2, h // 2)
  
     # grab the rotation matrix (applying the negative of the
     # angle to rotate clockwise), then grab the sine and cosine
-    # (i.e., the rotation components of the matrix)
-    M = cv2.getRotationMatrix2D((cX, cY), -angle, 1.0)
+    # (i.e., the rotation components of the matrix, which also
+    # carry the scale)
+    M = cv2.getRotationMatrix2D((cX, cY), -angle, scale)
     cos = numpy.abs(M[0, 0])
     sin = numpy.abs(M[0, 1])
  
@@ -54,9 +89,100 @@ def rotate_bound(image, angle):
     # adjust the rotation matrix to take into account translation
     M[0, 2] += (nW / 2) - cX
     M[1, 2] += (nH / 2) - cY
- 
-    # perform the actual rotation and return the image
-    return cv2.warpAffine(image, M, (nW, nH))
+
+    transform = (M, (nW, nH))
+    with _rotation_lock:
+        _rotation_cache[key] = transform
+        # every scale and angle tried in the UI would be kept otherwise
+        while len(_rotation_cache) > ROTATION_CACHE_SIZE:
+            _rotation_cache.popitem(last=False)
+    return transform
+
+
+def rotate_scaled(image, angle, scale=1.0):
+    """
+    Rotate ``image`` clockwise by ``angle`` degrees and resize it by ``scale``.
+
+    Multiples of 90 degrees are done losslessly with ``cv2.rotate``, after
+    the image has been shrunk, so only one pass touches the full-resolution
+    frame. Any other angle is a single ``warpAffine`` with the scale folded
+    into the cached transform.
+    """
+    if angle % 90 == 0:
+        if scale != 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale,
+                               interpolation=cv2.INTER_AREA)
+        turns = int(angle // 90) % 4
+        if turns:
+            image = cv2.rotate(image, _quarter_turns[turns])
+        return image
+    M, size = _rotation_transform(image.shape, angle, scale)
+    return cv2.warpAffine(image, M, size)
+
+
+def open_capture(device, width=1920, height=1080):
+    """Open video capture ``device`` and request a ``width`` x ``height`` frame."""
+    capture = cv2.VideoCapture(device)
+    #capture.set(cv2.CAP_PROP_SETTINGS, 0)
+    #capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    #capture.set(cv2.CAP_PROP_FOURCC,  cv2.VideoWriter_fourcc('I','R', 'A', 'W'))
+    capture.set(cv2.CAP_PROP_FRAME_WIDTH, float(width))
+    capture.set(cv2.CAP_PROP_FRAME_HEIGHT, float(height))
+    return capture
+
+
+def rotate_bound(image, angle):
+    """Rotate ``image`` clockwise by ``angle`` degrees without cropping it."""
+    return rotate_scaled(image, angle)
+
+
+def reproject_valid(disparity, disp_to_depth_mat, image, threshold=0,
+                    dtype=numpy.float32, band_height=REPROJECTION_BAND):
+    """
+    Reproject the pixels of ``disparity`` above ``threshold`` to 3D.
+
+    This gives the points ``cv2.reprojectImageTo3D`` computes for those
+    pixels, but never builds a full-size point array: the valid pixels are
+    counted first, the output is allocated once, and bands of
+    ``band_height`` rows are reprojected into it with the
+    ``disp_to_depth_mat``. Colors are gathered from the BGR (or gray)
+    ``image`` through the same mask. Points that are not finite or do not fit
+    into ``dtype``, e.g. those of disparities close to 0 in float16, are
+    dropped. Return (coordinates, colors): Nx3 ``dtype`` coordinates and Nx3
+    uint8 RGB colors.
+    """
+    valid = disparity > threshold
+    # an upper bound, points out of range are only found while reprojecting
+    count = numpy.count_nonzero(valid)
+    coordinates = numpy.empty((count, 3), dtype)
+    colors = numpy.empty((count, 3), numpy.uint8)
+    matrix = numpy.asarray(disp_to_depth_mat, numpy.float64)
+    limit = numpy.finfo(dtype).max
+    start = 0
+    for top in range(0, disparity.shape[0], band_height):
+        band = valid[top:top + band_height]
+        rows, columns = numpy.nonzero(band)
+        if not len(rows):
+            continue
+        x = columns.astype(numpy.float32)
+        y = (rows + top).astype(numpy.float32)
+        d = disparity[top:top + band_height][band].astype(numpy.float32)
+        homogeneous = [matrix[i, 0] * x + matrix[i, 1] * y +
+                       matrix[i, 2] * d + matrix[i, 3] for i in range(4)]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            axes = [homogeneous[axis] / homogeneous[3] for axis in range(3)]
+        # NaN fails the comparison as well
+        keep = numpy.logical_and.reduce([abs(axis) <= limit for axis in axes])
+        end = start + numpy.count_nonzero(keep)
+        for i, axis in enumerate(axes):
+            coordinates[start:end, i] = axis[keep]
+        pixels = image[top:top + band_height][band][keep]
+        colors[start:end] = (pixels[:, None] if pixels.ndim == 1
+                             else pixels[:, ::-1])
+        start = end
+    if start < count:
+        coordinates, colors = coordinates[:start].copy(), colors[:start].copy()
+    return coordinates, colors
 
 
 class StereoPair(object):
@@ -74,51 +200,115 @@ class StereoPair(object):
     windows = ["{} camera".format(side) for side in ("Left", "Right")]
     rotation = [0, 0]
 
-    def __init__(self, devices):
+    def __init__(self, devices, threaded=True, captures=None):
         """
         Initialize cameras.
 
-        ``devices`` is an iterable containing the device numbers.
+        ``devices`` is an iterable containing the device numbers. If
+        ``threaded`` is set, each camera is read by its own grab thread and
+        ``get_frames`` returns timestamp-matched frames. ``captures`` are
+        (left, right) ``VideoCapture``-like sources to use instead of opening
+        ``devices``, such as those in ``frame_sources``.
         """
-
-        if devices[0] != devices[1]:
-            #: Video captures associated with the ``StereoPair``
-            self.captures = [cv2.VideoCapture(device) for device in devices]
-            for capture in self.captures:
-                    #capture.set(cv2.CAP_PROP_SETTINGS, 0)
-                    #capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
-                    #capture.set(cv2.CAP_PROP_FOURCC,  cv2.VideoWriter_fourcc('I','R', 'A', 'W'))
-                    capture.set(cv2.CAP_PROP_FRAME_WIDTH, 1920.0)
-                    capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080.0)
+        #: ``SynchronizedCapture`` acquiring frames in the background, if any
+        self.engine = None
+        if captures is not None:
+            self.captures = list(captures)
+            if threaded:
+                self.engine = SynchronizedCapture(self.captures)
+        elif devices[0] != devices[1]:
+            # opening a camera and setting its resolution can take a second
+            # or more, so both are opened at once
+            pool = ThreadPool(len(devices))
+            try:
+                #: Video captures associated with the ``StereoPair``
+                self.captures = pool.map(open_capture, devices)
+            finally:
+                pool.close()
+            if threaded:
+                self.engine = SynchronizedCapture(self.captures)
         else:
             # Stereo images come from a single device, as single image
             self.captures = [cv2.VideoCapture(devices[0])]
             self.get_frames = self.get_frames_singleimage
+            self.get_raw_frames = self.get_frames_singleimage
+        #: Callables called with (camera index, property, requested value,
+        #: applied value) once a property was set, see ``set_property``
+        self.property_callbacks = (self.engine.property_callbacks
+                                   if self.engine else [])
+        #: {property: value} of each camera, as last applied
+        self.properties = [{} for capture in self.captures]
+        self.property_callbacks.append(self._remember_property)
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
+        if self.engine:
+            self.engine.stop()
         for capture in self.captures:
             capture.release()
         for window in self.windows:
-            cv2.destroyWindow(window)
+            try:
+                cv2.destroyWindow(window)
+            except cv2.error:
+                # never shown, e.g. when running headless
+                pass
 
     def set_rotation(self, isLeft, rotation):
         self.rotation[0 if isLeft else 1] = rotation
 
+    def set_properties(self, index, properties):
+        """
+        Set the {property: value} ``properties`` of camera ``index``.
+
+        With a capture engine, the camera's grab thread sets them before its
+        next grab and this returns at once; properties set again before then
+        only keep their latest value. ``property_callbacks`` are called on the
+        grab thread with the value the camera reports afterwards. Without an
+        engine, properties are set and reported right away.
+        """
+        if self.engine:
+            self.engine.set_properties(index, properties)
+            return
+        capture = self.captures[min(index, len(self.captures) - 1)]
+        for prop, value in sorted(properties.items()):
+            capture.set(prop, value)
+            applied = capture.get(prop)
+            for callback in list(self.property_callbacks):
+                callback(index, prop, value, applied)
+
+    def _remember_property(self, index, prop, value, applied):
+        self.properties[min(index, len(self.properties) - 1)][prop] = applied
+
+    def set_property(self, index, prop, value):
+        """Set property ``prop`` of camera ``index``, see ``set_properties``."""
+        self.set_properties(index, {prop: value})
+
+    def set_resolution(self, index, width, height):
+        """Change the frame size of camera ``index``."""
+        self.set_properties(index, {cv2.CAP_PROP_FRAME_WIDTH: width,
+                                    cv2.CAP_PROP_FRAME_HEIGHT: height})
+
     def get_frames(self):
         """
         Get current frames from cameras.
         This function was modified to support cameras which were rotated
         90 degrees in opposite directions.
         """
-        frames = []
-        orient = 1
-        for i in range(len(self.captures)):
-            capture = self.captures[i]
-            frames.append(rotate_bound(capture.read()[1], self.rotation[i]))
-        return frames
+        return [rotate_bound(frame, self.rotation[i])
+                for i, frame in enumerate(self.get_raw_frames())]
+
+    def get_raw_frames(self):
+        """
+        Get current frames from cameras without applying their rotation.
+
+        With a capture engine running, this returns the newest pair of frames
+        matched by grab timestamp and never blocks on device I/O.
+        """
+        if self.engine:
+            return self.engine.get_frames()
+        return [capture.read()[1] for capture in self.captures]
 
     def get_frames_singleimage(self):
         """
@@ -131,18 +321,30 @@ class StereoPair(object):
         right_frame = frame[:, width/2:, :]
         return [left_frame, right_frame]
 
-    def show_frames(self, wait=0, scale=80.0):
+    def show_frames(self, wait=0, scale=80.0, frames=None):
         """
         Show current frames from cameras.
 
         ``wait`` is the wait interval in milliseconds before the window closes.
+        ``frames`` are unrotated frames to show instead of reading new ones.
         """
-        for window, frame in zip(self.windows, self.get_frames()):
-            if frame.any():
-                frame = cv2.resize(frame, None, fx=scale/100.0, fy=scale/100.0, interpolation=cv2.INTER_AREA) 
-            cv2.imshow(window, frame)
-
-        cv2.waitKey(wait)
+        if frames is None:
+            frames = self.get_raw_frames()
+        with instrumentation.stage("preview.resize"):
+            frames = self._preview_frames(frames, scale/100.0)
+        for window, frame in zip(self.windows, frames):
+            if frame is None:
+                continue
+            with instrumentation.stage("preview.imshow"):
+                cv2.imshow(window, frame)
+
+        with instrumentation.stage("preview.waitKey"):
+            cv2.waitKey(wait)
+
+    def _preview_frames(self, frames, scale):
+        """Return unrotated ``frames`` rotated and resized by ``scale``."""
+        return [None if frame is None else rotate_scaled(frame, angle, scale)
+                for frame, angle in zip(frames, self.rotation)]
 
     def show_videos(self):
         """Show video from cameras."""
@@ -182,17 +384,22 @@ class CalibratedPair(StereoPair):
     A ``StereoPair`` that works with rectified images and produces point clouds.
     """
 
-    def __init__(self, devices, calibration, block_matcher):
+    def __init__(self, devices, calibration, block_matcher, captures=None):
         """
         Initialize cameras.
 
         ``devices`` is an iterable of the device numbers. If you want to use the
-        ``CalibratedPair`` in offline mode, it should be None.
-        ``calibration`` is a ``StereoCalibration`` object.
+        ``CalibratedPair`` in offline mode, it should be None. ``captures`` are
+        passed to ``StereoPair``.
+        ``calibration`` is a ``StereoCalibration`` object, or the folder it
+        was exported to, in which case its rectification maps are loaded from
+        the map cache.
         ``block_matcher`` is a ``BlockMatcher`` object.
         """
-        if devices:
-            super(CalibratedPair, self).__init__(devices)
+        if devices or captures is not None:
+            super(CalibratedPair, self).__init__(devices, captures=captures)
+        if isinstance(calibration, basestring):
+            calibration = load_calibration(calibration, fixed_point=True)
         #: ``StereoCalibration`` object holding the camera pair's calibration
         self.calibration = calibration
         #: ``BlockMatcher`` object for computing disparity and point cloud
@@ -203,10 +410,38 @@ class CalibratedPair(StereoPair):
         frames = super(CalibratedPair, self).get_frames()
         return self.calibration.rectify(frames)
 
-    def get_point_cloud(self, pair):
-        """Get 3D point cloud from image pair."""
-        disparity = self.block_matcher.get_disparity(pair)
-        points = self.block_matcher.get_3d(disparity,
-                                           self.calibration.disp_to_depth_mat)
-        colors = cv2.cvtColor(pair[0], cv2.COLOR_BGR2RGB)
-        return PointCloud(points, colors)
+    def _preview_frames(self, frames, scale):
+        """
+        Return unrotated ``frames`` rotated, rectified and resized by
+        ``scale``. The rectification maps are for full-resolution frames, so
+        frames are only shrunk after rectifying them. Incomplete pairs are
+        shown unrectified.
+        """
+        if any(frame is None for frame in frames):
+            return super(CalibratedPair, self)._preview_frames(frames, scale)
+        frames = self.calibration.rectify(
+            [rotate_bound(frame, angle)
+             for frame, angle in zip(frames, self.rotation)])
+        if scale == 1.0:
+            return frames
+        return [cv2.resize(frame, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA) for frame in frames]
+
+    def get_point_cloud(self, pair, disparity=None, dtype=numpy.float32):
+        """
+        Get 3D point cloud from image pair.
+
+        ``disparity`` is the pair's disparity map, if already computed. Only
+        pixels with a valid, positive disparity become points, so the cloud
+        needs no ``filter_infinity``. ``dtype`` is the coordinate type;
+        ``numpy.float16`` halves the cloud's memory at reduced precision.
+        """
+        from stereovision.point_cloud import PointCloud
+        if disparity is None:
+            disparity = self.block_matcher.get_disparity(pair)
+        # the engines mark invalid pixels with minDisparity - 1
+        threshold = max(getattr(self.block_matcher, "minDisparity", 0) - 1, 0)
+        coordinates, colors = reproject_valid(
+            disparity, self.calibration.disp_to_depth_mat, pair[0], threshold,
+            dtype)
+        return PointCloud(coordinates, colors)
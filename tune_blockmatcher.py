@@ -25,16 +25,56 @@ their resultant disparity map generated with the ``BlockMatcher`` and the
 parameters chosen in the ``BMTuner``'s GUI. Afterwards, report user's chosen
 settings and, if a file for the BM settings is provided, save the most common
 settings to file.
+
+With ``--search``, no GUI is shown. Candidate settings are instead searched
+automatically and scored by ``bm_search`` on all input pairs, and the best
+ones are saved.
 """
 
 from argparse import ArgumentParser
+import os
 
 import cv2
 
 from stereovision.blockmatchers import StereoBM, StereoSGBM
-from stereovision.calibration import StereoCalibration
 from stereovision.ui_utils import find_files, BMTuner, STEREO_BM_FLAG
 
+import bm_search
+from rectification_cache import load_calibration
+
+
+def search(args, calibration, input_files, block_matcher):
+    """Search settings headlessly, print the best and save the winner."""
+    bm_settings = args.bm_settings or "bm_settings.txt"
+    if os.path.exists(bm_settings):
+        block_matcher.load_settings(bm_settings)
+    pairs = bm_search.load_pairs(calibration, input_files)
+    print("Searching {} settings on {} pairs.".format(args.search, len(pairs)))
+    if args.search == "grid":
+        results = bm_search.grid_search(block_matcher, pairs, args.parameters,
+                                        args.workers)
+    elif args.search == "halving":
+        results = bm_search.successive_halving(block_matcher, pairs,
+                                               args.candidates,
+                                               args.parameters, args.workers,
+                                               args.seed)
+    else:
+        results = bm_search.random_search(block_matcher, pairs,
+                                          args.candidates, args.parameters,
+                                          args.workers, args.seed)
+    for score, settings, metrics in results[:5]:
+        if score is None:
+            break
+        print("score {:.3f} (valid {:.3f}, consistent {:.3f}): {}".format(
+            score, metrics["valid"], metrics["consistency"], settings))
+    score, settings = results[0][:2]
+    if score is None:
+        print("No valid settings found.")
+        return
+    bm_search.apply_settings(block_matcher, settings)
+    block_matcher.save_settings(bm_settings)
+    print("Saved best settings to {}.".format(bm_settings))
+
 
 def main():
     parser = ArgumentParser(description="Read images taken from a calibrated "
@@ -50,14 +90,35 @@ def main():
     parser.add_argument("--bm_settings",
                         help="File to save last block matcher settings to.",
                         default="")
+    parser.add_argument("--float_maps", help="Cache the rectification maps as "
+                        "float instead of fixed-point maps.",
+                        action="store_true")
+    parser.add_argument("--search", choices=["random", "grid", "halving"],
+                        help="Search settings automatically instead of "
+                        "showing the tuner, and save the best to "
+                        "--bm_settings (default bm_settings.txt).")
+    parser.add_argument("--candidates", type=int, default=64,
+                        help="Settings tried by random and halving search.")
+    parser.add_argument("--parameters", nargs="+",
+                        help="Only search these parameters, keeping the "
+                        "others at their saved values.")
+    parser.add_argument("--workers", type=int,
+                        help="Candidates evaluated in parallel.")
+    parser.add_argument("--seed", type=int, help="Random search seed.")
     args = parser.parse_args()
 
-    calibration = StereoCalibration(input_folder=args.calibration_folder)
+    calibration = load_calibration(args.calibration_folder,
+                                   fixed_point=not args.float_maps)
     input_files = find_files(args.image_folder)
+    if len(input_files) < 2:
+        parser.error("No image pairs found in {}.".format(args.image_folder))
     if args.use_stereobm:
         block_matcher = StereoBM()
     else:
         block_matcher = StereoSGBM()
+    if args.search:
+        search(args, calibration, input_files, block_matcher)
+        return
     image_pair = [cv2.imread(image) for image in input_files[:2]]
     input_files = input_files[2:]
     rectified_pair = calibration.rectify(image_pair)
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Qt Designer forms compiled to Python ahead of use.
+
+``uic.loadUi`` parses the ``.ui`` XML and builds the widgets through the
+uic machinery every time a window is created. ``load_ui`` does the same job
+from a Python module that ``uic.compileUi`` generated once, next to the form
+in a ``compiled`` folder, and regenerates it whenever the form is newer. Run
+this module to compile every form ahead of time, e.g. on read-only installs.
+
+Functions:
+
+    * ``compiled_form`` - Path of a form's compiled module, compiling if stale
+    * ``load_ui`` - Set up a widget from a form, like ``uic.loadUi``
+"""
+
+import glob
+import imp
+import os
+
+from PyQt4 import uic
+
+#: Folder, next to the forms, holding their compiled modules
+COMPILED_FOLDER = "compiled"
+
+#: Compiled form modules loaded so far, by path
+_modules = {}
+
+
+def compiled_form(ui_path):
+    """
+    Return the path of the module compiled from ``ui_path``, compiling it
+    first if it is missing or older than the form.
+    """
+    folder, name = os.path.split(ui_path)
+    folder = os.path.join(folder, COMPILED_FOLDER)
+    target = os.path.join(folder, os.path.splitext(name)[0] + "_ui.py")
+    if (os.path.exists(target) and
+            os.path.getmtime(target) >= os.path.getmtime(ui_path)):
+        return target
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    staging = target + ".tmp"
+    with open(staging, "w") as module_file:
+        uic.compileUi(ui_path, module_file)
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(staging, target)
+    return target
+
+
+def load_ui(ui_path, widget):
+    """
+    Build the form ``ui_path`` into ``widget`` and return ``widget``.
+
+    As with ``uic.loadUi``, the form's child widgets become attributes of
+    ``widget``. Falls back to ``uic.loadUi`` if the compiled module cannot be
+    written.
+    """
+    try:
+        module_path = compiled_form(ui_path)
+    except (IOError, OSError):
+        return uic.loadUi(ui_path, widget)
+    module = _modules.get(module_path)
+    if module is None:
+        name = "compiled_" + os.path.splitext(os.path.basename(ui_path))[0]
+        module = imp.load_source(name, module_path)
+        _modules[module_path] = module
+    form_class = [value for name, value in vars(module).items()
+                  if name.startswith("Ui_")][0]
+    form = form_class()
+    form.setupUi(widget)
+    for name, value in vars(form).items():
+        setattr(widget, name, value)
+    return widget
+
+
+if __name__ == "__main__":
+    for ui_path in glob.glob(os.path.join("workbench_ui", "*.ui")):
+        print("Compiled {}".format(compiled_form(ui_path)))
@@ -0,0 +1,141 @@
+"""
+Live camera preview embedded in the main window.
+
+The HighGUI preview draws from the capture thread and waits in
+``cv2.waitKey``, so a slow display slows down acquisition. ``StereoViewport``
+decouples the two: the capture side only hands over references to the latest
+frames, and a timer on the GUI thread draws whatever is newest at most
+``maxFps`` times per second. Frames that arrive faster are dropped before any
+work is done on them. Each frame is shrunk and rotated to its panel in one
+OpenCV pass, and the result is drawn through a ``QImage`` that wraps the
+panel's buffer without copying it.
+
+Classes:
+
+    * ``StereoViewport`` - Widget showing the latest frames side by side
+"""
+
+import threading
+
+import cv2
+import numpy
+from PyQt4 import QtCore, QtGui
+
+import instrumentation
+from transformed_stereo_cameras import rotate_scaled
+
+
+def _rotated_size(shape, angle):
+    """Return (width, height) of an image of ``shape`` rotated by ``angle``."""
+    height, width = shape[:2]
+    radians = numpy.radians(angle)
+    cos, sin = abs(numpy.cos(radians)), abs(numpy.sin(radians))
+    return width * cos + height * sin, width * sin + height * cos
+
+
+class StereoViewport(QtGui.QWidget):
+
+    """
+    Show the most recently submitted frames side by side.
+
+    ``submit`` may be called from any thread. It keeps references to the
+    frames, which must not be modified afterwards, and never waits for the
+    display. Frames submitted again before the display picked them up are
+    counted as dropped.
+    """
+
+    def __init__(self, parent=None, maxFps=30):
+        QtGui.QWidget.__init__(self, parent)
+        self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
+        #: Number of submitted frame sets drawn
+        self.shown = 0
+        #: Number of submitted frame sets replaced before being drawn
+        self.dropped = 0
+        self.maxFps = maxFps
+        self._lock = threading.Lock()
+        self._pending = None
+        self._current = None
+        self._buffers = []
+        self._images = []
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._refresh)
+        self.setMaxFps(maxFps)
+
+    def setMaxFps(self, fps):
+        """Redraw at most ``fps`` times per second."""
+        self.maxFps = fps
+        self._timer.start(int(1000.0 / fps))
+
+    def submit(self, frames, rotation=None):
+        """Show ``frames``, rotated clockwise by ``rotation`` degrees each."""
+        if rotation is None:
+            rotation = [0] * len(frames)
+        with self._lock:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (list(frames), list(rotation))
+
+    def stop(self):
+        """Stop redrawing."""
+        self._timer.stop()
+
+    def _refresh(self):
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None or not self.isVisible():
+            return
+        self._current = pending
+        self._prepare()
+        self.update()
+        self.shown += 1
+
+    def _buffer(self, index, size):
+        """Return the BGRA buffer of panel ``index``, (height, width) ``size``."""
+        while len(self._buffers) <= index:
+            self._buffers.append(None)
+        buffer = self._buffers[index]
+        if buffer is None or buffer.shape[:2] != size:
+            buffer = numpy.empty(size + (4,), numpy.uint8)
+            self._buffers[index] = buffer
+        return buffer
+
+    def _prepare(self):
+        """Shrink the current frames into their panels' images."""
+        with instrumentation.stage("viewport.prepare"):
+            frames = [(frame, angle) for frame, angle in zip(*self._current)
+                      if frame is not None]
+            panel = self.width() // max(len(frames), 1)
+            height = self.height()
+            images = []
+            for i, (frame, angle) in enumerate(frames):
+                width, length = _rotated_size(frame.shape, angle)
+                scale = min(panel / width, height / length)
+                if scale <= 0:
+                    continue
+                small = rotate_scaled(frame, angle, scale)
+                buffer = self._buffer(i, small.shape[:2])
+                code = (cv2.COLOR_GRAY2BGRA if small.ndim == 2
+                        else cv2.COLOR_BGR2BGRA)
+                cv2.cvtColor(small, code, buffer)
+                # BGRA bytes are what Format_RGB32 stores on little-endian
+                # hosts; the image refers to the buffer, which is kept
+                image = QtGui.QImage(buffer.data, buffer.shape[1],
+                                     buffer.shape[0], buffer.strides[0],
+                                     QtGui.QImage.Format_RGB32)
+                x = i * panel + (panel - buffer.shape[1]) // 2
+                y = (height - buffer.shape[0]) // 2
+                images.append((QtCore.QPoint(x, y), image))
+            self._images = images
+
+    def paintEvent(self, event):
+        with instrumentation.stage("viewport.paint"):
+            painter = QtGui.QPainter(self)
+            painter.fillRect(self.rect(), QtCore.Qt.black)
+            for position, image in self._images:
+                painter.drawImage(position, image)
+            painter.end()
+
+    def resizeEvent(self, event):
+        if self._current is not None:
+            self._prepare()
+        QtGui.QWidget.resizeEvent(self, event)